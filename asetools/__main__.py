@@ -20,10 +20,11 @@ from mod.misc.log import Log
 from mod.misc.qsub import QSubmit
 from mod.misc.string_constants import *
 from mod.pipelines.rnaseq_variant_calling import RunRNASeqVariantCalling
+from mod.pipelines.wasp_ase_batch import RunWASPAlleleSpecificExpressionBatch
 from mod.pipelines.wasp_ase_pipeline import RunWASPAlleleSpecificExpressionPipeline
 from mod.process.change_vcf_chrom import RunChangeVcfChrom
 from mod.process.fishers_exact_test import RunFishersExactTest
-from mod.process.prepare_count_data import RunPrepareReadCountData
+from mod.process.prepare_count_data import RunPrepareReadCountData, ENGINES, STREAM_ENGINE
 from mod.process.retrieve_mapping_distances import RunRetrieveMappingDistances
 from mod.process.vcf_filter_ase import RunVcfFilterASE
 from mod.process.vcf_summary_statistics import RunVcfSummaryStatistics
@@ -36,6 +37,7 @@ ANALYSIS_SUBPARSER_STR = 'process'
 # Pipeline Names
 RNASEQ_VARIANT_CALLER_STR = 'Pipeline-RNAseqVariantCaller'
 WASP_ASE_READ_COUNTER_STR = 'Pipeline-ASEReadCounterWASP'
+WASP_ASE_BATCH_STR = 'Pipeline-ASEReadCounterWASP-Batch'
 
 # Single process names
 CHANGE_VCF_CHROM_STR = 'ChangeVcfChrom'
@@ -59,13 +61,24 @@ READ_COUNTS_FLAG = '--read-counts'
 ADD_CHR_FLAG = '--add-chr'
 REMOVE_CHR_FLAG = '--remove-chr'
 QSUB_FLAG = '--qsub'
+NO_RESUME_FLAG = '--no-resume'
+SAMPLE_SHEET_FLAG = '--sample-sheet'
+MAX_SAMPLES_FLAG = '--max-samples'
+BENJAMINI_HOCHBERG_FLAG = '--benjamini-hochberg'
+BGZIP_FLAG = '--bgzip'
+RENAME_MAP_FLAG = '--rename-map'
+COLUMNAR_FLAG = '--columnar'
+ENGINE_FLAG = '--engine'
 
 # Descriptions and help strings
 ASETOOLS_DESCRIPTION = "ASEtools: a command line interface for allele-specific expression pipelines and analysis."
 PROTOCOL_SELECTION_HELP = 'Specify the name of the protocol you would like to execute from the available options.'
 RNASEQ_VARIANT_CALLER_HELP = 'Implements the GATK RNAseq variant calling pipeline from start to finish.'
 WASP_ASE_READ_COUNTER_HELP = 'Implements the WASP ASE read count pipeline from start to finish.'
-CHANGE_VCF_CHROM_HELP = 'Adds or removes the "chr" prefix from all of the chromosomes in a VCF file'
+WASP_ASE_BATCH_HELP = 'Runs the WASP ASE read count pipeline for every sample of a sample sheet, sharing one pool of ' \
+                      'cores, memory and java virtual machines.'
+CHANGE_VCF_CHROM_HELP = 'Adds or removes the "chr" prefix from all of the chromosomes in a VCF file, or renames them ' \
+                        'with a rename map'
 VCF_SUMMARY_STATISTICS_HELP = 'Calculates summary statistics from the specified VCF.'
 VCF_FILTER_ASE_HELP = 'Filters a VCF file to only include those variants that are eligible for ASE read counting.'
 PREPARE_READ_COUNT_HELP = 'Takes the output of the WASP pipeline and merges cases/controls by summing read counts.'
@@ -83,6 +96,16 @@ CONTROLS_HELP = 'Read count TSV files produced by GATK ASEReadCounter. For each
                 'read count files separated by spaces.'
 READ_COUNTS_HELP = 'A read counts file produced by {STRING}'.format(STRING=PREPARE_READ_COUNT_STR)
 QSUB_HELP = 'Designate a template SGE submission script if you wish to run the command on the cluster.'
+NO_RESUME_HELP = 'Rerun every step of the pipeline, even those that completed in a previous run.'
+SAMPLE_SHEET_HELP = 'A tab-separated file with one line per sample and the columns: sample name, BAM, VCF.'
+MAX_SAMPLES_HELP = 'The number of samples that are started at once. Defaults to the number of cores available.'
+BENJAMINI_HOCHBERG_HELP = 'Also correct the p-values for multiple testing with the Benjamini-Hochberg method.'
+BGZIP_HELP = 'Compress the output VCF with bgzip and index it with tabix.'
+RENAME_MAP_HELP = 'A file with the old and new name of a chromosome on each line, separated by whitespace, such as ' \
+                  '"MT chrM". Chromosomes that are not in the file are left unchanged.'
+COLUMNAR_HELP = 'Write the output as a compressed, columnar numpy .npz table instead of a TSV file.'
+ENGINE_HELP = 'How the read counts are merged: "stream" merges the sorted files as they are read, using little ' \
+              'memory, and "numpy" loads them into memory in bulk, which is faster for small cohorts.'
 
 def main(args):
     """
@@ -111,7 +134,8 @@ def main(args):
             rnaseq_var_caller = RunRNASeqVariantCalling(output_dir=args.output_dir,
                                                         fastq1=args.fastq1,
                                                         fastq2=args.fastq2,
-                                                        logger=Log(args.output_dir))
+                                                        logger=Log(args.output_dir),
+                                                        resume=not args.no_resume)
             rnaseq_var_caller.run()
 
     # This executes the WASP ASE read counting pipeline if selected
@@ -128,9 +152,28 @@ def main(args):
             wasp_pipeline = RunWASPAlleleSpecificExpressionPipeline(output_dir=args.output_dir,
                                                                     input_bam=args.bam,
                                                                     input_vcf=args.vcf,
-                                                                    logger=Log(args.output_dir))
+                                                                    logger=Log(args.output_dir),
+                                                                    resume=not args.no_resume)
             wasp_pipeline.run()
 
+    # This executes the WASP ASE read counting pipeline for every sample of a sample sheet
+    elif args.protocol_name == WASP_ASE_BATCH_STR:
+
+        # Submit the whole batch as a single job to the cluster
+        if args.qsub:
+            qsub = QSubmit(args.output_dir, args.qsub, SPACE.join(sys.argv))
+            qsub.submit()
+
+        # Or run it locally without submitting it to the cluster.
+        else:
+
+            wasp_batch = RunWASPAlleleSpecificExpressionBatch(output_dir=args.output_dir,
+                                                              sample_sheet=args.sample_sheet,
+                                                              logger=Log(args.output_dir),
+                                                              max_samples=args.max_samples,
+                                                              resume=not args.no_resume)
+            wasp_batch.run()
+
 
     # This executes a script that changes the chromosome identifiers of a VCF file
     # This is often necessary in order to get VCF files into the correct format.
@@ -141,7 +184,8 @@ def main(args):
             change_vcf_chrom = RunChangeVcfChrom(output_dir=args.output_dir,
                                                  input_vcf=args.vcf,
                                                  add_chr=True,
-                                                 logger=Log(args.output_dir))
+                                                 logger=Log(args.output_dir),
+                                                 bgzip=args.bgzip or None)
 
         # If the user gives the --remove-chr argument, this sets up the script to remove the 'chr' prefix
         # from the VCF file.
@@ -149,10 +193,19 @@ def main(args):
             change_vcf_chrom = RunChangeVcfChrom(output_dir=args.output_dir,
                                                  input_vcf=args.vcf,
                                                  add_chr=False,
-                                                 logger=Log(args.output_dir))
+                                                 logger=Log(args.output_dir),
+                                                 bgzip=args.bgzip or None)
+
+        # If the user gives the --rename-map argument, the chromosomes are renamed as listed in the file.
+        elif args.rename_map:
+            change_vcf_chrom = RunChangeVcfChrom(output_dir=args.output_dir,
+                                                 input_vcf=args.vcf,
+                                                 rename_map=args.rename_map,
+                                                 logger=Log(args.output_dir),
+                                                 bgzip=args.bgzip or None)
         # Catch an argument error
         else:
-            raise argparse.ArgumentTypeError('You must specify either --add-chr or --remove-chr')
+            raise argparse.ArgumentTypeError('You must specify either --add-chr, --remove-chr or --rename-map')
 
         change_vcf_chrom.run()
 
@@ -169,7 +222,8 @@ def main(args):
 
         filter_vcf = RunVcfFilterASE(output_dir=args.output_dir,
                                      input_vcf=args.vcf,
-                                     logger=Log(args.output_dir))
+                                     logger=Log(args.output_dir),
+                                     bgzip=args.bgzip)
         filter_vcf.run()
 
 
@@ -180,7 +234,9 @@ def main(args):
         prepare_read_counts = RunPrepareReadCountData(output_dir=args.output_dir,
                                                       cases_paths=args.cases,
                                                       controls_paths=args.controls,
-                                                      logger=Log(args.output_dir))
+                                                      logger=Log(args.output_dir),
+                                                      columnar=args.columnar,
+                                                      engine=args.engine)
         prepare_read_counts.run()
 
     # This executes the Fishers exact test protocol
@@ -188,7 +244,9 @@ def main(args):
 
         fishers_exact_test = RunFishersExactTest(output_dir=args.output_dir,
                                                  read_count_data=args.read_counts,
-                                                 logger=Log(args.output_dir))
+                                                 logger=Log(args.output_dir),
+                                                 benjamini_hochberg=args.benjamini_hochberg,
+                                                 columnar=args.columnar)
         fishers_exact_test.run()
 
     # This retrieves the mapping distance between reads.
@@ -197,7 +255,8 @@ def main(args):
         retrieve_mapping_distances = RunRetrieveMappingDistances(output_dir=args.output_dir,
                                                                  input_bam=args.bam,
                                                                  input_vcf=args.vcf,
-                                                                 logger=Log(args.output_dir))
+                                                                 logger=Log(args.output_dir),
+                                                                 columnar=args.columnar)
         retrieve_mapping_distances.run()
 
 
@@ -216,6 +275,7 @@ def parse_arguments():
     rnaseq_var_call_pipeline.add_argument(FASTQ1_FLAG, required=True)
     rnaseq_var_call_pipeline.add_argument(FASTQ2_FLAG, required=True)
     rnaseq_var_call_pipeline.add_argument(QSUB_FLAG, help=QSUB_HELP)
+    rnaseq_var_call_pipeline.add_argument(NO_RESUME_FLAG, action='store_true', help=NO_RESUME_HELP)
 
 
     # WASP ASE READ COUNTING PIPELINE
@@ -224,6 +284,16 @@ def parse_arguments():
     wasp_pipeline.add_argument(BAM_FLAG, required=True, help=BAM_HELP)
     wasp_pipeline.add_argument(VCF_FLAG, required=True, help=VCF_HELP)
     wasp_pipeline.add_argument(QSUB_FLAG, help=QSUB_HELP)
+    wasp_pipeline.add_argument(NO_RESUME_FLAG, action='store_true', help=NO_RESUME_HELP)
+
+
+    # WASP ASE READ COUNTING PIPELINE FOR A BATCH OF SAMPLES
+    wasp_batch = subparsers.add_parser(WASP_ASE_BATCH_STR, help=WASP_ASE_BATCH_HELP)
+    wasp_batch.add_argument(OUTPUT_DIR_STR, help=OUTPUT_DIR_HELP)
+    wasp_batch.add_argument(SAMPLE_SHEET_FLAG, required=True, help=SAMPLE_SHEET_HELP)
+    wasp_batch.add_argument(MAX_SAMPLES_FLAG, type=int, help=MAX_SAMPLES_HELP)
+    wasp_batch.add_argument(QSUB_FLAG, help=QSUB_HELP)
+    wasp_batch.add_argument(NO_RESUME_FLAG, action='store_true', help=NO_RESUME_HELP)
 
 
     # Change VCF chromosome tag
@@ -233,6 +303,8 @@ def parse_arguments():
     add_remove_chr = change_vcf_chrom.add_mutually_exclusive_group(required=True)
     add_remove_chr.add_argument(ADD_CHR_FLAG, action='store_true')
     add_remove_chr.add_argument(REMOVE_CHR_FLAG, action='store_true')
+    add_remove_chr.add_argument(RENAME_MAP_FLAG, help=RENAME_MAP_HELP)
+    change_vcf_chrom.add_argument(BGZIP_FLAG, action='store_true', help=BGZIP_HELP)
 
     # VCF summary statistics
     vcf_summary_stats = subparsers.add_parser(VCF_SUMMARY_STATISTICS_STR, help=VCF_SUMMARY_STATISTICS_HELP)
@@ -244,6 +316,7 @@ def parse_arguments():
     vcf_ase_filter = subparsers.add_parser(VCF_FILTER_ASE_STR, help=VCF_FILTER_ASE_HELP)
     vcf_ase_filter.add_argument(OUTPUT_DIR_STR, help=OUTPUT_DIR_HELP)
     vcf_ase_filter.add_argument(VCF_FLAG, required=True, help=VCF_HELP)
+    vcf_ase_filter.add_argument(BGZIP_FLAG, action='store_true', help=BGZIP_HELP)
 
 
     # Prepare Read Count Data
@@ -251,12 +324,16 @@ def parse_arguments():
     prepare_read_count_data.add_argument(OUTPUT_DIR_STR, help=OUTPUT_DIR_HELP)
     prepare_read_count_data.add_argument(CASES_FLAG, type=str, nargs='+', required=True, action='append', help=CASES_HELP)
     prepare_read_count_data.add_argument(CONTROLS_FLAG, type=str, nargs='+', required=True, action='append', help=CONTROLS_HELP)
+    prepare_read_count_data.add_argument(COLUMNAR_FLAG, action='store_true', help=COLUMNAR_HELP)
+    prepare_read_count_data.add_argument(ENGINE_FLAG, choices=ENGINES, default=STREAM_ENGINE, help=ENGINE_HELP)
 
 
     # Fishers exact test on read count data
     fishers_exact_test = subparsers.add_parser(FISHERS_EXACT_TEST_STR, help=FISHERS_EXACT_TEST_HELP)
     fishers_exact_test.add_argument(OUTPUT_DIR_STR, help=OUTPUT_DIR_HELP)
     fishers_exact_test.add_argument(READ_COUNTS_FLAG, required=True, help=READ_COUNTS_HELP)
+    fishers_exact_test.add_argument(BENJAMINI_HOCHBERG_FLAG, action='store_true', help=BENJAMINI_HOCHBERG_HELP)
+    fishers_exact_test.add_argument(COLUMNAR_FLAG, action='store_true', help=COLUMNAR_HELP)
 
 
     # Retrieve mapping distances arguments
@@ -264,6 +341,7 @@ def parse_arguments():
     retrieve_mapping_dist.add_argument(OUTPUT_DIR_STR, help=OUTPUT_DIR_HELP)
     retrieve_mapping_dist.add_argument(BAM_FLAG, help=BAM_HELP)
     retrieve_mapping_dist.add_argument(VCF_FLAG, help=VCF_HELP)
+    retrieve_mapping_dist.add_argument(COLUMNAR_FLAG, action='store_true', help=COLUMNAR_HELP)
 
     args = parser.parse_args()
 
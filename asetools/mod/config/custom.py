@@ -7,6 +7,7 @@ This is currently configured for the mdurrant account on Stanford's SCG4 cluster
 This file must be correctly configured in order to run the ASEtools pipelines.
 """
 
+from mod.misc.resources import CORES, MEMORY, SCRATCH, JVM
 from mod.misc.string_constants import *
 
 # Picard execution path and picard version
@@ -30,9 +31,75 @@ GENCODE_EXONS_BED = "/home/mdurrant/montgomery/mdurrant/data/gencode.exons.merge
 # The maximum memory available to java for the process. 50g = 50 gigabytes.
 MAX_JAVA_MEMORY = "50g"
 
+# The number of cores and the memory that a single pipeline can use at once. Steps that do not depend on each other
+# are run at the same time, as long as all of the running steps fit within these limits.
+PIPELINE_MAX_CORES = 32
+PIPELINE_MAX_MEMORY = "120g"
+
+# The scratch disk that the steps of a pipeline can fill at once. Set to None to use the free space of the filesystem of
+# the output directory when the pipeline starts. The cores, memory and scratch disk that each step needs are declared by
+# the resources of its config below.
+PIPELINE_MAX_SCRATCH = None
+
+# The number of java virtual machines (picard and GATK steps) that can run at once, across all of the samples of a batch.
+MAX_CONCURRENT_JVMS = 4
+
+# A directory to cache the outputs of pipeline steps in. A step that is run on the same inputs with the same version and
+# arguments as before has its outputs hard-linked from the cache instead of being run again. Set to None to disable.
+# The least recently used outputs are removed once the cache is larger than STEP_CACHE_MAX_SIZE.
+STEP_CACHE_DIR = None
+STEP_CACHE_MAX_SIZE = "500g"
+
+# A json file that the output of the version commands of the tools is cached in, so that each tool and java is only asked
+# for its version once per host until its files change. Set to None to only cache the versions within a run.
+VERSION_CACHE_FILE = "~/.asetools/version_cache.json"
+
+# Whether the picard and GATK steps run their tools in long-lived java virtual machines, instead of each starting its
+# own. Each worker runs a nailgun server (https://github.com/facebook/nailgun) with the jar of the tool on its classpath,
+# and the steps run their tools through the nailgun client, so that java start up and JIT warm up are paid once per
+# worker. A worker runs one step at a time, and is replaced after JVM_WORKER_MAX_RUNS steps or a failed step. At most
+# MAX_CONCURRENT_JVMS workers are kept while idle, and the heap of an idle worker is not counted in PIPELINE_MAX_MEMORY.
+# Relative paths are resolved against the working directory that the pipeline was started in. Steps whose output is
+# streamed from STAR still start their own java virtual machine.
+USE_JVM_WORKERS = False
+NAILGUN_SERVER_JAR = "/home/mdurrant/software/nailgun/nailgun-server-1.0.1.jar"
+NAILGUN_SERVER_CLASS = "com.facebook.nailgun.NGServer"
+NAILGUN_CLIENT_PATH = "/home/mdurrant/software/nailgun/ng"
+JVM_WORKER_MAX_RUNS = 50
+
+# Whether the SAM output of STAR is piped straight into picard AddOrReplaceReadGroups, instead of being written to disk
+# and read back in. The uncompressed SAM of a full RNAseq sample can be hundreds of gigabytes.
+STREAM_STAR_OUTPUT = True
+
+# Whether the STAR genome is loaded into shared memory once, and shared by all of the alignments of a pipeline or batch,
+# instead of being loaded from disk by each alignment. STAR cannot insert splice junctions on the fly into a shared
+# genome, so the junctions must be inserted when the genome is generated, and --twopassMode must be None. The kernel must
+# also allow shared memory segments as large as the genome (kernel.shmmax and kernel.shmall).
+STAR_SHARED_GENOME = False
+
+# The number of parts of the genome that GATK ASEReadCounter and HaplotypeCaller are split into, each of which is run in
+# its own java virtual machine with SCATTER_JAVA_MEMORY. The outputs of the parts are merged in genome order.
+# HaplotypeCaller is only split between contigs, so that its calls match a run over the whole genome.
+# Set to 1 to run each of them once over the whole genome.
+SCATTER_SHARDS = 8
+SCATTER_JAVA_MEMORY = "8g"
+
+# Whether the WASP pipeline counts alleles with pysam in python, instead of starting GATK ASEReadCounter in java. The
+# pysam counter applies the read filters of the GATK ASEReadCounter arguments below in the same order as GATK, and counts
+# this many contigs at once. Only enable it once its counts have been compared with GATK ASEReadCounter on your data.
+USE_PYSAM_ASE_READ_COUNTER = False
+PYSAM_ASE_READ_COUNTER_PROCESSES = 8
+
 # You must specify a python interpreter that will run in a python environment that has been configured to run WASP.
 WASP_PYTHON_PATH = "/home/mdurrant/miniconda3/envs/venv2.7/bin/python"
 
+# Whether the WASP SNPs are also written to HDF5 files, which WASP find_intersecting_snps.py reads instead of the gzipped
+# text files of the SNP directory. This requires PyTables, and a version of WASP whose find_intersecting_snps.py accepts
+# --snp_tab and --snp_index. With WASP_HDF5_HAPLOTYPES, WASP only remaps the haplotypes of the samples of the VCF file,
+# rather than every combination of the alleles of the SNPs in a read.
+WASP_HDF5_SNPS = False
+WASP_HDF5_HAPLOTYPES = False
+
 
 class StarAlignCustomConfig:
     """
@@ -73,6 +140,12 @@ class StarAlignCustomConfig:
 
         ]
 
+        # The cores, memory and scratch disk that the step needs while it runs.
+        self.resources = {CORES: dict(self.args).get("--runThreadN", 1), MEMORY: "32g", SCRATCH: "100g"}
+
+        # The memory an alignment needs on top of the genome when the genome is shared, see STAR_SHARED_GENOME.
+        self.shared_genome_memory = "4g"
+
 
 class JavaCustomConfig:
     """
@@ -117,6 +190,9 @@ class PicardAddReadGroupsCustomConfig:
 
         ]
 
+        # The cores, memory, scratch disk and java virtual machines that the step needs while it runs.
+        self.resources = {CORES: 1, MEMORY: MAX_JAVA_MEMORY, SCRATCH: "50g", JVM: 1}
+
 
 class PicardMarkDuplicatesCustomConfig:
     """
@@ -143,6 +219,9 @@ class PicardMarkDuplicatesCustomConfig:
 
         ]
 
+        # The cores, memory, scratch disk and java virtual machines that the step needs while it runs.
+        self.resources = {CORES: 1, MEMORY: MAX_JAVA_MEMORY, SCRATCH: "50g", JVM: 1}
+
 
 class GATKSplitNCigarReadsCustomConfig:
     """
@@ -171,6 +250,9 @@ class GATKSplitNCigarReadsCustomConfig:
 
         ]
 
+        # The cores, memory, scratch disk and java virtual machines that the step needs while it runs.
+        self.resources = {CORES: 1, MEMORY: MAX_JAVA_MEMORY, SCRATCH: "50g", JVM: 1}
+
 
 class GATKRNAseqBaseRecalibratorCustomConfig:
     """
@@ -197,6 +279,9 @@ class GATKRNAseqBaseRecalibratorCustomConfig:
 
         ]
 
+        # The cores, memory, scratch disk and java virtual machines that the step needs while it runs.
+        self.resources = {CORES: 1, MEMORY: MAX_JAVA_MEMORY, SCRATCH: "1g", JVM: 1}
+
 
 class GATKPrintReadsCustomConfig:
     """
@@ -221,6 +306,9 @@ class GATKPrintReadsCustomConfig:
 
         ]
 
+        # The cores, memory, scratch disk and java virtual machines that the step needs while it runs.
+        self.resources = {CORES: 1, MEMORY: MAX_JAVA_MEMORY, SCRATCH: "50g", JVM: 1}
+
 
 class GATKHaplotypeCallerCustomConfig:
     """
@@ -247,6 +335,9 @@ class GATKHaplotypeCallerCustomConfig:
 
         ]
 
+        # The cores, memory, scratch disk and java virtual machines that the step needs while it runs.
+        self.resources = {CORES: 1, MEMORY: MAX_JAVA_MEMORY, SCRATCH: "5g", JVM: 1}
+
 
 class WASPFindIntersectingSnpsCustomConfig:
     """
@@ -273,6 +364,9 @@ class WASPFindIntersectingSnpsCustomConfig:
 
         ]
 
+        # The cores, memory and scratch disk that the step needs while it runs.
+        self.resources = {CORES: 1, MEMORY: "8g", SCRATCH: "50g"}
+
 
 class WASPFilterRemappedReadsCustomConfig:
     """
@@ -291,6 +385,9 @@ class WASPFilterRemappedReadsCustomConfig:
         # If only single argument, write it as ("--arg","")
         self.args = []
 
+        # The cores, memory and scratch disk that the step needs while it runs.
+        self.resources = {CORES: 1, MEMORY: "8g", SCRATCH: "50g"}
+
 
 class SamtoolsCustomConfig:
     """
@@ -327,6 +424,9 @@ class SamtoolsMergeCustomConfig:
             ('-f', '')
         ]
 
+        # The cores, memory and scratch disk that the step needs while it runs.
+        self.resources = {CORES: 1, MEMORY: "1g", SCRATCH: "50g"}
+
 
 class SamtoolsSortCustomConfig:
     """
@@ -344,6 +444,9 @@ class SamtoolsSortCustomConfig:
         # If only single argument, write it as ("--arg","")
         self.args = []
 
+        # The cores, memory and scratch disk that the step needs while it runs.
+        self.resources = {CORES: 1, MEMORY: "2g", SCRATCH: "100g"}
+
 
 class SamtoolsIndexCustomConfig:
     """
@@ -361,6 +464,9 @@ class SamtoolsIndexCustomConfig:
         # If only single argument, write it as ("--arg","")
         self.args = []
 
+        # The cores, memory and scratch disk that the step needs while it runs.
+        self.resources = {CORES: 1, MEMORY: "1g", SCRATCH: "1g"}
+
 
 class GATKVariantFiltrationCustomConfig:
     """
@@ -391,6 +497,9 @@ class GATKVariantFiltrationCustomConfig:
 
         ]
 
+        # The cores, memory, scratch disk and java virtual machines that the step needs while it runs.
+        self.resources = {CORES: 1, MEMORY: MAX_JAVA_MEMORY, SCRATCH: "1g", JVM: 1}
+
 
 class GATKASEReadCounterCustomConfig:
     """
@@ -419,3 +528,6 @@ class GATKASEReadCounterCustomConfig:
             ("-drf", "DuplicateRead")
 
         ]
+
+        # The cores, memory, scratch disk and java virtual machines that the step needs while it runs.
+        self.resources = {CORES: 1, MEMORY: MAX_JAVA_MEMORY, SCRATCH: "1g", JVM: 1}
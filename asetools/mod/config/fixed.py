@@ -23,6 +23,13 @@ class StarAlignFixedConfig:
         self.log_name = "star_align.json"
 
 
+class StarAlignAddReadGroupsFixedConfig:
+    def __init__(self):
+        self.name = "STAR-AddOrReplaceReadGroups"
+
+        self.log_name = "star_align_add_read_groups.json"
+
+
 class JavaFixedConfig:
     def __init__(self):
         self.name = "Java"
@@ -234,3 +241,12 @@ class WASPAlleleSpecificExpressionPipelineFixedConfig:
         self.name = "WASP-ASE-subprocess"
 
         self.input_file = FlagTwoArgs(flag='--readFilesIn', arg1=None, arg2=None)
+
+
+class WASPAlleleSpecificExpressionBatchFixedConfig:
+    def __init__(self):
+        self.name = "WASP-ASE-batch"
+
+        self.sample_sheet_columns = ['sample', 'bam', 'vcf']
+
+        self.summary_name = "batch_summary.tsv"
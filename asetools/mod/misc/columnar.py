@@ -0,0 +1,211 @@
+"""
+AUTHOR: Matt Durrant
+
+This module contains the writers and readers of the output tables of the process steps, which can be written as TSV
+files or as columnar tables.
+
+A columnar table is a compressed numpy .npz archive, which is much smaller than a TSV file and can be loaded without
+parsing any text. The rows are written in batches, and each column of each batch is stored as its own array, so that a
+large table never has to be held in memory while it is written. Numeric columns are stored as arrays of their type.
+Columns with few distinct values, such as the chromosome or the allele, are dictionary encoded: each batch stores an
+integer code for each row, and the distinct values are stored once for the whole table.
+"""
+
+import zipfile
+import numpy as np
+from mod.misc.string_constants import *
+
+# The type of the columns that are dictionary encoded.
+DICTIONARY = 'dictionary'
+
+# The number of rows that are held in memory before they are written as a batch.
+BATCH_ROWS = 100000
+
+# The names of the arrays in a columnar table.
+COLUMNS_KEY = 'columns'
+BATCHES_KEY = 'batches'
+DICTIONARY_KEY = 'dictionary.{COLUMN}'
+BATCH_KEY = 'batch{BATCH:06d}.{COLUMN}'
+ARRAY_SUFFIX = '.npy'
+
+# The type of the codes of the dictionary encoded columns.
+CODE_DTYPE = np.int32
+
+
+def is_columnar(path):
+    """
+    :param path: The path to a table.
+    :return: True if the table is a columnar table, rather than a TSV file.
+    """
+    return path.endswith(DOT + npz_str)
+
+
+def table_suffix(columnar):
+    """
+    :param columnar: Whether the table is a columnar table.
+    :return: The suffix of the table.
+    """
+    return npz_str if columnar else tsv_str
+
+
+def open_table(path, schema, columnar=False, batch_rows=BATCH_ROWS):
+    """
+    :param path: The path to write the table to.
+    :param schema: A list of the (name, type) of each column. The type is a numpy dtype, or DICTIONARY for a column of
+    strings that is dictionary encoded. The types are only used by columnar tables.
+    :param columnar: Whether to write a columnar table, rather than a TSV file.
+    :param batch_rows: The number of rows in each batch of a columnar table.
+    :return: A TsvTableWriter or ColumnarTableWriter.
+    """
+    if columnar:
+        return ColumnarTableWriter(path, schema, batch_rows)
+    return TsvTableWriter(path, schema)
+
+
+class TsvTableWriter:
+    """
+    This class writes the rows of a table to a TSV file, with a header line of the column names.
+    """
+
+    def __init__(self, path, schema):
+        """
+        The constructor for a TsvTableWriter object.
+        :param path: The path to write the TSV file to.
+        :param schema: A list of the (name, type) of each column.
+        """
+        self.outfile = open(path, w)
+        self.outfile.write(TAB.join(name for name, dtype in schema) + NL)
+
+    def write(self, row):
+        """
+        :param row: The values of a row, in the order of the columns.
+        """
+        self.outfile.write(TAB.join(map(str, row)) + NL)
+
+    def close(self):
+        self.outfile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ColumnarTableWriter:
+    """
+    This class writes the rows of a table to a columnar table, in batches.
+    """
+
+    def __init__(self, path, schema, batch_rows=BATCH_ROWS):
+        """
+        The constructor for a ColumnarTableWriter object.
+        :param path: The path to write the columnar table to.
+        :param schema: A list of the (name, type) of each column.
+        :param batch_rows: The number of rows in each batch.
+        """
+        self.archive = zipfile.ZipFile(path, w, compression=zipfile.ZIP_DEFLATED, allowZip64=True)
+        self.schema = schema
+        self.batch_rows = batch_rows
+
+        self.rows = []
+        self.batches = 0
+        # The codes of the values of each dictionary encoded column, in the order they were first seen.
+        self.dictionaries = {name: {} for name, dtype in schema if dtype == DICTIONARY}
+
+    def write(self, row):
+        """
+        :param row: The values of a row, in the order of the columns.
+        """
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the rows that are held in memory as a batch.
+        """
+        if not self.rows:
+            return
+
+        for (name, dtype), values in zip(self.schema, zip(*self.rows)):
+            if dtype == DICTIONARY:
+                codes = self.dictionaries[name]
+                array = np.fromiter((codes.setdefault(value, len(codes)) for value in values), dtype=CODE_DTYPE,
+                                    count=len(values))
+            else:
+                array = np.asarray(values, dtype=dtype)
+            self.write_array(BATCH_KEY.format(BATCH=self.batches, COLUMN=name), array)
+
+        self.rows = []
+        self.batches += 1
+
+    def write_array(self, key, array):
+        """
+        Writes an array to the archive in the same way as numpy.savez_compressed().
+        :param key: The name of the array.
+        :param array: The array.
+        """
+        with self.archive.open(key + ARRAY_SUFFIX, w, force_zip64=True) as outfile:
+            np.lib.format.write_array(outfile, np.asanyarray(array), allow_pickle=False)
+
+    def close(self):
+        """
+        Writes the last batch, the dictionaries and the column names, and closes the archive.
+        """
+        self.flush()
+        for name, codes in self.dictionaries.items():
+            self.write_array(DICTIONARY_KEY.format(COLUMN=name), np.array(list(codes), dtype=str))
+        self.write_array(COLUMNS_KEY, np.array([name for name, dtype in self.schema], dtype=str))
+        self.write_array(BATCHES_KEY, np.array(self.batches))
+        self.archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def iter_batches(path):
+    """
+    Reads a columnar table one batch at a time. The dictionary encoded columns are decoded into arrays of strings.
+    :param path: The path to the columnar table.
+    :return: Yields a dictionary of the column names to the arrays of each batch.
+    """
+    with np.load(path, allow_pickle=False) as archive:
+        columns = archive[COLUMNS_KEY].tolist()
+        dictionaries = {name: archive[DICTIONARY_KEY.format(COLUMN=name)] for name in columns
+                        if DICTIONARY_KEY.format(COLUMN=name) in archive}
+
+        for batch in range(int(archive[BATCHES_KEY])):
+            arrays = {}
+            for name in columns:
+                array = archive[BATCH_KEY.format(BATCH=batch, COLUMN=name)]
+                arrays[name] = dictionaries[name][array] if name in dictionaries else array
+            yield arrays
+
+
+def read_columns(path):
+    """
+    Reads a whole columnar table. The dictionary encoded columns are decoded into arrays of strings.
+    :param path: The path to the columnar table.
+    :return: A dictionary of the column names to arrays of the values of the columns.
+    """
+    with np.load(path, allow_pickle=False) as archive:
+        columns = archive[COLUMNS_KEY].tolist()
+
+    batches = list(iter_batches(path))
+    if not batches:
+        return {name: np.array([]) for name in columns}
+    return {name: np.concatenate([arrays[name] for arrays in batches]) for name in columns}
+
+
+def iter_rows(path):
+    """
+    Reads the rows of a columnar table, with the values converted to Python types.
+    :param path: The path to the columnar table.
+    :return: Yields a tuple of the values of each row, in the order of the columns.
+    """
+    for arrays in iter_batches(path):
+        yield from zip(*(array.tolist() for array in arrays.values()))
@@ -25,3 +25,68 @@ class ExecutionNotRanNoOutput(Exception):
         super().__init__("The program {PROGRAM} has not yet been executed. No output path available.".format(
             PROGRAM=program
         ))
+
+
+class SampleSheetError(Exception):
+    """
+    This is a class used to handle sample sheets that cannot be read, such as sheets with missing columns, duplicate
+    sample names or paths to files that do not exist.
+    """
+    def __init__(self, sample_sheet, line_number, problem):
+        super().__init__("Line {LINE} of the sample sheet {SHEET} is invalid: {PROBLEM}".format(
+            LINE=line_number, SHEET=sample_sheet, PROBLEM=problem
+        ))
+
+
+class BatchFailedError(Exception):
+    """
+    This is a class used to report the samples of a batch that failed, once every other sample has finished.
+    """
+    def __init__(self, batch, failed_samples):
+        super().__init__("{COUNT} sample(s) of {BATCH} failed: {SAMPLES}".format(
+            COUNT=len(failed_samples), BATCH=batch, SAMPLES=', '.join(failed_samples)
+        ))
+
+
+class StepGraphError(Exception):
+    """
+    This is a class used to handle pipeline step graphs that cannot be executed, such as steps that require an input
+    that no other step produces, or steps that depend on each other in a cycle.
+    """
+    def __init__(self, pipeline, problem):
+        super().__init__("The steps of {PIPELINE} cannot be executed: {PROBLEM}".format(
+            PIPELINE=pipeline, PROBLEM=problem
+        ))
+
+
+class UnsortedReadCountsError(Exception):
+    """
+    This is a class used to handle read count files that are not sorted by coordinate, which cannot be merged as they
+    are read.
+    """
+    def __init__(self, path, problem):
+        super().__init__("The read count file {PATH} is not sorted by coordinate: {PROBLEM}".format(
+            PATH=path, PROBLEM=problem
+        ))
+
+
+class StarSharedGenomeError(Exception):
+    """
+    This is a class used to handle STAR alignments that cannot use a genome in shared memory, because of the arguments
+    they are configured with.
+    """
+    def __init__(self, genome_dir, problem):
+        super().__init__("The STAR genome {GENOME} cannot be shared: {PROBLEM}".format(
+            GENOME=genome_dir, PROBLEM=problem
+        ))
+
+
+class JvmWorkerError(Exception):
+    """
+    This is a class used to handle JVM workers that cannot be started for a jar, such as a jar without a main class or
+    a nailgun server that exits or never starts listening.
+    """
+    def __init__(self, jar, problem):
+        super().__init__("Cannot run {JAR} in a JVM worker: {PROBLEM}".format(
+            JAR=jar, PROBLEM=problem
+        ))
@@ -0,0 +1,142 @@
+"""
+AUTHOR: Matt Durrant
+
+This module contains a vectorized two-sided Fisher's exact test for many 2x2 contingency tables at once.
+
+scipy.stats.fisher_exact tests a single table per call, which is slow when it is called once for each of millions of
+SNPs. Here the tables are tested together with NumPy. The hypergeometric probabilities of every table in the support of
+an observed table are computed in log space with gammaln, and the p-value is the sum of the probabilities of the tables
+that are no more likely than the observed table, as in scipy. Tables that occur more than once, which is common at low
+coverage, are only tested once.
+"""
+
+import numpy as np
+from scipy.special import gammaln
+
+# Tables whose probability is within this relative tolerance of the observed table's are counted as being as extreme
+# as the observed table. This absorbs the rounding error of the log probabilities, so that tied tables are counted.
+RELATIVE_TOLERANCE = 1e-7
+
+# The largest number of support points that are held in memory at once.
+MAX_SUPPORT_BLOCK = 2 ** 22
+
+
+def fisher_exact(tables):
+    """
+    Performs a two-sided Fisher's exact test on each 2x2 contingency table, matching scipy.stats.fisher_exact.
+    :param tables: An array-like of shape (n, 2, 2) of non-negative integer counts.
+    :return: A tuple of two float arrays of length n, the sample odds ratios and the p-values.
+    """
+    tables = np.asarray(tables, dtype=np.int64).reshape(-1, 4)
+    if np.any(tables < 0):
+        raise ValueError('All values in the tables must be nonnegative.')
+
+    # Each distinct table is only tested once.
+    unique_tables, inverse = np.unique(tables, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+
+    oddsratios = odds_ratios(unique_tables)
+    pvals = np.ones(len(unique_tables))
+
+    # Tables with an empty row or column have a p-value of one and are not tested.
+    testable = np.flatnonzero(~empty_margin(unique_tables))
+    if len(testable):
+        pvals[testable] = two_sided_pvals(unique_tables[testable])
+
+    return oddsratios[inverse], pvals[inverse]
+
+
+def empty_margin(tables):
+    """
+    :param tables: An array of shape (n, 4) of the flattened tables.
+    :return: A boolean array that is True for the tables where both values of a row or column are zero.
+    """
+    a, b, c, d = tables.T
+    return (a + b == 0) | (c + d == 0) | (a + c == 0) | (b + d == 0)
+
+
+def odds_ratios(tables):
+    """
+    Calculates the sample odds ratio of each table, which is NaN if the table has an empty row or column and infinite if
+    either off-diagonal value is zero, as in scipy.
+    :param tables: An array of shape (n, 4) of the flattened tables.
+    :return: A float array of the odds ratios.
+    """
+    a, b, c, d = tables.T.astype(np.float64)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        oddsratios = a * d / (b * c)
+
+    oddsratios[(b == 0) | (c == 0)] = np.inf
+    oddsratios[empty_margin(tables)] = np.nan
+    return oddsratios
+
+
+def two_sided_pvals(tables):
+    """
+    Calculates the two-sided p-value of each table, none of which may have an empty row or column. The tables are
+    processed in blocks of similar support size, to bound the memory that is used.
+    :param tables: An array of shape (n, 4) of the flattened tables.
+    :return: A float array of the p-values.
+    """
+    a, b, c, d = tables.T
+    row1, row2, col1 = a + b, c + d, a + c
+
+    # The support is the range of values the top left cell can take with the margins fixed.
+    low = np.maximum(0, col1 - row2)
+    high = np.minimum(col1, row1)
+    widths = high - low + 1
+
+    pvals = np.empty(len(tables))
+    order = np.argsort(widths, kind='stable')
+
+    start = 0
+    while start < len(order):
+        # The block grows until the padded support matrix would be larger than the limit.
+        stop = start + 1
+        while stop < len(order) and widths[order[stop]] * (stop + 1 - start) <= MAX_SUPPORT_BLOCK:
+            stop += 1
+
+        block = order[start:stop]
+        pvals[block] = support_pvals(a[block], row1[block], row2[block], col1[block], low[block], high[block])
+        start = stop
+
+    return pvals
+
+
+def support_pvals(a, row1, row2, col1, low, high):
+    """
+    Calculates the two-sided p-values of a block of tables from the hypergeometric probabilities over their supports.
+    :param a: The top left value of each table.
+    :param row1: The sum of the first row of each table.
+    :param row2: The sum of the second row of each table.
+    :param col1: The sum of the first column of each table.
+    :param low: The lowest value in the support of each table.
+    :param high: The highest value in the support of each table.
+    :return: A float array of the p-values.
+    """
+    width = int((high - low).max()) + 1
+    x = low[:, None] + np.arange(width)[None, :]
+    in_support = x <= high[:, None]
+    x = np.minimum(x, high[:, None])
+
+    # The log probability of each table, up to a constant that is shared by every table in the same support.
+    log_pmf = (log_choose(row1[:, None], x) + log_choose(row2[:, None], col1[:, None] - x))
+    log_observed = log_choose(row1, a) + log_choose(row2, col1 - a)
+
+    # The probabilities are scaled by the most likely table and normalised by the total of the support, so the
+    # constant cancels out and small p-values keep their precision.
+    pmf = np.where(in_support, np.exp(log_pmf - log_pmf.max(axis=1, keepdims=True)), 0.0)
+    extreme = in_support & (log_pmf <= log_observed[:, None] + np.log1p(RELATIVE_TOLERANCE))
+
+    pvals = np.where(extreme, pmf, 0.0).sum(axis=1) / pmf.sum(axis=1)
+    return np.minimum(pvals, 1.0)
+
+
+def log_choose(n, k):
+    """
+    :param n: The number of items.
+    :param k: The number of items chosen.
+    :return: The natural log of the binomial coefficient n choose k.
+    """
+    return gammaln(n + 1) - gammaln(k + 1) - gammaln(n - k + 1)
@@ -0,0 +1,91 @@
+"""
+AUTHOR: Matt Durrant
+
+This module contains functions that split the genome into balanced lists of intervals, for running a step on each part
+of the genome at the same time.
+
+The intervals are derived from the sequence dictionary in the header of a BAM file. The contigs are laid end to end in
+header order and the genome is cut into shards of equal length, so a shard may end part way through a contig. Steps that
+look beyond the site they are at, such as HaplotypeCaller with its active regions, are instead only split between
+contigs, so that they call the same variants as a run over the whole genome. Each shard covers a consecutive run of the
+genome in header order, so that the outputs of the shards can simply be concatenated.
+"""
+
+import pysam
+
+# Intervals are written to files with this suffix, as GATK only reads interval lists that end with it.
+INTERVALS_SUFFIX = '.intervals'
+
+
+def read_contigs(bam):
+    """
+    :param bam: The path to a BAM file.
+    :return: A list of (contig, length) tuples in the order of the BAM header.
+    """
+    with pysam.AlignmentFile(bam, 'rb') as bamfile:
+        return list(zip(bamfile.references, bamfile.lengths))
+
+
+def format_interval(contig, start, end, length):
+    """
+    :param contig: The name of the contig.
+    :param start: The one-based start of the interval.
+    :param end: The one-based, inclusive end of the interval.
+    :param length: The length of the contig.
+    :return: The interval as a GATK interval string, just the contig name when it covers the whole contig.
+    """
+    if start == 1 and end == length:
+        return contig
+    return '{CONTIG}:{START}-{END}'.format(CONTIG=contig, START=start, END=end)
+
+
+def scatter_intervals(contigs, shard_count, split_contigs=True):
+    """
+    Splits a genome into at most shard_count shards of roughly equal length.
+    :param contigs: A list of (contig, length) tuples in genome order.
+    :param shard_count: The number of shards to split the genome into.
+    :param split_contigs: Whether a contig may be cut between two shards. If not, each contig is put in the shard that
+    its midpoint falls in, so the shards are only as balanced as the lengths of the contigs allow.
+    :return: A list of shards, each of which is a list of GATK interval strings in genome order.
+    """
+    total = sum(length for contig, length in contigs)
+    if not total or shard_count <= 1:
+        return [[contig for contig, length in contigs]] if contigs else []
+
+    shard_length = -(-total // shard_count)
+
+    if not split_contigs:
+        shards = [[] for i in range(shard_count)]
+        offset = 0
+        for contig, length in contigs:
+            shards[min((offset + length // 2) // shard_length, shard_count - 1)].append(contig)
+            offset += length
+        return [shard for shard in shards if shard]
+
+    # The offset is the position of the start of the contig in the genome, with the contigs laid end to end. Each
+    # contig is cut wherever it crosses the boundary between two shards.
+    shards = [[] for i in range(shard_count)]
+    offset = 0
+    for contig, length in contigs:
+        start = 1
+        while start <= length:
+            shard = (offset + start - 1) // shard_length
+            end = min(length, (shard + 1) * shard_length - offset)
+            shards[shard].append(format_interval(contig, start, end, length))
+            start = end + 1
+        offset += length
+
+    return [shard for shard in shards if shard]
+
+
+def write_intervals(intervals, path):
+    """
+    Writes a GATK interval list, one interval per line.
+    :param intervals: A list of GATK interval strings.
+    :param path: The output path, which should end with INTERVALS_SUFFIX.
+    :return: The output path.
+    """
+    with open(path, 'w') as outfile:
+        for interval in intervals:
+            outfile.write(interval + '\n')
+    return path
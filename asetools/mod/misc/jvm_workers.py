@@ -0,0 +1,287 @@
+"""
+AUTHOR: Matt Durrant
+
+This module contains the JvmWorkerPool class, which keeps long-lived java virtual machines that the picard and GATK
+steps run their tools in, instead of each step starting its own.
+
+Each worker is a nailgun server, started with the same java options as the step and with the jar of the tool on its
+classpath. A step is dispatched to a worker by replacing the java part of its command with the nailgun client and the
+main class of the jar, so that the client runs the tool in the worker and passes back its output and exit code. The
+start up and JIT warm up of the java virtual machine are then paid once per worker rather than once per step.
+
+A worker runs one step at a time, as the tools keep static state. A worker is stopped after a step fails, after it has
+run a number of steps, and when the pool is full and a worker for another jar or java options is needed.
+"""
+
+import atexit
+import os
+import re
+import socket
+import subprocess
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+from contextlib import contextmanager
+from mod.misc.exceptions import JvmWorkerError
+from mod.misc.log import *
+from mod.misc.string_constants import *
+
+# The address the workers listen on, which only accepts connections from this host.
+WORKER_HOST = '127.0.0.1'
+
+# The number of seconds a worker has to start listening, and the number of seconds between the checks.
+WORKER_START_SECONDS = 120
+WORKER_POLL_SECONDS = 0.2
+
+# The number of seconds a worker has to exit after SIGTERM, before it is killed.
+WORKER_STOP_SECONDS = 10
+
+JAR_FLAG = '-jar'
+MANIFEST_PATH = 'META-INF/MANIFEST.MF'
+MAIN_CLASS_PATTERN = re.compile(r'^Main-Class:\s*(\S+)', re.MULTILINE)
+
+
+def parse_java_execution_path(execution_path):
+    """
+    :param execution_path: The execution path of a step, such as 'java -Xmx50g -jar picard.jar MarkDuplicates'.
+    :return: A tuple of the java binary, the list of java options, the jar and the list of the words after the jar, or
+    None if the execution path does not run a jar with java.
+    """
+    words = execution_path.split() if execution_path else []
+    if JAR_FLAG not in words[1:-1] or not os.path.basename(words[0]).startswith('java'):
+        return None
+
+    jar_index = words.index(JAR_FLAG) + 1
+    return words[0], words[1:jar_index - 1], words[jar_index], words[jar_index + 1:]
+
+
+def jar_main_class(jar):
+    """
+    :param jar: The path to a jar file.
+    :return: The main class of the jar, from its manifest.
+    """
+    try:
+        with zipfile.ZipFile(jar) as jar_file:
+            manifest = jar_file.read(MANIFEST_PATH).decode(UTF8, errors='replace')
+    except (OSError, KeyError, zipfile.BadZipFile) as e:
+        raise JvmWorkerError(jar, "its manifest cannot be read ({ERROR})".format(ERROR=e))
+
+    # Long lines of a manifest are continued on the next line after a single space.
+    match = MAIN_CLASS_PATTERN.search(manifest.replace('\r\n', NL).replace(NL + SPACE, ''))
+    if not match:
+        raise JvmWorkerError(jar, "its manifest does not name a Main-Class")
+    return match.group(1)
+
+
+def free_port():
+    """
+    :return: A TCP port on WORKER_HOST that is not in use.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((WORKER_HOST, 0))
+        return sock.getsockname()[1]
+
+
+class JvmWorker:
+    """
+    A nailgun server running in its own java virtual machine.
+    """
+
+    def __init__(self, key, server_jar, server_class, client_path, logger=None):
+        """
+        The constructor for a JvmWorker object, which starts the server and waits for it to listen.
+        :param key: A tuple of the java binary, the java options and the jar of the worker.
+        :param server_jar: The nailgun server jar.
+        :param server_class: The main class of the nailgun server.
+        :param client_path: The execution path of the nailgun client.
+        :param logger: The logger object for outputting all of the relevant log information.
+        """
+        java, java_options, jar = key
+        self.key = key
+        self.main_class = jar_main_class(jar)
+        self.client_path = client_path
+        self.port = free_port()
+        self.runs = 0
+
+        # The paths of the steps are resolved against the working directory of the server.
+        command = [java] + list(java_options) + ['-cp', os.pathsep.join([server_jar, jar]), server_class,
+                                                 '{HOST}:{PORT}'.format(HOST=WORKER_HOST, PORT=self.port)]
+        Log.info_chk(logger, msg_starting_jvm_worker.format(JAR=jar, PORT=self.port, DELIM=NL,
+                                                                 COMMAND=SPACE.join(command)))
+        self.popen = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=os.getcwd())
+
+        try:
+            self.wait_until_listening()
+        except Exception:
+            self.stop()
+            raise
+
+    def wait_until_listening(self):
+        """
+        Blocks until the server accepts connections.
+        """
+        deadline = time.time() + WORKER_START_SECONDS
+        while True:
+            if self.popen.poll() is not None:
+                raise JvmWorkerError(self.key[2], "the worker exited with status {CODE} while starting".format(
+                    CODE=self.popen.returncode))
+            try:
+                with socket.create_connection((WORKER_HOST, self.port), timeout=WORKER_POLL_SECONDS):
+                    return
+            except OSError:
+                if time.time() > deadline:
+                    raise JvmWorkerError(self.key[2], "the worker did not start within {SECONDS} seconds".format(
+                        SECONDS=WORKER_START_SECONDS))
+                time.sleep(WORKER_POLL_SECONDS)
+
+    def client_command(self, tool_words):
+        """
+        :param tool_words: The words of the execution path after the jar, such as ['MarkDuplicates'].
+        :return: The words of the nailgun client command that runs the tool in the worker.
+        """
+        return self.client_path.split() + ['--nailgun-server', WORKER_HOST, '--nailgun-port', str(self.port),
+                                           self.main_class] + list(tool_words)
+
+    def alive(self):
+        """
+        :return: Whether the server is still running.
+        """
+        return self.popen.poll() is None
+
+    def stop(self):
+        """
+        Stops the server.
+        """
+        if self.alive():
+            self.popen.terminate()
+            try:
+                self.popen.wait(WORKER_STOP_SECONDS)
+            except subprocess.TimeoutExpired:
+                self.popen.kill()
+                self.popen.wait()
+
+
+class JvmWorkerPool:
+    """
+    A thread-safe pool of JvmWorkers, shared by all of the steps that run in this process.
+    """
+
+    def __init__(self, server_jar, server_class, client_path, max_workers, max_runs=None):
+        """
+        The constructor for a JvmWorkerPool object. The workers are started when they are first needed.
+        :param server_jar: The nailgun server jar.
+        :param server_class: The main class of the nailgun server.
+        :param client_path: The execution path of the nailgun client.
+        :param max_workers: The number of workers that are kept. More are started if more steps run at once.
+        :param max_runs: The number of steps a worker runs before it is replaced, or None.
+        """
+        self.server_jar = server_jar
+        self.server_class = server_class
+        self.client_path = client_path
+        self.max_workers = max_workers
+        self.max_runs = max_runs
+
+        # The idle workers, least recently used first, and the number of workers that are running steps.
+        self.idle = OrderedDict()
+        self.busy = 0
+        self.lock = threading.Lock()
+
+        atexit.register(self.close)
+
+    def checkout(self, key, logger=None):
+        """
+        Takes an idle worker for a jar and java options, or starts a new one.
+        :param key: A tuple of the java binary, the java options and the jar.
+        :param logger: The logger object for outputting all of the relevant log information.
+        :return: The JvmWorker, which must be passed back to checkin().
+        """
+        stopped = []
+        with self.lock:
+            worker = None
+            for idle_worker in list(self.idle):
+                if idle_worker.key == key:
+                    del self.idle[idle_worker]
+                    if idle_worker.alive():
+                        worker = idle_worker
+                        break
+                    stopped.append(idle_worker)
+
+            # The least recently used idle workers of other jars make room for the new worker.
+            if worker is None:
+                while self.idle and len(self.idle) + self.busy >= self.max_workers:
+                    stopped.append(self.idle.popitem(last=False)[0])
+            self.busy += 1
+
+        for idle_worker in stopped:
+            idle_worker.stop()
+
+        if worker is None:
+            try:
+                worker = JvmWorker(key, self.server_jar, self.server_class, self.client_path, logger=logger)
+            except Exception:
+                with self.lock:
+                    self.busy -= 1
+                raise
+        return worker
+
+    def checkin(self, worker, failed=False):
+        """
+        Returns a worker after it has run a step. The worker is stopped if the step failed, if it has run max_runs steps,
+        or if the pool holds more than max_workers workers.
+        :param worker: A JvmWorker returned by checkout().
+        :param failed: Whether the step failed, which may have left the worker in a bad state.
+        """
+        worker.runs += 1
+        with self.lock:
+            self.busy -= 1
+            retire = failed or not worker.alive() or (self.max_runs and worker.runs >= self.max_runs) or \
+                len(self.idle) + self.busy >= self.max_workers
+            if not retire:
+                self.idle[worker] = None
+
+        if retire:
+            worker.stop()
+
+    @contextmanager
+    def dispatch(self, execution_path, command, logger=None):
+        """
+        Runs a command in a worker, if it runs a jar with java.
+        :param execution_path: The execution path of the step.
+        :param command: The command of the step as a string, which starts with the execution path, or as a list of words.
+        :param logger: The logger object for outputting all of the relevant log information.
+        :return: A context manager that yields the command that runs the step in a worker, in the same form as command,
+        or the command itself if it cannot be dispatched.
+        """
+        parsed = parse_java_execution_path(execution_path)
+        words = command if isinstance(command, list) else None
+        prefix = execution_path.split() if execution_path else []
+        if parsed is None or (words is not None and words[:len(prefix)] != prefix) or \
+                (words is None and not command.startswith(execution_path)):
+            yield command
+            return
+
+        java, java_options, jar, tool_words = parsed
+        worker = self.checkout((java, tuple(java_options), jar), logger=logger)
+        client_command = worker.client_command(tool_words)
+        Log.info_chk(logger, msg_dispatching_to_jvm_worker.format(JAR=jar, PORT=worker.port))
+
+        failed = True
+        try:
+            if words is not None:
+                yield client_command + words[len(prefix):]
+            else:
+                yield SPACE.join(client_command) + command[len(execution_path):]
+            failed = False
+        finally:
+            self.checkin(worker, failed=failed)
+
+    def close(self):
+        """
+        Stops the idle workers.
+        """
+        with self.lock:
+            workers = list(self.idle)
+            self.idle.clear()
+        for worker in workers:
+            worker.stop()
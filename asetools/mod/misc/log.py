@@ -18,6 +18,18 @@ msg_executing_command = "Executing the command:{DELIM}{COMMAND}"
 msg_saving_run_info = "Saving run info to {PATH}"
 msg_check_version_signature = "stderr={STDERR}, ignore_error={IGNORE_E}, pass_version_to_parser={PVTP}"
 msg_execute_command_signature = "stderr={STDERR}, subprocess={SHELL}"
+msg_scheduling_step = "Scheduling {NAME}, waiting for {RESOURCES}..."
+msg_finished_step = "Finished {NAME} in {SECONDS:.1f} seconds"
+msg_failed_step = "{NAME} failed: {ERROR}"
+msg_starting_sample = "Starting sample {NAME} in {PATH}"
+msg_finished_sample = "Sample {NAME} {STATUS} after {SECONDS:.1f} seconds"
+msg_batch_summary = "Batch summary saved to {PATH}: {COMPLETED} completed, {FAILED} failed"
+msg_skipping_completed_step = "Skipping {NAME}, it already completed according to {PATH}"
+msg_step_cache_hit = "Linked the outputs of {NAME} from the step cache at {PATH}"
+msg_step_cache_store = "Stored the outputs of {NAME} in the step cache at {PATH}"
+msg_stopping_command = "Stopping {NAME}, it {REASON}..."
+msg_starting_jvm_worker = "Starting a JVM worker for {JAR} on port {PORT}:{DELIM}{COMMAND}"
+msg_dispatching_to_jvm_worker = "Running {JAR} in the JVM worker on port {PORT}"
 
 
 class Log:
@@ -0,0 +1,169 @@
+"""
+AUTHOR: Matt Durrant
+
+This module contains the StepManifest class, which keeps a durable record of a pipeline step that completed.
+
+A manifest is saved next to the json log of each step when it finishes. It holds the paths, sizes, modification times
+and md5 hashes of the step's input and output files, the command that was executed and the version of the tool.
+When a pipeline is rerun, any step whose manifest still matches its inputs and outputs does not need to run again.
+"""
+
+import hashlib
+import json
+import os
+
+# Files are hashed in blocks of this many bytes so that large BAM files are never read into memory at once.
+HASH_BLOCK_SIZE = 2 ** 20
+
+
+def file_md5(path):
+    """
+    :param path: The path to a file.
+    :return: The md5 hex digest of the contents of the file.
+    """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as infile:
+        for block in iter(lambda: infile.read(HASH_BLOCK_SIZE), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def expand_paths(paths):
+    """
+    Flattens a collection of paths into a sorted list of files. Directories are replaced by the files they contain.
+    :param paths: A path, or a list or tuple of paths. None values are ignored.
+    :return: A list of paths.
+    """
+    if paths is None:
+        return []
+    if isinstance(paths, str):
+        paths = [paths]
+
+    expanded = []
+    for path in paths:
+        if isinstance(path, (list, tuple)):
+            expanded.extend(expand_paths(path))
+        elif path is None:
+            continue
+        elif os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                expanded.extend(os.path.join(root, name) for name in sorted(files))
+        else:
+            expanded.append(path)
+
+    return expanded
+
+
+def describe_file(path):
+    """
+    Describes a file by its size, modification time and md5 hash. Paths that are not regular files, such as
+    /dev/stdin in a stream, are recorded without a size or hash.
+    :param path: The path to a file.
+    :return: A dictionary describing the file.
+    """
+    if not os.path.isfile(path):
+        return {'path': path, 'size': None, 'mtime': None, 'md5': None}
+
+    stat = os.stat(path)
+    return {'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime, 'md5': file_md5(path)}
+
+
+def file_matches(description):
+    """
+    Checks that a file still matches its description. The md5 hash is only recomputed when the modification time
+    has changed, so that unchanged files are not read again.
+    :param description: A description produced by describe_file().
+    :return: True if the file is unchanged.
+    """
+    path = description['path']
+    if description['size'] is None:
+        return not os.path.isfile(path)
+    if not os.path.isfile(path):
+        return False
+
+    stat = os.stat(path)
+    if stat.st_size != description['size']:
+        return False
+    if stat.st_mtime == description['mtime']:
+        return True
+    return file_md5(path) == description['md5']
+
+
+class StepManifest:
+    """
+    The completion manifest of a single step.
+    """
+
+    def __init__(self, path):
+        """
+        Constructor for a StepManifest object.
+        :param path: The path to the manifest json file.
+        """
+        self.path = path
+
+    def save(self, inputs, command, version, outputs):
+        """
+        Saves the manifest.
+        :param inputs: The input paths of the step.
+        :param command: The command that was executed by the step.
+        :param version: The version of the tool that was run.
+        :param outputs: The output paths of the step.
+        """
+        manifest = {
+
+            'inputs': [describe_file(path) for path in expand_paths(inputs)],
+            'command': command,
+            'version': version,
+            'outputs': [describe_file(path) for path in expand_paths(outputs)]
+
+        }
+
+        # Writes to a temporary file first so that an interrupted run never leaves a partial manifest behind.
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as outfile:
+            json.dump(manifest, outfile, indent=4)
+        os.replace(temp_path, self.path)
+
+    def load(self):
+        """
+        :return: The saved manifest, or None if there is no readable manifest.
+        """
+        try:
+            with open(self.path) as infile:
+                return json.load(infile)
+        except (OSError, ValueError):
+            return None
+
+    def matches(self, inputs, command, version):
+        """
+        Checks if the step has already been run with the same inputs, command and version, and that none of its
+        inputs or outputs have changed since.
+        :param inputs: The input paths of the step.
+        :param command: The command the step would execute.
+        :param version: The version of the tool the step would run.
+        :return: True if the step does not need to be run again.
+        """
+        manifest = self.load()
+        if not manifest:
+            return False
+
+        # Round trips the command through json so that tuples compare equal to the lists they are saved as.
+        command = json.loads(json.dumps(command))
+        if manifest['command'] != command or manifest['version'] != version:
+            return False
+
+        if [description['path'] for description in manifest['inputs']] != expand_paths(inputs):
+            return False
+
+        if not manifest['outputs']:
+            return False
+
+        return all(file_matches(description) for description in manifest['inputs'] + manifest['outputs'])
+
+    def output_paths(self):
+        """
+        :return: The output paths recorded in the manifest.
+        """
+        manifest = self.load()
+        return [description['path'] for description in manifest['outputs']] if manifest else []
@@ -7,9 +7,15 @@ I retrieved it from https://github.com/nfusi/qvalue, see Storey and Tibshirani,
 THIS CODE WAS NOT WRITTEN BY ME
 
 I changed all xrange() function calls to range() so it would work with python3
+
+I replaced the python loops with numpy so that it scales to tens of millions of p-values. The cumulative minimum over
+the sorted p-values is taken with np.minimum.accumulate, the pi0 counts are taken from the sorted p-values with
+np.searchsorted, and the lowmem version sorts once instead of calling argmax() for every p-value. Both versions now give
+the same q-values, and the lowmem version writes them over the p-values rather than into a new array. The scipy aliases
+of numpy functions (sp.arange etc.) were removed from scipy, so numpy is used.
 """
 
-import scipy as sp
+import numpy as np
 from scipy import interpolate
 
 
@@ -22,16 +28,23 @@ def estimate(pv, m=None, verbose=False, lowmem=False, pi0=None):
 
     m: number of tests. If not specified m = pv.size
     verbose: print verbose messages? (default False)
-    lowmem: use memory-efficient in-place algorithm
+    lowmem: write the q-values over pv, which must be a writable float array, instead of into a new array.
+            This saves one array of the size of pv; the sort order and the sorted q-values are still allocated.
     pi0: if None, it's estimated as suggested in Storey and Tibshirani, 2003.
          For most GWAS this is not necessary, since pi0 is extremely likely to be
          1
 
     """
+    if lowmem:
+        assert(np.issubdtype(pv.dtype, np.floating)), "lowmem needs a float array of p-values to write q-values over"
+    if pv.size == 0:
+        return pv if lowmem else np.zeros(pv.shape)
+
     assert(pv.min() >= 0 and pv.max() <= 1), "p-values should be between 0 and 1"
 
+    original = pv
     original_shape = pv.shape
-    pv = pv.ravel()  # flattens the array in place, more efficient than flatten()
+    pv = pv.ravel()  # a view of a contiguous array, but a copy of an array that is not contiguous
 
     if m is None:
         m = float(len(pv))
@@ -39,6 +52,10 @@ def estimate(pv, m=None, verbose=False, lowmem=False, pi0=None):
         # the user has supplied an m
         m *= 1.0
 
+    # the sorted p-values are turned into q-values in place
+    p_ordered = np.argsort(pv)
+    qv = pv[p_ordered].astype(np.float64, copy=False)
+
     # if the number of hypotheses is small, just set pi0 to 1
     if len(pv) < 100 and pi0 is None:
         pi0 = 1.0
@@ -46,13 +63,9 @@ def estimate(pv, m=None, verbose=False, lowmem=False, pi0=None):
         pi0 = pi0
     else:
         # evaluate pi0 for different lambdas
-        pi0 = []
-        lam = sp.arange(0, 0.90, 0.01)
-        counts = sp.array([(pv > i).sum() for i in sp.arange(0, 0.9, 0.01)])
-        for l in range(len(lam)):
-            pi0.append(counts[l]/(m*(1-lam[l])))
-
-        pi0 = sp.array(pi0)
+        lam = np.arange(0, 0.90, 0.01)
+        counts = len(qv) - np.searchsorted(qv, lam, side='right')
+        pi0 = counts / (m * (1 - lam))
 
         # fit natural cubic spline
         tck = interpolate.splrep(lam, pi0, k=3)
@@ -67,33 +80,25 @@ def estimate(pv, m=None, verbose=False, lowmem=False, pi0=None):
 
     assert(pi0 >= 0 and pi0 <= 1), "pi0 is not between 0 and 1: %f" % pi0
 
-    if lowmem:
-        # low memory version, only uses 1 pv and 1 qv matrices
-        qv = sp.zeros((len(pv),))
-        last_pv = pv.argmax()
-        qv[last_pv] = (pi0*pv[last_pv]*m)/float(m)
-        pv[last_pv] = -sp.inf
-        prev_qv = last_pv
-        for i in range(int(len(pv))-2, -1, -1):
-            cur_max = pv.argmax()
-            qv_i = (pi0*m*pv[cur_max]/float(i+1))
-            pv[cur_max] = -sp.inf
-            qv_i1 = prev_qv
-            qv[cur_max] = min(qv_i, qv_i1)
-            prev_qv = qv[cur_max]
-
-    else:
-        p_ordered = sp.argsort(pv)
-        pv = pv[p_ordered]
-        qv = pi0 * m/len(pv) * pv
+    # qv[i] = min(pi0 * m * pv[i] / (i + 1), qv[i + 1]), with the largest q-value capped at 1
+    qv *= pi0 * m
+    qv /= np.arange(1, len(qv) + 1)
+    if len(qv):
         qv[-1] = min(qv[-1], 1.0)
+    np.minimum.accumulate(qv[::-1], out=qv[::-1])
 
-        for i in range(len(pv)-2, -1, -1):
-            qv[i] = min(pi0*m*pv[i]/(i+1.0), qv[i+1])
-
-        # reorder qvalues
-        qv_temp = qv.copy()
-        qv = sp.zeros_like(qv)
+    # reorder qvalues
+    if lowmem:
+        # low memory version, the q-values are written over the p-values, through flat indices of the original
+        # array if ravel() had to copy it
+        if np.shares_memory(pv, original):
+            pv[p_ordered] = qv
+        else:
+            original.flat[p_ordered] = qv
+        return original
+    else:
+        qv_temp = qv
+        qv = np.zeros_like(qv)
         qv[p_ordered] = qv_temp
 
     # reshape qvalues
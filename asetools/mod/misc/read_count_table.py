@@ -0,0 +1,251 @@
+"""
+AUTHOR: Matt Durrant
+
+This module contains the ReadCountTable class, which holds the read counts of many variant sites in numpy arrays.
+
+The chromosomes, alleles and treatments are stored as integer codes into small arrays of their names, the positions as
+integers, and the read counts as a matrix of int32 counts with a named column for each count. The read count files of
+GATK ASEReadCounter are loaded in bulk by numpy, rather than one line at a time, and the read counts of replicates are
+summed by sorting the sites and adding up the counts of each run of identical sites with np.add.reduceat. A table can
+be given to FishersExactTest directly, without writing and reparsing a TSV file.
+"""
+
+import warnings
+import numpy as np
+
+# The columns of a GATK ASEReadCounter output file that are loaded, and the names of its counts.
+ASE_READ_COUNTER_COLUMNS = (0, 1, 3, 4, 5, 6, 7)
+ASE_READ_COUNTER_COUNTS = ['REF_COUNT', 'ALT_COUNT', 'TOTAL_COUNT']
+
+# The starting width of the chromosome and allele fields, which is doubled until no field is cut short.
+FIELD_WIDTH = 64
+
+CODE_DTYPE = np.int32
+COUNT_DTYPE = np.int32
+
+
+def encode(values):
+    """
+    Dictionary encodes an array of values.
+    :param values: An array of values.
+    :return: An array of the distinct values in the order they are first seen, and the code of each value.
+    """
+    distinct, first_index, codes = np.unique(values, return_index=True, return_inverse=True)
+    order = np.argsort(first_index, kind='stable')
+    rank = np.empty(len(order), dtype=CODE_DTYPE)
+    rank[order] = np.arange(len(order), dtype=CODE_DTYPE)
+    return distinct[order], rank[codes.reshape(-1)]
+
+
+def merge_names(name_arrays):
+    """
+    :param name_arrays: The arrays of names of several tables.
+    :return: An array of all of the names in the order they are first seen, and for each table an array that maps its
+    codes to codes into the merged array.
+    """
+    merged = list(dict.fromkeys(name for names in name_arrays for name in names.tolist()))
+    index = {name: code for code, name in enumerate(merged)}
+    mappings = [np.array([index[name] for name in names.tolist()], dtype=CODE_DTYPE) for names in name_arrays]
+    return np.array(merged, dtype=str), mappings
+
+
+def lexical_rank(names):
+    """
+    :param names: An array of names.
+    :return: The rank of each name when the names are sorted.
+    """
+    rank = np.empty(len(names), dtype=CODE_DTYPE)
+    rank[np.argsort(names, kind='stable')] = np.arange(len(names), dtype=CODE_DTYPE)
+    return rank
+
+
+def load_ase_read_counter(path, width=FIELD_WIDTH):
+    """
+    Loads the columns of a GATK ASEReadCounter output file that hold the sites and their counts.
+    :param path: The path to the read count file.
+    :param width: The width of the chromosome and allele fields.
+    :return: A structured array with the chromosome, position, alleles and counts of each site.
+    """
+    dtype = np.dtype([('chrom', 'S%d' % width), ('position', np.int64), ('ref', 'S%d' % width),
+                      ('alt', 'S%d' % width), ('ref_count', COUNT_DTYPE), ('alt_count', COUNT_DTYPE),
+                      ('total_count', COUNT_DTYPE)])
+
+    # A file with only a header has no sites, which numpy warns about.
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', UserWarning)
+        sites = np.loadtxt(path, dtype=dtype, usecols=ASE_READ_COUNTER_COLUMNS, skiprows=1, ndmin=1)
+
+    # Fields that fill the whole width may have been cut short, so they are loaded again with wider fields.
+    if len(sites) and max(np.char.str_len(sites[field]).max() for field in ('chrom', 'ref', 'alt')) >= width:
+        return load_ase_read_counter(path, width * 2)
+    return sites
+
+
+class ReadCountTable:
+    """
+    This class holds the read counts of variant sites in numpy arrays. Each row is a site of a treatment, with a
+    chromosome, position, reference allele and alternate allele, and a count in each of the count columns.
+    """
+
+    def __init__(self, treatments, treatment_codes, chroms, chrom_codes, positions, alleles, ref_codes, alt_codes,
+                 counts, count_columns, path=None):
+        """
+        The constructor for a ReadCountTable object.
+        :param treatments: An array of the names of the treatments.
+        :param treatment_codes: The treatment of each row, as an index into treatments.
+        :param chroms: An array of the names of the chromosomes.
+        :param chrom_codes: The chromosome of each row, as an index into chroms.
+        :param positions: The position of each row.
+        :param alleles: An array of the alleles.
+        :param ref_codes: The reference allele of each row, as an index into alleles.
+        :param alt_codes: The alternate allele of each row, as an index into alleles.
+        :param counts: A matrix of the counts of each row, with a column for each count.
+        :param count_columns: The names of the count columns.
+        :param path: The path to the file that the table was written to, if it was written to one.
+        """
+        self.treatments = treatments
+        self.treatment_codes = treatment_codes
+        self.chroms = chroms
+        self.chrom_codes = chrom_codes
+        self.positions = positions
+        self.alleles = alleles
+        self.ref_codes = ref_codes
+        self.alt_codes = alt_codes
+        self.counts = counts
+        self.count_columns = list(count_columns)
+        self.path = path
+
+    @classmethod
+    def read_ase_read_counter(cls, path, treatment=''):
+        """
+        Loads a read count file produced by GATK ASEReadCounter, or by PysamASEReadCounter.
+        :param path: The path to the read count file.
+        :param treatment: The name of the treatment of the sites.
+        :return: A ReadCountTable with the REF_COUNT, ALT_COUNT and TOTAL_COUNT columns.
+        """
+        sites = load_ase_read_counter(path)
+
+        chroms, chrom_codes = encode(sites['chrom'])
+        alleles, allele_codes = encode(np.concatenate([sites['ref'], sites['alt']]))
+        counts = np.column_stack([sites['ref_count'], sites['alt_count'], sites['total_count']])
+
+        return cls(np.array([treatment], dtype=str), np.zeros(len(sites), dtype=CODE_DTYPE),
+                   np.char.decode(chroms).astype(str), chrom_codes, sites['position'],
+                   np.char.decode(alleles).astype(str), allele_codes[:len(sites)], allele_codes[len(sites):],
+                   counts.astype(COUNT_DTYPE).reshape(len(sites), len(ASE_READ_COUNTER_COUNTS)),
+                   ASE_READ_COUNTER_COUNTS, path)
+
+    @classmethod
+    def concatenate(cls, tables):
+        """
+        :param tables: ReadCountTables with the same count columns.
+        :return: A ReadCountTable with the rows of all of the tables, in order.
+        """
+        treatments, treatment_maps = merge_names([table.treatments for table in tables])
+        chroms, chrom_maps = merge_names([table.chroms for table in tables])
+        alleles, allele_maps = merge_names([table.alleles for table in tables])
+
+        return cls(treatments,
+                   np.concatenate([mapping[table.treatment_codes] for mapping, table in zip(treatment_maps, tables)]),
+                   chroms,
+                   np.concatenate([mapping[table.chrom_codes] for mapping, table in zip(chrom_maps, tables)]),
+                   np.concatenate([table.positions for table in tables]),
+                   alleles,
+                   np.concatenate([mapping[table.ref_codes] for mapping, table in zip(allele_maps, tables)]),
+                   np.concatenate([mapping[table.alt_codes] for mapping, table in zip(allele_maps, tables)]),
+                   np.concatenate([table.counts for table in tables]),
+                   tables[0].count_columns)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def column(self, name):
+        """
+        :param name: The name of a count column.
+        :return: The counts of the column.
+        """
+        return self.counts[:, self.count_columns.index(name)]
+
+    def chrom_names(self):
+        """
+        :return: The set of the chromosomes that have rows in the table.
+        """
+        return set(self.chroms[np.unique(self.chrom_codes)].tolist())
+
+    def take(self, rows):
+        """
+        :param rows: A boolean mask or an array of indexes of the rows to keep.
+        :return: A ReadCountTable of the rows.
+        """
+        return ReadCountTable(self.treatments, self.treatment_codes[rows], self.chroms, self.chrom_codes[rows],
+                              self.positions[rows], self.alleles, self.ref_codes[rows], self.alt_codes[rows],
+                              self.counts[rows], self.count_columns, self.path)
+
+    def select_chroms(self, chroms):
+        """
+        :param chroms: The chromosomes to keep.
+        :return: A ReadCountTable of the rows on the chromosomes.
+        """
+        keep = np.array([chrom in chroms for chrom in self.chroms.tolist()], dtype=bool)
+        return self.take(keep[self.chrom_codes])
+
+    def with_count_columns(self, count_columns, prefix):
+        """
+        Moves the counts into a wider set of count columns, such as the case or control columns of a treatment.
+        :param count_columns: The new count columns. The columns that the table does not have are set to 0.
+        :param prefix: The prefix of the new name of each count column of the table.
+        :return: A ReadCountTable with the new count columns.
+        """
+        counts = np.zeros((len(self), len(count_columns)), dtype=COUNT_DTYPE)
+        for index, name in enumerate(self.count_columns):
+            counts[:, count_columns.index(prefix + name)] = self.counts[:, index]
+
+        return ReadCountTable(self.treatments, self.treatment_codes, self.chroms, self.chrom_codes, self.positions,
+                              self.alleles, self.ref_codes, self.alt_codes, counts, count_columns, self.path)
+
+    def aggregate(self, chrom_order=None):
+        """
+        Sums the counts of the rows of the same site of the same treatment. The rows are sorted by treatment,
+        chromosome, position, reference allele and alternate allele.
+        :param chrom_order: The order of the chromosomes. The rows of the chromosomes that are not in it are dropped.
+        By default, the treatments and chromosomes are in the order they were first seen in.
+        :return: A ReadCountTable with one row for each site of each treatment.
+        """
+        table = self
+        chrom_rank = np.arange(len(self.chroms), dtype=CODE_DTYPE)
+        if chrom_order is not None:
+            chrom_index = {chrom: rank for rank, chrom in enumerate(chrom_order)}
+            chrom_rank = np.array([chrom_index.get(chrom, -1) for chrom in self.chroms.tolist()], dtype=CODE_DTYPE)
+            table = self.take(chrom_rank[self.chrom_codes] >= 0)
+
+        allele_rank = lexical_rank(table.alleles)
+        order = np.lexsort((allele_rank[table.alt_codes], allele_rank[table.ref_codes], table.positions,
+                            chrom_rank[table.chrom_codes], table.treatment_codes))
+        table = table.take(order)
+        if not len(table):
+            return table
+
+        # Each run of rows with the same site starts where any part of the site changes.
+        keys = [table.treatment_codes, table.chrom_codes, table.positions, table.ref_codes, table.alt_codes]
+        changes = np.zeros(len(table) - 1, dtype=bool)
+        for key in keys:
+            changes |= key[1:] != key[:-1]
+        starts = np.concatenate([[0], np.flatnonzero(changes) + 1])
+
+        sums = np.add.reduceat(table.counts, starts, axis=0).astype(COUNT_DTYPE)
+        sites = table.take(starts)
+        sites.counts = sums
+        return sites
+
+    def rows(self, indexes=None):
+        """
+        :param indexes: The indexes of the rows. Defaults to every row.
+        :return: Yields each row as a list of the treatment, chromosome, position, reference allele, alternate allele
+        and each of the counts, as Python values.
+        """
+        table = self if indexes is None else self.take(indexes)
+        columns = [table.treatments[table.treatment_codes].tolist(), table.chroms[table.chrom_codes].tolist(),
+                   table.positions.tolist(), table.alleles[table.ref_codes].tolist(),
+                   table.alleles[table.alt_codes].tolist()] + table.counts.T.tolist()
+        for row in zip(*columns):
+            yield list(row)
@@ -21,3 +21,11 @@ FlagTwoArgs = recordclass('FlagTwoArgs', 'flag, arg1, arg2')
 
 def flagtwoargs_to_tuple(flagtwoargs):
     return flagtwoargs.flag, flagtwoargs.arg1, flagtwoargs.arg2
+
+
+# Record Class to specify a named and typed input or output of a pipeline step
+StepPort = recordclass('StepPort', 'name, type')
+
+# Record Class to store a sample of a batch and the outcome of running it
+Sample = recordclass('Sample', 'name, bam, vcf')
+SampleResult = recordclass('SampleResult', 'name, status, seconds, output_dir, error')
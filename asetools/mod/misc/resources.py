@@ -0,0 +1,190 @@
+"""
+AUTHOR: Matt Durrant
+
+This module contains the ResourcePool class, which keeps track of the cores, memory and scratch disk available to
+pipeline steps.
+
+Each step declares the resources it needs in its custom config, and acquires them from the pool before it runs and
+releases them when it finishes. This allows independent steps to run at the same time without oversubscribing the
+machine. Steps that do not fit are queued, and are admitted in the order they asked for their resources. A later step
+that fits may start ahead of an earlier one that does not, but only a limited number of times, so that a large step,
+such as STAR, is never starved by a stream of small ones.
+"""
+
+import os
+import shutil
+import threading
+
+# The names of the resources that are tracked by default.
+CORES = 'cores'
+MEMORY = 'memory'
+SCRATCH = 'scratch'
+JVM = 'jvm'
+
+# The number of later requests that may be admitted ahead of a queued request, before it blocks the queue.
+MAX_BYPASSES = 4
+
+# Multipliers for the suffixes that can be used in size strings, as in the java -Xmx argument.
+SIZE_UNITS = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+
+
+def parse_size(size):
+    """
+    Converts a size string such as '50g' or '512m' into a number of bytes.
+    :param size: A size string, a number of bytes or None.
+    :return: The size in bytes, 0 if size is None.
+    """
+    if size is None:
+        return 0
+    if isinstance(size, (int, float)):
+        return int(size)
+
+    size = str(size).strip().lower().rstrip('b')
+    if size and size[-1] in SIZE_UNITS:
+        return int(float(size[:-1]) * SIZE_UNITS[size[-1]])
+    return int(float(size))
+
+
+def total_memory():
+    """
+    :return: The physical memory of the machine in bytes, or None if it cannot be determined.
+    """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def free_disk_space(path):
+    """
+    :param path: A path, which does not need to exist yet.
+    :return: The free space in bytes of the filesystem that the path is, or will be, on.
+    """
+    path = os.path.abspath(path)
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return shutil.disk_usage(path).free
+
+
+def combine_requests(requests):
+    """
+    :param requests: Dictionaries of resource names and amounts, of steps that run at the same time.
+    :return: A dictionary of the sum of each resource.
+    """
+    combined = {}
+    for request in requests:
+        for name, amount in request.items():
+            combined[name] = combined.get(name, 0) + parse_size(amount)
+    return combined
+
+
+class ResourceTicket:
+    """
+    A request that is waiting in the queue of a ResourcePool.
+    """
+
+    def __init__(self, request):
+        """
+        Constructor for a ResourceTicket object.
+        :param request: A fitted request.
+        """
+        self.request = request
+        self.bypasses = 0
+        self.admitted = False
+
+
+class ResourcePool:
+    """
+    A thread-safe pool of resources. Steps block in acquire() until the resources they request are free.
+    """
+
+    def __init__(self, cores=None, memory=None, scratch=None, **capacities):
+        """
+        Constructor for a ResourcePool object.
+        :param cores: The number of cores in the pool. Defaults to the number of cores on the machine.
+        :param memory: The memory in the pool, as bytes or a size string. Defaults to the memory of the machine.
+        :param scratch: The scratch disk in the pool, as bytes or a size string. Scratch disk is not limited by default.
+        :param capacities: Any additional named resources and their capacities.
+        """
+        self.capacities = {CORES: cores or os.cpu_count() or 1,
+                           MEMORY: parse_size(memory) or total_memory(),
+                           SCRATCH: parse_size(scratch) or None}
+        self.capacities.update(capacities)
+
+        # Resources without a known capacity are not limited.
+        self.capacities = {name: capacity for name, capacity in self.capacities.items() if capacity is not None}
+        self.available = dict(self.capacities)
+
+        # The tickets of the requests that are waiting for their resources, in the order they were made.
+        self.queue = []
+        self.condition = threading.Condition()
+
+    def fit_request(self, request):
+        """
+        Restricts a request to the resources tracked by the pool. A request that is larger than the pool is reduced
+        to the full capacity of the pool, so that the step runs on its own instead of waiting forever.
+        :param request: A dictionary of resource names and amounts.
+        :return: The fitted request.
+        """
+        request = request or {}
+        return {name: min(parse_size(amount), self.capacities[name])
+                for name, amount in request.items() if name in self.capacities}
+
+    def acquire(self, request):
+        """
+        Queues a request and blocks until it is admitted, when its resources are taken from the pool.
+        :param request: A dictionary of resource names and amounts.
+        :return: The resources that were taken, which must be passed back to release().
+        """
+        ticket = ResourceTicket(self.fit_request(request))
+        with self.condition:
+            self.queue.append(ticket)
+            self.admit()
+            self.condition.wait_for(lambda: ticket.admitted)
+        return ticket.request
+
+    def release(self, request):
+        """
+        Returns resources taken by acquire() to the pool.
+        :param request: The resources returned by acquire().
+        """
+        with self.condition:
+            for name, amount in request.items():
+                self.available[name] += amount
+            self.admit()
+
+    def admit(self):
+        """
+        Admits the queued requests that fit, in order. A request that fits is admitted ahead of the earlier requests
+        that do not, unless one of them has already been passed over MAX_BYPASSES times. Must be called while holding
+        the condition.
+        """
+        waiting = []
+        for ticket in list(self.queue):
+            if not self.fits(ticket.request):
+                waiting.append(ticket)
+            elif any(earlier.bypasses >= MAX_BYPASSES for earlier in waiting):
+                break
+            else:
+                for earlier in waiting:
+                    earlier.bypasses += 1
+                for name, amount in ticket.request.items():
+                    self.available[name] -= amount
+                ticket.admitted = True
+                self.queue.remove(ticket)
+
+        self.condition.notify_all()
+
+    def queued(self):
+        """
+        :return: The number of requests that are waiting for their resources.
+        """
+        with self.condition:
+            return len(self.queue)
+
+    def fits(self, request):
+        """
+        :param request: A fitted request.
+        :return: Whether the request can be taken from the pool right now.
+        """
+        return all(self.available[name] >= amount for name, amount in request.items())
@@ -0,0 +1,224 @@
+"""
+AUTHOR: Matt Durrant
+
+This module contains the StepNode and StepScheduler classes, which execute the steps of a pipeline as a dependency
+graph.
+
+Each pipeline declares its steps as StepNode objects with named and typed inputs and outputs. The StepScheduler starts
+every step as soon as all of its inputs have been produced, so that steps that do not depend on each other run at the
+same time. Steps only run once the cores, memory and scratch disk they declare are available in the ResourcePool, and
+wait in its queue until then. When resuming, steps whose completion manifest shows that they already ran are skipped.
+When a StepCache is given, steps that were already run on the same inputs by any pipeline have their outputs linked from
+the cache.
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from mod.misc.exceptions import StepGraphError
+from mod.misc.log import *
+
+
+class StepNode:
+    """
+    A single step in a pipeline graph.
+    """
+
+    def __init__(self, name, step_class, step_kwargs=None, inputs=None, outputs=None, resources=None):
+        """
+        Constructor for a StepNode object.
+        :param name: The unique name of the step within the pipeline.
+        :param step_class: The RunSubprocessStepSuper or RunProcessStepSuper subclass to run. This can be any callable
+        that returns an object with run() and retrieve_output_path() methods.
+        :param step_kwargs: The fixed keyword arguments passed to step_class, such as output_dir and logger.
+        :param inputs: A dictionary of step_class keyword arguments to the StepPort that provides their value.
+        :param outputs: A list of StepPorts, one for each value returned by the step's retrieve_output_path().
+        :param resources: The resources the step needs while it runs, such as {'cores': 6, 'memory': '50g'}. These
+        override the resources that the step declares itself.
+        """
+        self.name = name
+        self.step_class = step_class
+        self.step_kwargs = step_kwargs if step_kwargs else {}
+
+        self.inputs = inputs if inputs else {}
+        self.outputs = outputs if outputs else []
+
+        self.resources = resources if resources else {}
+
+    def build_step(self, values):
+        """
+        Creates the step object once all of the node's inputs are available.
+        :param values: A dictionary of all of the values produced so far, keyed by port name.
+        :return: The step object, ready to run.
+        """
+        kwargs = dict(self.step_kwargs)
+        kwargs.update({kwarg: values[port.name] for kwarg, port in self.inputs.items()})
+        return self.step_class(**kwargs)
+
+    def collect_outputs(self, step):
+        """
+        Matches the output paths of the step that was run to the node's output ports.
+        :param step: The step object that was run.
+        :return: A dictionary of output port names to values.
+        """
+        if not self.outputs:
+            return {}
+
+        output = step.retrieve_output_path()
+        if len(self.outputs) == 1:
+            return {self.outputs[0].name: output}
+        return {port.name: value for port, value in zip(self.outputs, output)}
+
+    def is_ready(self, values):
+        """
+        :param values: A dictionary of all of the values produced so far, keyed by port name.
+        :return: Whether all of the node's inputs are available.
+        """
+        return all(port.name in values for port in self.inputs.values())
+
+
+class StepScheduler:
+    """
+    Executes a graph of StepNodes, running independent steps in parallel within the limits of a ResourcePool.
+    """
+
+    def __init__(self, name, nodes, resource_pool, logger=None, resume=False, step_cache=None):
+        """
+        Constructor for a StepScheduler object.
+        :param name: The name of the pipeline, used in error messages.
+        :param nodes: A list of StepNodes. The order of the list is the order ready steps are started in.
+        :param resource_pool: The ResourcePool that the steps take their resources from.
+        :param logger: The logger to track progress.
+        :param resume: Whether to skip steps that completed in a previous run.
+        :param step_cache: The StepCache to share step outputs through, or None to always run the steps.
+        """
+        self.name = name
+        self.nodes = nodes
+        self.resource_pool = resource_pool
+        self.logger = logger
+        self.resume = resume
+        self.step_cache = step_cache
+
+    def validate(self, inputs):
+        """
+        Ensures that the graph can be executed: names are unique, every input is produced by exactly one step or by
+        the pipeline with a matching type, and there are no cycles.
+        :param inputs: The pipeline inputs, a list of (StepPort, value) tuples.
+        """
+        names = [node.name for node in self.nodes]
+        if len(names) != len(set(names)):
+            raise StepGraphError(self.name, "step names are not unique")
+
+        port_types = {}
+        producers = {}
+        for port, value in inputs:
+            port_types[port.name] = port.type
+        for node in self.nodes:
+            for port in node.outputs:
+                if port.name in port_types:
+                    raise StepGraphError(self.name, "{PORT} is produced more than once".format(PORT=port.name))
+                port_types[port.name] = port.type
+                producers[port.name] = node.name
+
+        for node in self.nodes:
+            for port in node.inputs.values():
+                if port.name not in port_types:
+                    raise StepGraphError(self.name, "no step produces {PORT}, needed by {NODE}".format(
+                        PORT=port.name, NODE=node.name))
+                if port_types[port.name] != port.type:
+                    raise StepGraphError(self.name, "{NODE} expects {PORT} to be {EXPECTED}, not {OBSERVED}".format(
+                        NODE=node.name, PORT=port.name, EXPECTED=port.type, OBSERVED=port_types[port.name]))
+
+        # Kahn's algorithm, all nodes must be reachable in topological order.
+        dependencies = {node.name: {producers[port.name] for port in node.inputs.values() if port.name in producers}
+                        for node in self.nodes}
+        resolved = set()
+        while len(resolved) < len(self.nodes):
+            ready = [name for name, deps in dependencies.items() if name not in resolved and deps <= resolved]
+            if not ready:
+                raise StepGraphError(self.name, "the steps {NODES} depend on each other in a cycle".format(
+                    NODES=', '.join(sorted(set(dependencies) - resolved))))
+            resolved.update(ready)
+
+    def run(self, inputs):
+        """
+        Runs every step in the graph. Each step is started as soon as its inputs are available. If a step fails, no
+        new steps are started, the steps that are already running are allowed to finish, and the error is raised.
+        :param inputs: The pipeline inputs, a list of (StepPort, value) tuples.
+        :return: A dictionary of every value produced by the pipeline, keyed by port name.
+        """
+        self.validate(inputs)
+
+        values = {port.name: value for port, value in inputs}
+        remaining = list(self.nodes)
+        running = {}
+        error = None
+
+        with ThreadPoolExecutor(max_workers=max(len(self.nodes), 1)) as executor:
+            while remaining or running:
+
+                for node in [node for node in remaining if node.is_ready(values)]:
+                    remaining.remove(node)
+                    running[executor.submit(self.execute_node, node, dict(values))] = node
+
+                if not running:
+                    raise StepGraphError(self.name, "the inputs of {NODES} were never produced".format(
+                        NODES=', '.join(node.name for node in remaining)))
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node = running.pop(future)
+                    try:
+                        values.update(future.result())
+                    except Exception as e:
+                        Log.error_chk(self.logger, msg_failed_step.format(NAME=node.name, ERROR=e))
+                        error = error if error else e
+                        remaining = []
+
+        if error:
+            raise error
+
+        return values
+
+    def execute_node(self, node, values):
+        """
+        Builds and runs the step of a single node, holding its resources while it runs.
+        :param node: The StepNode to execute.
+        :param values: The values produced so far, which include all of the node's inputs.
+        :return: A dictionary of output port names to values.
+        """
+        step = node.build_step(values)
+
+        if self.resume and step.completed_previously():
+            return node.collect_outputs(step)
+
+        resources = self.get_resources(node, step)
+        Log.info_chk(self.logger, msg_scheduling_step.format(NAME=node.name, RESOURCES=resources))
+        request = self.resource_pool.acquire(resources)
+        start = time.time()
+        try:
+            self.run_step(step)
+        finally:
+            self.resource_pool.release(request)
+        Log.info_chk(self.logger, msg_finished_step.format(NAME=node.name, SECONDS=time.time() - start))
+
+        return node.collect_outputs(step)
+
+    def get_resources(self, node, step):
+        """
+        :param node: The StepNode of the step.
+        :param step: The step object to run.
+        :return: The resources the step declares, updated with the resources of its node.
+        """
+        resources = step.get_resources() if hasattr(step, 'get_resources') else {}
+        resources.update(node.resources)
+        return resources
+
+    def run_step(self, step):
+        """
+        Runs a single step. This can be overridden to change how steps are executed.
+        :param step: The step object to run.
+        """
+        if self.step_cache:
+            step.run_cached(self.step_cache)
+        else:
+            step.run()
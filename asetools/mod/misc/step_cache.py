@@ -0,0 +1,246 @@
+"""
+AUTHOR: Matt Durrant
+
+This module contains the StepCache class, a content-addressed cache of pipeline step outputs.
+
+Each cache entry is keyed on a hash of the step name, the tool version, the arguments from the custom config and the
+md5 hashes of the step's input files. The outputs of a step are stored in the cache once, and are hard-linked into
+the output directory of every later pipeline that runs the same step on the same inputs. The outputs are copied when
+the cache is on a different filesystem, so that evicting an entry never leaves a pipeline with dangling outputs. The
+cache is kept below a maximum size by evicting the entries that were least recently used.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from mod.misc.manifest import expand_paths, file_md5
+from mod.misc.resources import parse_size
+
+# The names of the files and directories inside of a cache entry.
+ENTRY_FILES_DIR = 'files'
+ENTRY_JSON = 'entry.json'
+LOCK_FILE = '.lock'
+
+
+def link_file(source, destination):
+    """
+    Hard links a file out of the cache, falling back to a copy when the two paths are on different filesystems. A
+    symbolic link is never used, since the entry it points to may be evicted.
+    :param source: The path to the existing file.
+    :param destination: The path to the link. Any existing file at this path is replaced.
+    """
+    if os.path.lexists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+def store_file(source, destination):
+    """
+    Hard links a file into the cache, falling back to a copy. A symbolic link is never used, since the cache must
+    own its data when the original output directory is deleted.
+    :param source: The path to the existing file.
+    :param destination: The path in the cache.
+    """
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+class StepCache:
+    """
+    A content-addressed cache of step outputs that can be shared across samples and pipeline runs.
+    """
+
+    def __init__(self, cache_dir, max_size=None, logger=None):
+        """
+        Constructor for a StepCache object.
+        :param cache_dir: The directory that holds the cache entries.
+        :param max_size: The maximum size of the cache, as bytes or a size string such as '500g'. None is unlimited.
+        :param logger: The logger to track progress.
+        """
+        self.cache_dir = cache_dir
+        self.max_size = parse_size(max_size) if max_size else None
+        self.logger = logger
+
+        # The md5 hashes of input files keyed by path, size and modification time, so that an input shared by many
+        # steps is only hashed once.
+        self.digests = {}
+        self.digests_lock = threading.Lock()
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @contextmanager
+    def locked(self):
+        """
+        Holds an exclusive lock on the cache, so that entries are never evicted by one pipeline while they are
+        linked by another.
+        """
+        with open(os.path.join(self.cache_dir, LOCK_FILE), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def digest(self, path):
+        """
+        :param path: The path to a file.
+        :return: The md5 hash of the file, reused while the file is unchanged.
+        """
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+        with self.digests_lock:
+            if key in self.digests:
+                return self.digests[key]
+
+        md5 = file_md5(path)
+        with self.digests_lock:
+            self.digests[key] = md5
+        return md5
+
+    def get_key(self, step):
+        """
+        Hashes everything that determines the outputs of a step. Input files are identified by their name and
+        contents, not by their full path, so that the same input in different directories shares an entry.
+        :param step: A RunSubprocessStepSuper or RunProcessStepSuper object.
+        :return: The cache key of the step, or None if the step cannot be cached.
+        """
+        signature = step.get_cache_signature()
+        if signature is None:
+            return None
+
+        inputs = []
+        for input_path in expand_paths(step.get_input_paths()):
+            if not os.path.isfile(input_path):
+                return None
+            inputs.append([os.path.basename(input_path), self.digest(input_path)])
+
+        key = json.dumps({'signature': signature, 'inputs': inputs}, sort_keys=True, default=str)
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def get_entry_dir(self, key):
+        """
+        :param key: A cache key.
+        :return: The directory of the cache entry.
+        """
+        return os.path.join(self.cache_dir, key)
+
+    def get_output_files(self, step):
+        """
+        :param step: A step that has been run.
+        :return: The paths of the step's output files relative to its output directory, or None if any output is
+        outside of the output directory and the step cannot be cached.
+        """
+        skip = {os.path.abspath(step.get_log_path()), os.path.abspath(step.get_manifest_path())}
+        output_dir = os.path.abspath(step.output_dir)
+
+        output_files = []
+        for output_path in expand_paths(step.get_output_paths()):
+            output_path = os.path.abspath(output_path)
+            if output_path in skip:
+                continue
+            if not output_path.startswith(output_dir + os.sep) or not os.path.isfile(output_path):
+                return None
+            output_files.append(os.path.relpath(output_path, output_dir))
+
+        return output_files
+
+    def fetch(self, step):
+        """
+        Links the cached outputs of a step into its output directory.
+        :param step: A step that has not been run.
+        :return: True if the outputs were found in the cache.
+        """
+        key = self.get_key(step)
+        if key is None:
+            return False
+
+        entry_dir = self.get_entry_dir(key)
+        with self.locked():
+            try:
+                with open(os.path.join(entry_dir, ENTRY_JSON)) as infile:
+                    entry = json.load(infile)
+            except (OSError, ValueError):
+                return False
+
+            for output_file in entry['files']:
+                destination = os.path.join(step.output_dir, output_file)
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                link_file(os.path.join(entry_dir, ENTRY_FILES_DIR, output_file), destination)
+
+            # The modification time of the entry json marks when the entry was last used.
+            os.utime(os.path.join(entry_dir, ENTRY_JSON))
+
+        return True
+
+    def store(self, step):
+        """
+        Stores the outputs of a step that has been run, then evicts old entries if the cache is too large.
+        :param step: A step that has been run.
+        :return: True if the outputs were stored.
+        """
+        key = self.get_key(step)
+        output_files = self.get_output_files(step)
+        if key is None or not output_files:
+            return False
+
+        # The entry is assembled in a temporary directory and renamed into place, so a partial entry is never used.
+        temp_dir = tempfile.mkdtemp(prefix='.tmp.', dir=self.cache_dir)
+        size = 0
+        for output_file in output_files:
+            destination = os.path.join(temp_dir, ENTRY_FILES_DIR, output_file)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            store_file(os.path.join(step.output_dir, output_file), destination)
+            size += os.path.getsize(destination)
+
+        with open(os.path.join(temp_dir, ENTRY_JSON), 'w') as outfile:
+            json.dump({'name': step.name, 'files': output_files, 'size': size, 'created': time.time()}, outfile,
+                      indent=4)
+
+        with self.locked():
+            entry_dir = self.get_entry_dir(key)
+            if os.path.isdir(entry_dir):
+                shutil.rmtree(temp_dir)
+            else:
+                os.rename(temp_dir, entry_dir)
+            self.evict(keep=key)
+
+        return True
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used entries until the cache is no larger than its maximum size. This must be
+        called while holding the cache lock.
+        :param keep: A key that is never evicted, such as the entry that was just stored.
+        """
+        if self.max_size is None:
+            return
+
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry_json = os.path.join(self.get_entry_dir(key), ENTRY_JSON)
+            try:
+                with open(entry_json) as infile:
+                    size = json.load(infile)['size']
+                entries.append((os.path.getmtime(entry_json), key, size))
+            except (OSError, ValueError, KeyError):
+                continue
+
+        total = sum(size for last_used, key, size in entries)
+        for last_used, key, size in sorted(entries):
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self.get_entry_dir(key), ignore_errors=True)
+            total -= size
@@ -44,6 +44,12 @@ chrY = 'chrY'
 fasta_str = 'fasta'
 vcf_str = 'vcf'
 tsv_str = 'tsv'
+sam_str = 'sam'
+bam_str = 'bam'
+fastq_str = 'fastq'
+dir_str = 'dir'
+table_str = 'table'
+npz_str = 'npz'
 
 r = 'r'
 w = 'w'
\ No newline at end of file
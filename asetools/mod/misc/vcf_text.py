@@ -0,0 +1,249 @@
+"""
+AUTHOR: Matt Durrant
+
+This module contains functions that read and write VCF files as raw lines of text, without PyVCF.
+
+PyVCF builds a record object, and a call object for every sample, for each line of a VCF file, which is very slow for
+VCF files with many samples. The functions here split only the columns that are needed out of each line, and the lines
+that are kept can be written back out unchanged. Plain and gzipped VCF files can be read, and VCF files can be written
+with bgzip compression and indexed with tabix.
+"""
+
+import gzip
+import os
+import re
+import pysam
+
+# The indexes of the columns of a VCF record.
+CHROM_COL, POS_COL, ID_COL, REF_COL, ALT_COL, QUAL_COL, FILTER_COL, INFO_COL, FORMAT_COL, SAMPLES_COL = range(10)
+
+HEADER_PREFIX = b'#'
+TAB_BYTES = b'\t'
+COMMA_BYTES = b','
+COLON_BYTES = b':'
+SEMI_BYTES = b';'
+MISSING_BYTES = b'.'
+GT_KEY = b'GT'
+
+# The genotype types, as in PyVCF. Uncalled genotypes have the type None.
+HOM_REF = 0
+HET = 1
+HOM_ALT = 2
+
+# The same delimiter between the alleles of a genotype as PyVCF.
+ALLELE_DELIMITER = re.compile(rb'[|/]')
+
+# The suffixes of gzipped VCF files and their tabix indexes.
+GZ_SUFFIX = '.gz'
+TABIX_SUFFIX = '.tbi'
+CSI_SUFFIX = '.csi'
+
+# The empty block that marks the end of a BGZF file.
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+# The contig lines of a VCF header.
+CONTIG_PATTERN = re.compile(rb'^##contig=<ID=([^,>]+)')
+
+# The size of the chunks that parts of a file are copied in.
+COPY_BUFFER_SIZE = 2 ** 20
+
+# Tabix returns strings, which are encoded as latin-1 so that every byte of the record is kept.
+RECORD_ENCODING = 'latin-1'
+
+# Genotype types by genotype string, as there are only a handful of distinct genotype strings in a VCF file.
+_gt_types = {}
+
+
+def open_vcf(path):
+    """
+    :param path: The path to a plain or gzipped (including bgzipped) VCF file.
+    :return: A binary file object to read the lines of the VCF file from.
+    """
+    if path.endswith(GZ_SUFFIX):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def open_vcf_output(path, bgzip=False):
+    """
+    :param path: The path to write a VCF file to.
+    :param bgzip: Whether to compress the VCF file with bgzip, so that it can be indexed with tabix.
+    :return: A binary file object to write the lines of the VCF file to.
+    """
+    if bgzip:
+        return pysam.BGZFile(path, 'wb')
+    return open(path, 'wb')
+
+
+def index_vcf(path):
+    """
+    Indexes a bgzipped VCF file with tabix.
+    :param path: The path to the bgzipped VCF file.
+    :return: The path to the tabix index.
+    """
+    pysam.tabix_index(path, preset='vcf', force=True)
+    return path + TABIX_SUFFIX
+
+
+def is_indexed(path):
+    """
+    :param path: The path to a VCF file.
+    :return: True if the VCF file is gzipped and has a tabix or CSI index, so that regions can be read from it.
+    """
+    return path.endswith(GZ_SUFFIX) and (os.path.exists(path + TABIX_SUFFIX) or os.path.exists(path + CSI_SUFFIX))
+
+
+def read_header(path):
+    """
+    :param path: The path to a plain or gzipped VCF file.
+    :return: The lines of the header of the VCF file, as bytes strings.
+    """
+    header = []
+    with open_vcf(path) as infile:
+        for line in infile:
+            if not line.startswith(HEADER_PREFIX):
+                break
+            header.append(line)
+    return header
+
+
+def indexed_contigs(path, header):
+    """
+    :param path: The path to an indexed VCF file.
+    :param header: The lines of the header of the VCF file.
+    :return: The contigs that have records in the index, in the order of the contig lines of the header. Contigs that
+    are not in the header follow in the order of the index.
+    """
+    with pysam.TabixFile(path) as tabix_file:
+        contigs = list(tabix_file.contigs)
+
+    header_order = [match.group(1).decode() for match in map(CONTIG_PATTERN.match, header) if match]
+    return [contig for contig in header_order if contig in contigs] + \
+           [contig for contig in contigs if contig not in header_order]
+
+
+def open_tabix(path):
+    """
+    :param path: The path to an indexed VCF file.
+    :return: A pysam.TabixFile that decodes records as RECORD_ENCODING, for fetch_records().
+    """
+    return pysam.TabixFile(path, encoding=RECORD_ENCODING)
+
+
+def fetch_records(tabix_file, contig):
+    """
+    :param tabix_file: A pysam.TabixFile of a VCF file, as opened by open_tabix().
+    :param contig: The contig to read the records of.
+    :return: Yields each record of the contig as a bytes string, with its newline.
+    """
+    for record in tabix_file.fetch(contig):
+        yield record.encode(RECORD_ENCODING) + b'\n'
+
+
+def concatenate_parts(part_paths, output_path, bgzip=False):
+    """
+    Concatenates files that were written with open_vcf_output() into one file, removing the parts afterwards.
+    :param part_paths: The paths of the parts, in order.
+    :param output_path: The path to write the concatenated file to.
+    :param bgzip: Whether the parts were compressed with bgzip. The end of file block is only kept for the last part.
+    """
+    with open(output_path, 'wb') as outfile:
+        for i, part_path in enumerate(part_paths):
+            remaining = os.path.getsize(part_path)
+            with open(part_path, 'rb') as part:
+                if bgzip and i < len(part_paths) - 1 and remaining >= len(BGZF_EOF):
+                    part.seek(remaining - len(BGZF_EOF))
+                    if part.read() == BGZF_EOF:
+                        remaining -= len(BGZF_EOF)
+                    part.seek(0)
+
+                while remaining > 0:
+                    chunk = part.read(min(COPY_BUFFER_SIZE, remaining))
+                    if not chunk:
+                        break
+                    outfile.write(chunk)
+                    remaining -= len(chunk)
+            os.remove(part_path)
+
+
+def split_record(line, columns=SAMPLES_COL):
+    """
+    Splits the columns out of a VCF record. The sample columns are left joined together in the last column.
+    :param line: A VCF record as a bytes string.
+    :param columns: The number of columns to split out of the record, the rest are left in the last column.
+    :return: A list of the columns as bytes strings.
+    """
+    return line.rstrip(b'\r\n').split(TAB_BYTES, columns)
+
+
+def info_has_key(info, key):
+    """
+    :param info: The INFO column of a VCF record.
+    :param key: The INFO key to look for, as a bytes string.
+    :return: True if the INFO column contains the key, with or without a value.
+    """
+    return any(entry.split(b'=', 1)[0] == key for entry in info.split(SEMI_BYTES))
+
+
+def is_indel(ref, alts, info):
+    """
+    Determines whether a record is an indel in the same way as PyVCF.
+    :param ref: The REF column of the record.
+    :param alts: The alternate alleles in the ALT column of the record.
+    :param info: The INFO column of the record, which is only checked for an SVTYPE if it is needed.
+    :return: True if the record is an indel.
+    """
+    if len(ref) > 1 and not info_has_key(info, b'SVTYPE'):
+        return True
+
+    for alt in alts:
+        # Missing, breakend and structural variant alleles are not indels
+        if alt == MISSING_BYTES or b'[' in alt or b']' in alt or alt.startswith(b'<') and alt.endswith(b'>') or \
+                len(alt) > 1 and (alt.startswith(MISSING_BYTES) or alt.endswith(MISSING_BYTES)):
+            return False
+        elif len(alt) != len(ref):
+            return not info_has_key(info, b'SVTYPE')
+
+    return False
+
+
+def gt_type(gt):
+    """
+    Determines the type of a genotype in the same way as PyVCF.
+    :param gt: The genotype string, such as b'0/1', or None if the sample has no genotype.
+    :return: HOM_REF, HET or HOM_ALT, or None if the genotype was not called.
+    """
+    if gt is None:
+        return None
+
+    try:
+        return _gt_types[gt]
+    except KeyError:
+        alleles = [allele if allele != MISSING_BYTES else None for allele in ALLELE_DELIMITER.split(gt)]
+        if not any(allele is not None for allele in alleles):
+            called_type = None
+        elif all(allele == alleles[0] for allele in alleles[1:]):
+            called_type = HOM_REF if alleles[0] == b'0' else HOM_ALT
+        else:
+            called_type = HET
+        _gt_types[gt] = called_type
+        return called_type
+
+
+def iter_gt_types(columns):
+    """
+    Decodes the genotype of each sample of a VCF record, one sample at a time, so that the caller can stop early.
+    :param columns: The columns of the record, as returned by split_record().
+    :return: Yields the genotype type of each sample, as returned by gt_type().
+    """
+    if len(columns) <= SAMPLES_COL:
+        return
+
+    keys = columns[FORMAT_COL].split(COLON_BYTES)
+    if GT_KEY not in keys:
+        return
+    gt_index = keys.index(GT_KEY)
+
+    for sample in columns[SAMPLES_COL].split(TAB_BYTES):
+        values = sample.split(COLON_BYTES, gt_index + 1)
+        yield gt_type(values[gt_index] if gt_index < len(values) else None)
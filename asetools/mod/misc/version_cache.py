@@ -0,0 +1,157 @@
+"""
+AUTHOR: Matt Durrant
+
+This module contains the VersionCache class, which remembers the output of the version commands of the tools that
+the subprocess steps run.
+
+Every subprocess step checks the version of its tool before it runs, and the GATK steps also check the version of java,
+which starts a java virtual machine each time. The output of a version command is cached in memory and in a small json
+file, keyed on the execution path, the version flag, whether stderr is kept, and the inode, size and modification time
+of each file of the execution path, such as the java binary and the GATK jar. A version command is run again whenever
+one of these files is replaced, so each tool is only probed once per host until it changes. A version command that
+fails is only kept in memory, unless the caller expects it to fail, so that a transient failure, such as java failing
+to reserve its heap on a busy node, is not replayed by every later run.
+"""
+
+import fcntl
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from contextlib import contextmanager
+
+# The output of the version commands is kept as text in the json file, and latin-1 keeps every byte of the output.
+OUTPUT_ENCODING = 'latin-1'
+LOCK_SUFFIX = '.lock'
+
+
+def file_stats(execution_path):
+    """
+    :param execution_path: An execution path, such as 'java -Xmx50g -jar GenomeAnalysisTK.jar'.
+    :return: A list of the path, inode, size and modification time of the program and of each of the other words of the
+    execution path that is a file.
+    """
+    words = execution_path.split()
+    paths = [shutil.which(words[0]) or words[0]] + words[1:] if words else []
+
+    stats = []
+    for path in paths:
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            stats.append([os.path.realpath(path), stat.st_ino, stat.st_size, stat.st_mtime_ns])
+    return stats
+
+
+class VersionCache:
+    """
+    A cache of the output of version commands, shared by the steps of a process and persisted across runs.
+    """
+
+    def __init__(self, path=None):
+        """
+        The constructor for a VersionCache object.
+        :param path: The path to the json file of the cache. The cache is only held in memory if it is None.
+        """
+        self.path = os.path.expanduser(path) if path else None
+        self.outputs = None
+
+        # A lock for the cache itself, and a lock for each version command, so that the steps that check the same
+        # tool at the same time wait for one version command rather than running it several times.
+        self.lock = threading.Lock()
+        self.key_locks = {}
+
+    @contextmanager
+    def locked_file(self):
+        """
+        Holds an exclusive lock on the json file, so that the pipelines that run at once do not lose each other's
+        versions.
+        """
+        with open(self.path + LOCK_SUFFIX, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def read_file(self):
+        """
+        :return: The entries of the json file, or an empty dictionary if it does not exist or cannot be read.
+        """
+        try:
+            with open(self.path) as infile:
+                outputs = json.load(infile)
+            return outputs if isinstance(outputs, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    def load(self):
+        """
+        Loads the json file the first time the cache is used.
+        """
+        if self.outputs is None:
+            self.outputs = self.read_file() if self.path else {}
+
+    def save(self, key, entry):
+        """
+        Adds an entry to the json file, merged with the entries that other processes added since it was loaded. The
+        entries of the same version command for files that have since changed are removed.
+        :param key: The key of the version command.
+        :param entry: The returncode and output of the version command.
+        """
+        if not self.path:
+            return
+
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with self.locked_file():
+                command = json.loads(key)[:-1]
+                outputs = {other: value for other, value in self.read_file().items()
+                           if json.loads(other)[:-1] != command}
+                outputs[key] = entry
+                handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)))
+                with os.fdopen(handle, 'w') as outfile:
+                    json.dump(outputs, outfile, indent=4, sort_keys=True)
+                os.replace(temp_path, self.path)
+        except (OSError, ValueError):
+            # The cache is only an optimization, so a cache file that cannot be written leaves the version in memory.
+            pass
+
+    def check_output(self, execution_path, version_flag, stderr=subprocess.PIPE, save_errors=False):
+        """
+        Runs a version command, or returns its output from the cache, in the same way as subprocess.check_output().
+        :param execution_path: The execution path of the tool.
+        :param version_flag: The flag that makes the tool print its version.
+        :param stderr: Passed to subprocess.check_output(). Only whether stderr is kept in the output matters.
+        :param save_errors: Whether a failed version command is saved to the json file, for tools that always exit with
+        an error when they print their version.
+        :return: The output of the version command, as bytes.
+        """
+        command = execution_path.split() + version_flag.split()
+        key = json.dumps([execution_path, version_flag, stderr == subprocess.STDOUT, file_stats(execution_path)])
+
+        with self.lock:
+            self.load()
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self.lock:
+                entry = self.outputs.get(key)
+
+            if entry is None:
+                try:
+                    output = subprocess.check_output(command, stderr=stderr)
+                    entry = {'returncode': 0, 'output': output.decode(OUTPUT_ENCODING)}
+                except subprocess.CalledProcessError as e:
+                    entry = {'returncode': e.returncode, 'output': (e.output or b'').decode(OUTPUT_ENCODING)}
+
+                with self.lock:
+                    self.outputs[key] = entry
+                if save_errors or not entry['returncode']:
+                    self.save(key, entry)
+
+        output = entry['output'].encode(OUTPUT_ENCODING)
+        if entry['returncode']:
+            raise subprocess.CalledProcessError(entry['returncode'], command, output=output)
+        return output
@@ -0,0 +1,244 @@
+"""
+AUTHOR: Matt Durrant
+
+This module contains the WaspSnpTableWriter class, which writes the SNPs of a VCF file to the HDF5 files that WASP
+reads SNPs from, in place of a directory of gzipped text files.
+
+WASP's snp2h5 writes three HDF5 files, each with a node for each chromosome. snp_tab.h5 holds a table of the name,
+position and alleles of each SNP. snp_index.h5 holds an array with an entry for each position of the chromosome, which
+is the row of the SNP at that position in the table, or -1. haplotype.h5 holds an array of the allele of each haplotype
+of each sample at each SNP, and a table of the names of the samples. The files are written in the same layout while
+the VCF file is read, as chunked and compressed datasets, so that WASP loads the SNPs of a chromosome at once instead of
+parsing them from text. PyTables is only imported when the files are written.
+"""
+
+import re
+import warnings
+from os.path import join
+import numpy as np
+from mod.misc.string_constants import *
+from mod.misc.vcf_text import CHROM_COL, POS_COL, ID_COL, REF_COL, ALT_COL, FORMAT_COL, SAMPLES_COL, TAB_BYTES, \
+    COMMA_BYTES, COLON_BYTES, GT_KEY, ALLELE_DELIMITER, CONTIG_PATTERN
+
+# The names of the HDF5 files that WASP reads, with the --snp_tab, --snp_index and --haplotype arguments.
+SNP_TAB_FILE = 'snp_tab.h5'
+SNP_INDEX_FILE = 'snp_index.h5'
+HAPLOTYPE_FILE = 'haplotype.h5'
+
+# The node of the names of the samples of a chromosome in the haplotype file.
+SAMPLES_NODE = 'samples_{CHROM}'
+
+# The rows of the SNP table, with the same widths as snp2h5.
+SNP_TAB_DTYPE = np.dtype([('name', 'S16'), ('pos', np.int64), ('allele1', 'S100'), ('allele2', 'S100')])
+SAMPLE_NAME_LENGTH = 255
+
+# The value of the positions without a SNP in the index, and of the alleles of missing genotypes in the haplotypes.
+NO_SNP = -1
+MISSING_ALLELE = -1
+HAPLOTYPE_ALLELES = {b'0': 0, b'1': 1}
+
+# The number of SNPs of a chromosome that are held in memory before they are appended to the datasets.
+BATCH_ROWS = 100000
+
+# The number of positions of the index that are written at once. Blocks without a SNP are never written, and are read
+# back as NO_SNP.
+INDEX_BLOCK = 2 ** 20
+
+# The compression of the datasets.
+COMPLIB = 'zlib'
+COMPRESS_LEVEL = 1
+
+# The length of a contig in a contig line of a VCF header.
+CONTIG_LENGTH_PATTERN = re.compile(rb'[<,]length=(\d+)')
+
+# Haplotype alleles by genotype string, as there are only a handful of distinct genotype strings in a VCF file.
+_haplotype_alleles = {}
+
+
+def sample_names(header):
+    """
+    :param header: The lines of the header of a VCF file.
+    :return: The names of the samples of the VCF file.
+    """
+    columns = header[-1].rstrip(b'\r\n').split(TAB_BYTES) if header else []
+    return [sample.decode() for sample in columns[SAMPLES_COL:]]
+
+
+def contig_lengths(header):
+    """
+    :param header: The lines of the header of a VCF file.
+    :return: A dictionary of the contigs of the contig lines of the header to their lengths, if they are given.
+    """
+    lengths = {}
+    for line in header:
+        contig, length = CONTIG_PATTERN.match(line), CONTIG_LENGTH_PATTERN.search(line)
+        if contig and length:
+            lengths[contig.group(1).decode()] = int(length.group(1))
+    return lengths
+
+
+def haplotype_alleles(gt):
+    """
+    :param gt: The genotype string of a sample, such as b'0|1', or None if the sample has no genotype.
+    :return: The alleles of the two haplotypes of the sample. Alleles that are missing, or are not the reference or
+    first alternate allele, are MISSING_ALLELE.
+    """
+    try:
+        return _haplotype_alleles[gt]
+    except KeyError:
+        alleles = [HAPLOTYPE_ALLELES.get(allele, MISSING_ALLELE) for allele in ALLELE_DELIMITER.split(gt)] if gt else []
+        alleles = tuple((alleles + [MISSING_ALLELE, MISSING_ALLELE])[:2])
+        _haplotype_alleles[gt] = alleles
+        return alleles
+
+
+def haplotype_row(columns, samples):
+    """
+    :param columns: The columns of a VCF record, as returned by split_record().
+    :param samples: The number of samples of the VCF file.
+    :return: A list of the alleles of the two haplotypes of each sample.
+    """
+    keys = columns[FORMAT_COL].split(COLON_BYTES) if len(columns) > SAMPLES_COL else []
+    if GT_KEY not in keys:
+        return [MISSING_ALLELE] * (2 * samples)
+    gt_index = keys.index(GT_KEY)
+
+    row = []
+    for sample in columns[SAMPLES_COL].split(TAB_BYTES):
+        values = sample.split(COLON_BYTES, gt_index + 1)
+        row.extend(haplotype_alleles(values[gt_index] if gt_index < len(values) else None))
+    return row
+
+
+class WaspSnpTableWriter:
+    """
+    This class writes the SNPs of the records of a VCF file to WASP's HDF5 SNP files, one record at a time.
+    """
+
+    def __init__(self, output_dir, header, batch_rows=BATCH_ROWS):
+        """
+        The constructor for a WaspSnpTableWriter object. The haplotype file is only written if the VCF file has samples.
+        :param output_dir: The directory to write the HDF5 files to.
+        :param header: The lines of the header of the VCF file.
+        :param batch_rows: The number of SNPs of a chromosome that are appended to the datasets at once.
+        """
+        import tables
+        self.tables = tables
+        self.filters = tables.Filters(complevel=COMPRESS_LEVEL, complib=COMPLIB)
+
+        self.samples = sample_names(header)
+        self.contig_lengths = contig_lengths(header)
+        self.batch_rows = batch_rows
+
+        self.snp_tab = tables.open_file(join(output_dir, SNP_TAB_FILE), w)
+        self.snp_index = tables.open_file(join(output_dir, SNP_INDEX_FILE), w)
+        self.haplotype = tables.open_file(join(output_dir, HAPLOTYPE_FILE), w) if self.samples else None
+
+        # The SNPs and haplotypes of each chromosome that have not been appended yet, and the positions of the SNPs of
+        # each chromosome that the index is built from once every SNP has been read.
+        self.rows = {}
+        self.haplotypes = {}
+        self.positions = {}
+
+    def write(self, columns):
+        """
+        :param columns: The columns of a VCF record, as returned by split_record().
+        """
+        chrom = columns[CHROM_COL].decode()
+        if chrom not in self.rows:
+            self.create_chrom(chrom)
+
+        rows = self.rows[chrom]
+        rows.append((columns[ID_COL], int(columns[POS_COL]), columns[REF_COL],
+                     columns[ALT_COL].split(COMMA_BYTES, 1)[0]))
+        if self.haplotype is not None:
+            self.haplotypes[chrom].append(haplotype_row(columns, len(self.samples)))
+
+        if len(rows) >= self.batch_rows:
+            self.flush(chrom)
+
+    def create_chrom(self, chrom):
+        """
+        Creates the SNP table of a chromosome, and its haplotype array and sample table.
+        :param chrom: The chromosome.
+        """
+        self.rows[chrom] = []
+        self.haplotypes[chrom] = []
+        self.positions[chrom] = []
+
+        # Chromosome names are not always valid python identifiers, which WASP does not need them to be.
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', self.tables.NaturalNameWarning)
+            self.snp_tab.create_table(self.snp_tab.root, chrom, SNP_TAB_DTYPE, filters=self.filters)
+
+            if self.haplotype is not None:
+                self.haplotype.create_earray(self.haplotype.root, chrom, self.tables.Int8Atom(),
+                                             shape=(0, 2 * len(self.samples)), filters=self.filters)
+                samples = self.haplotype.create_table(self.haplotype.root, SAMPLES_NODE.format(CHROM=chrom),
+                                                      np.dtype([('name', 'S%d' % SAMPLE_NAME_LENGTH)]))
+                samples.append(np.array([(sample.encode(),) for sample in self.samples], dtype=samples.dtype))
+
+    def flush(self, chrom):
+        """
+        Appends the SNPs and haplotypes of a chromosome that are held in memory to the datasets.
+        :param chrom: The chromosome.
+        """
+        rows = self.rows[chrom]
+        if not rows:
+            return
+
+        snps = np.array(rows, dtype=SNP_TAB_DTYPE)
+        self.snp_tab.get_node(self.snp_tab.root, chrom).append(snps)
+        self.positions[chrom].append(snps['pos'])
+
+        if self.haplotype is not None:
+            haplotypes = np.array(self.haplotypes[chrom], dtype=np.int8).reshape(len(rows), 2 * len(self.samples))
+            self.haplotype.get_node(self.haplotype.root, chrom).append(haplotypes)
+
+        self.rows[chrom] = []
+        self.haplotypes[chrom] = []
+
+    def write_index(self, chrom):
+        """
+        Writes the index of the SNPs of a chromosome, over the length of the chromosome in the VCF header, or up to its
+        last SNP if the header does not give it. Where there are several SNPs at a position, the first is indexed.
+        :param chrom: The chromosome.
+        """
+        positions = np.concatenate(self.positions[chrom])
+        unique_positions, first_rows = np.unique(positions, return_index=True)
+        first_rows = first_rows[unique_positions > 0]
+        unique_positions = unique_positions[unique_positions > 0]
+        length = max(self.contig_lengths.get(chrom, 0), int(positions.max()), 1)
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', self.tables.NaturalNameWarning)
+            index = self.snp_index.create_carray(self.snp_index.root, chrom, self.tables.Int32Atom(dflt=NO_SNP),
+                                                 shape=(length,), filters=self.filters)
+
+        blocks = (unique_positions - 1) // INDEX_BLOCK
+        starts = np.concatenate([[0], np.flatnonzero(np.diff(blocks)) + 1, [len(blocks)]])
+        for start, end in zip(starts[:-1], starts[1:]):
+            block_start = int(blocks[start]) * INDEX_BLOCK
+            block_end = min(block_start + INDEX_BLOCK, length)
+            values = np.full(block_end - block_start, NO_SNP, dtype=np.int32)
+            values[unique_positions[start:end] - 1 - block_start] = first_rows[start:end]
+            index[block_start:block_end] = values
+
+    def close(self):
+        """
+        Appends the SNPs that are held in memory, writes the index of each chromosome and closes the files.
+        """
+        for chrom in self.rows:
+            self.flush(chrom)
+            self.write_index(chrom)
+
+        self.snp_tab.close()
+        self.snp_index.close()
+        if self.haplotype is not None:
+            self.haplotype.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
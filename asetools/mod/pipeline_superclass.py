@@ -8,7 +8,13 @@ This functions acts as the superclass for all of the pipelines that are found in
 This superclass makes much of the analyses object-oriented, which greatly eases the creation of new subclasses.
 """
 
+from contextlib import ExitStack
+from mod.config.custom import PIPELINE_MAX_CORES, PIPELINE_MAX_MEMORY, PIPELINE_MAX_SCRATCH, MAX_CONCURRENT_JVMS, \
+    STEP_CACHE_DIR, STEP_CACHE_MAX_SIZE
 from mod.misc.log import *
+from mod.misc.resources import ResourcePool, JVM, free_disk_space
+from mod.misc.scheduler import StepScheduler
+from mod.misc.step_cache import StepCache
 
 
 class RunPipelineSuper:
@@ -16,7 +22,7 @@ class RunPipelineSuper:
     This class acts as a superclass for all pipelines in this package.
     """
 
-    def __init__(self, name, output_dir, input_file, logger):
+    def __init__(self, name, output_dir, input_file, logger, resource_pool=None, resume=True, step_cache=None):
 
         self.name = name
         self.output_dir = output_dir
@@ -25,6 +31,27 @@ class RunPipelineSuper:
 
         self.logger = logger
 
+        # The cores, memory, scratch disk and java virtual machines shared by all of the steps of the pipeline.
+        if resource_pool:
+            self.resource_pool = resource_pool
+        else:
+            self.resource_pool = ResourcePool(cores=PIPELINE_MAX_CORES, memory=PIPELINE_MAX_MEMORY,
+                                              scratch=PIPELINE_MAX_SCRATCH or free_disk_space(output_dir),
+                                              **{JVM: MAX_CONCURRENT_JVMS})
+
+        # Whether steps that completed in a previous run of the pipeline are skipped.
+        self.resume = resume
+
+        # The cache of step outputs shared with other pipelines, if one is configured.
+        if step_cache:
+            self.step_cache = step_cache
+        elif STEP_CACHE_DIR:
+            self.step_cache = StepCache(STEP_CACHE_DIR, max_size=STEP_CACHE_MAX_SIZE, logger=logger)
+        else:
+            self.step_cache = None
+
+        self.outputs = {}
+
         self.ran = False
 
 
@@ -35,13 +62,61 @@ class RunPipelineSuper:
         """
         Log.info_chk(self.logger, msg_starting_run.format(NAME=self.name))
         os.makedirs(self.output_dir, exist_ok=True)
-        self.execute_steps()
+
+        # The shared genomes stay loaded until every step has finished, even if one of the steps fails.
+        with ExitStack() as stack:
+            for genome in self.shared_genomes():
+                genome.acquire(self.resource_pool)
+                stack.callback(genome.release)
+            self.execute_steps()
+
         self.ran = True
 
 
     def execute_steps(self):
+        """
+        Executes the graph of steps declared by declare_steps(). Steps are started as soon as their inputs are ready.
+        """
+        scheduler = StepScheduler(self.name, self.declare_steps(), self.resource_pool, logger=self.logger,
+                                  resume=self.resume, step_cache=self.step_cache)
+        self.outputs = scheduler.run(self.declare_inputs())
+
+
+    def declare_inputs(self):
         """
         This needs to be implemented by the subclasses.
-        This is the sequential execution of all pipeline steps.
+        :return: A list of (StepPort, value) tuples for the inputs given to the pipeline.
+        """
+        raise NotImplementedError
+
+
+    def declare_steps(self):
+        """
+        This needs to be implemented by the subclasses.
+        :return: A list of StepNodes, one for each of the pipeline steps.
+        """
+        raise NotImplementedError
+
+
+    def shared_genomes(self):
+        """
+        This can be overridden by the pipelines whose steps attach a genome from shared memory.
+        :return: A list of the StarSharedGenome objects that are held while the pipeline runs.
+        """
+        return []
+
+
+    def step_kwargs(self, step_dir):
+        """
+        :param step_dir: The name of the step's output directory within the pipeline output directory.
+        :return: The keyword arguments shared by all of the steps of the pipeline.
+        """
+        return {'output_dir': os.path.join(self.output_dir, step_dir), 'logger': self.logger}
+
+
+    def scatter_kwargs(self, step_dir):
+        """
+        :param step_dir: The name of the step's output directory within the pipeline output directory.
+        :return: The keyword arguments of a scattered step, whose shards take their resources from the pipeline's pool.
         """
-        raise NotImplementedError
\ No newline at end of file
+        return dict(self.step_kwargs(step_dir), resource_pool=self.resource_pool)
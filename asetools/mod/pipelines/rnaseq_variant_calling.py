@@ -8,18 +8,23 @@ This executes the full RNAseq Variant Calling pipeline as detailed by the GATK b
 . Calling variants from RNA-seq can be useful when genotyping information for your sample is limited.
 """
 
-from os.path import join
-
 from mod.subprocess.add_read_groups import RunPicardAddReadGroups
 from mod.subprocess.haplotype_caller import RunGATKHaplotypeCaller
+from mod.subprocess.haplotype_caller_scatter import RunGATKHaplotypeCallerScatter
 from mod.subprocess.print_reads import RunGATKPrintReads
 from mod.subprocess.rnaseq_base_recalibrator import RunGATKRNAseqBaseRecalibrator
 from mod.subprocess.split_n_cigar_reads import RunGATKSplitNCigarReads
 from mod.subprocess.star_align import RunStarAlign
+from mod.subprocess.star_align_add_read_groups import RunStarAlignAddReadGroups
+from mod.subprocess.star_genome import shared_star_genome
 from mod.subprocess.variant_filtration import RunGATKVariantFiltration
 from mod.process.vcf_summary_statistics import RunVcfSummaryStatistics
 
+from mod.config.custom import STREAM_STAR_OUTPUT, SCATTER_SHARDS, STAR_SHARED_GENOME
 from mod.config.fixed import RNASeqVariantCallingFixedConfig
+from mod.misc.record_classes import StepPort
+from mod.misc.scheduler import StepNode
+from mod.misc.string_constants import *
 from mod.pipeline_superclass import RunPipelineSuper
 from mod.subprocess.mark_duplicates import RunPicardMarkDuplicates
 
@@ -29,13 +34,16 @@ class RunRNASeqVariantCalling(RunPipelineSuper):
     This class executes the full RNAseq Variant Calling pipeline as detailed by the GATK best practices.
     """
 
-    def __init__(self, output_dir, fastq1, fastq2, logger):
+    def __init__(self, output_dir, fastq1, fastq2, logger, resource_pool=None, resume=True, step_cache=None):
         """
         Constructor for a RunRNASeqVariantCalling object.
         :param output_dir: The output directory to save all of the output.
         :param fastq1: The first FASTQ file for the paired-end reads.
         :param fastq2: The second FASTQ files for the paired-end reads.
         :param logger: The logger to use when executing the pipeline.
+        :param resource_pool: The ResourcePool to run the steps in, a new one is created if not given.
+        :param resume: Whether to skip steps that completed in a previous run of the pipeline.
+        :param step_cache: The StepCache to share step outputs through, the configured one is used if not given.
         """
         fixed_config = RNASeqVariantCallingFixedConfig()
 
@@ -48,92 +56,128 @@ class RunRNASeqVariantCalling(RunPipelineSuper):
 
         logger = logger
 
-        super().__init__(name, output_dir, input_file, logger)
-
-
-    def execute_steps(self):
-
-        # STAR ALIGN
-        star_output_dir = join(self.output_dir, 'STEP1_STAR_ALIGN')
-        run_star = RunStarAlign(output_dir=star_output_dir,
-                                fastq1=self.input_file.arg1,
-                                fastq2=self.input_file.arg2,
-                                logger=self.logger)
-        run_star.run()
-        star_output_sam = run_star.retrieve_output_path()
-
-
-        # ADD READ GROUPS
-        add_read_groups_output_dir = join(self.output_dir, "STEP2_ADD_READ_GROUPS")
-        run_add_read_groups = RunPicardAddReadGroups(output_dir=add_read_groups_output_dir,
-                                                     input_sam=star_output_sam,
-                                                     logger=self.logger)
-        run_add_read_groups.run()
-        arg_output_bam = run_add_read_groups.retrieve_output_path()
-
-
-        # MARK DUPLICATES
-        mark_dups_output_dir = join(self.output_dir, "STEP3_MARK_DUPLICATES")
-        mark_dups = RunPicardMarkDuplicates(output_dir = mark_dups_output_dir,
-                                            input_bam=arg_output_bam,
-                                            logger=self.logger)
-        mark_dups.run()
-        mark_dups_bam = mark_dups.retrieve_output_path()
-
-
-        # SPLIT READS
-        split_reads_output_dir = join(self.output_dir, "STEP4_SPLIT_READS")
-        split_reads = RunGATKSplitNCigarReads(output_dir = split_reads_output_dir,
-                                              input_bam=mark_dups_bam,
-                                              logger=self.logger)
-        split_reads.run()
-        split_reads_bam = split_reads.retrieve_output_path()
-
-
-        # RECALIBRATE BASES
-        recal_bases_output_dir = join(self.output_dir, "STEP5_RECAL_BASES")
-        recal_bases = RunGATKRNAseqBaseRecalibrator(output_dir=recal_bases_output_dir,
-                                                    input_bam=split_reads_bam,
-                                                    logger=self.logger)
-        recal_bases.run()
-        recal_table = recal_bases.retrieve_output_path()
-
-
-        # PRINT READS
-        print_reads_output_dir = join(self.output_dir, "STEP6_PRINT_READS")
-        print_reads = RunGATKPrintReads(output_dir=print_reads_output_dir,
-                                        input_bam=split_reads_bam,
-                                        input_recal_table=recal_table,
-                                        logger=self.logger)
-        print_reads.run()
-        recal_bam = print_reads.retrieve_output_path()
-
-
-        # HAPLOTYPE CALLER
-        haplotype_caller_output_dir = join(self.output_dir, "STEP7_HAPLOTYPE_CALLER")
-        haplotype_caller = RunGATKHaplotypeCaller(output_dir=haplotype_caller_output_dir,
-                                                  input_bam=recal_bam,
-                                                  logger=self.logger)
-        haplotype_caller.run()
-        raw_vcf = haplotype_caller.retrieve_output_path()
-
-
-        # VARIANT FILTRATION
-        variant_filtration_output_dir = join(self.output_dir, "STEP8_VARIANT_FILTRATION")
-        variant_filter = RunGATKVariantFiltration(output_dir=variant_filtration_output_dir,
-                                                  input_vcf=raw_vcf,
-                                                  logger=self.logger)
-        variant_filter.run()
-        filtered_vcf = variant_filter.retrieve_output_path()
-
-
-        # Produce summary statistics of final VCF
-        # This uses my own script, vcf_summary_statistics.py, to process the final VCF produced by the pipeline,
-        # providing summary statistics that can be used for quality control purposes by the user.
-        vcf_sum_stats_output_dir = join(self.output_dir, "STEP9_FINAL_VCF_SUMMARY_STATS")
-        vcf_sum_stats = RunVcfSummaryStatistics(output_dir=vcf_sum_stats_output_dir,
-                                                input_vcf=filtered_vcf,
-                                                logger=self.logger)
-        vcf_sum_stats.run()
+        super().__init__(name, output_dir, input_file, logger, resource_pool=resource_pool, resume=resume,
+                         step_cache=step_cache)
+
+
+    def declare_inputs(self):
+        """
+        :return: The paired-end FASTQ files given to the pipeline.
+        """
+        return [(StepPort('fastq1', fastq_str), self.input_file.arg1),
+                (StepPort('fastq2', fastq_str), self.input_file.arg2)]
+
 
+    def shared_genomes(self):
+        """
+        :return: The STAR genome, if the alignments attach it from shared memory.
+        """
+        return [shared_star_genome(logger=self.logger)] if STAR_SHARED_GENOME else []
+
+
+    def declare_steps(self):
+        """
+        :return: The steps of the GATK RNAseq variant calling pipeline as a graph of StepNodes.
+        """
+        if STREAM_STAR_OUTPUT:
+            alignment_steps = [
+
+                # STAR ALIGN, STREAMED INTO ADD READ GROUPS
+                StepNode(name='STEP1_STAR_ALIGN_ADD_READ_GROUPS',
+                         step_class=RunStarAlignAddReadGroups,
+                         step_kwargs=dict(self.step_kwargs('STEP1_STAR_ALIGN_ADD_READ_GROUPS'),
+                                          shared_genome=STAR_SHARED_GENOME),
+                         inputs={'fastq1': StepPort('fastq1', fastq_str),
+                                 'fastq2': StepPort('fastq2', fastq_str)},
+                         outputs=[StepPort('read_groups_bam', bam_str)])
+
+            ]
+        else:
+            alignment_steps = [
+
+                # STAR ALIGN
+                StepNode(name='STEP1_STAR_ALIGN',
+                         step_class=RunStarAlign,
+                         step_kwargs=dict(self.step_kwargs('STEP1_STAR_ALIGN'),
+                                          shared_genome=STAR_SHARED_GENOME),
+                         inputs={'fastq1': StepPort('fastq1', fastq_str),
+                                 'fastq2': StepPort('fastq2', fastq_str)},
+                         outputs=[StepPort('star_sam', sam_str)]),
+
+                # ADD READ GROUPS
+                StepNode(name='STEP2_ADD_READ_GROUPS',
+                         step_class=RunPicardAddReadGroups,
+                         step_kwargs=self.step_kwargs('STEP2_ADD_READ_GROUPS'),
+                         inputs={'input_sam': StepPort('star_sam', sam_str)},
+                         outputs=[StepPort('read_groups_bam', bam_str)])
+
+            ]
+
+        if SCATTER_SHARDS > 1:
+            # HAPLOTYPE CALLER, scattered across the genome. The shards take their own resources from the pool.
+            haplotype_caller = StepNode(name='STEP7_HAPLOTYPE_CALLER',
+                                        step_class=RunGATKHaplotypeCallerScatter,
+                                        step_kwargs=self.scatter_kwargs('STEP7_HAPLOTYPE_CALLER'),
+                                        inputs={'input_bam': StepPort('recal_bam', bam_str)},
+                                        outputs=[StepPort('raw_vcf', vcf_str)])
+        else:
+            # HAPLOTYPE CALLER
+            haplotype_caller = StepNode(name='STEP7_HAPLOTYPE_CALLER',
+                                        step_class=RunGATKHaplotypeCaller,
+                                        step_kwargs=self.step_kwargs('STEP7_HAPLOTYPE_CALLER'),
+                                        inputs={'input_bam': StepPort('recal_bam', bam_str)},
+                                        outputs=[StepPort('raw_vcf', vcf_str)])
+
+        steps = alignment_steps + [
+
+            # MARK DUPLICATES
+            StepNode(name='STEP3_MARK_DUPLICATES',
+                     step_class=RunPicardMarkDuplicates,
+                     step_kwargs=self.step_kwargs('STEP3_MARK_DUPLICATES'),
+                     inputs={'input_bam': StepPort('read_groups_bam', bam_str)},
+                     outputs=[StepPort('mark_dups_bam', bam_str)]),
+
+            # SPLIT READS
+            StepNode(name='STEP4_SPLIT_READS',
+                     step_class=RunGATKSplitNCigarReads,
+                     step_kwargs=self.step_kwargs('STEP4_SPLIT_READS'),
+                     inputs={'input_bam': StepPort('mark_dups_bam', bam_str)},
+                     outputs=[StepPort('split_reads_bam', bam_str)]),
+
+            # RECALIBRATE BASES
+            StepNode(name='STEP5_RECAL_BASES',
+                     step_class=RunGATKRNAseqBaseRecalibrator,
+                     step_kwargs=self.step_kwargs('STEP5_RECAL_BASES'),
+                     inputs={'input_bam': StepPort('split_reads_bam', bam_str)},
+                     outputs=[StepPort('recal_table', table_str)]),
+
+            # PRINT READS
+            StepNode(name='STEP6_PRINT_READS',
+                     step_class=RunGATKPrintReads,
+                     step_kwargs=self.step_kwargs('STEP6_PRINT_READS'),
+                     inputs={'input_bam': StepPort('split_reads_bam', bam_str),
+                             'input_recal_table': StepPort('recal_table', table_str)},
+                     outputs=[StepPort('recal_bam', bam_str)]),
+
+            haplotype_caller,
+
+            # VARIANT FILTRATION
+            StepNode(name='STEP8_VARIANT_FILTRATION',
+                     step_class=RunGATKVariantFiltration,
+                     step_kwargs=self.step_kwargs('STEP8_VARIANT_FILTRATION'),
+                     inputs={'input_vcf': StepPort('raw_vcf', vcf_str)},
+                     outputs=[StepPort('filtered_vcf', vcf_str)]),
+
+            # Produce summary statistics of final VCF
+            # This uses my own script, vcf_summary_statistics.py, to process the final VCF produced by the pipeline,
+            # providing summary statistics that can be used for quality control purposes by the user.
+            StepNode(name='STEP9_FINAL_VCF_SUMMARY_STATS',
+                     step_class=RunVcfSummaryStatistics,
+                     step_kwargs=self.step_kwargs('STEP9_FINAL_VCF_SUMMARY_STATS'),
+                     inputs={'input_vcf': StepPort('filtered_vcf', vcf_str)},
+                     outputs=[StepPort('vcf_summary_stats', tsv_str)])
+
+        ]
+
+        return steps
 
@@ -0,0 +1,210 @@
+"""
+AUTHOR: Matt Durrant
+
+This module contains the RunWASPAlleleSpecificExpressionBatch class, which runs the WASP ASE read counting pipeline
+for every sample of a cohort in a single process.
+
+The samples are listed in a tab-separated sample sheet with the columns sample, BAM and VCF. Every sample is run in its
+own output subdirectory, and the steps of all of the samples share one ResourcePool. This keeps the machine busy
+without oversubscribing it, and limits the number of java virtual machines that run at once across the whole batch.
+A summary of the status and run time of each sample is saved when the batch finishes.
+"""
+
+import csv
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from mod.config.custom import PIPELINE_MAX_CORES, PIPELINE_MAX_MEMORY, PIPELINE_MAX_SCRATCH, MAX_CONCURRENT_JVMS, \
+    STEP_CACHE_DIR, STEP_CACHE_MAX_SIZE, STAR_SHARED_GENOME
+from mod.config.fixed import WASPAlleleSpecificExpressionBatchFixedConfig
+from mod.misc.exceptions import SampleSheetError, BatchFailedError
+from mod.misc.log import *
+from mod.misc.record_classes import Sample, SampleResult
+from mod.misc.resources import ResourcePool, CORES, JVM, free_disk_space
+from mod.misc.step_cache import StepCache
+from mod.misc.string_constants import *
+from mod.pipelines.wasp_ase_pipeline import RunWASPAlleleSpecificExpressionPipeline
+from mod.subprocess.star_genome import shared_star_genome
+
+# The status of each sample in the batch summary.
+COMPLETED_STR = 'completed'
+FAILED_STR = 'failed'
+
+
+def read_sample_sheet(sample_sheet):
+    """
+    Reads a tab-separated sample sheet with the columns sample, BAM and VCF. Blank lines and lines that start with #
+    are skipped, as is a header line that starts with the word sample. Relative paths are relative to the sample sheet.
+    Sample names must be plain directory names, as the outputs of each sample are written to a directory of that name.
+    :param sample_sheet: The path to the sample sheet.
+    :return: A list of Sample records in the order of the sample sheet.
+    """
+    header = WASPAlleleSpecificExpressionBatchFixedConfig().sample_sheet_columns
+    sheet_dir = os.path.dirname(os.path.abspath(sample_sheet))
+
+    samples = []
+    names = set()
+    with open(sample_sheet) as infile:
+        for line_number, line in enumerate(infile, 1):
+            line = line.rstrip(NL)
+            if not line.strip() or line.startswith('#'):
+                continue
+
+            fields = [field.strip() for field in line.split(TAB)]
+            if not samples and fields[0].lower() == header[0]:
+                continue
+
+            if len(fields) != len(header):
+                raise SampleSheetError(sample_sheet, line_number, "expected the {COUNT} columns {COLUMNS}".format(
+                    COUNT=len(header), COLUMNS=', '.join(header)))
+
+            name, bam, vcf = fields[0], os.path.join(sheet_dir, fields[1]), os.path.join(sheet_dir, fields[2])
+            # The name is the directory of the sample in the batch directory, so it cannot be a path.
+            if not name or name != os.path.basename(name) or name in ('.', '..'):
+                raise SampleSheetError(sample_sheet, line_number, "the sample name {NAME!r} is not a valid directory "
+                                                                  "name".format(NAME=name))
+            if name in names:
+                raise SampleSheetError(sample_sheet, line_number, "the sample {NAME} is listed more than once".format(
+                    NAME=name))
+            for path in (bam, vcf):
+                if not os.path.isfile(path):
+                    raise SampleSheetError(sample_sheet, line_number, "{PATH} does not exist".format(PATH=path))
+
+            names.add(name)
+            samples.append(Sample(name=name, bam=bam, vcf=vcf))
+
+    if not samples:
+        raise SampleSheetError(sample_sheet, 0, "no samples were found")
+
+    return samples
+
+
+class RunWASPAlleleSpecificExpressionBatch:
+    """
+    This class executes the WASP ASE read counting pipeline for all of the samples of a sample sheet.
+    """
+
+    def __init__(self, output_dir, sample_sheet, logger=None, max_samples=None, resource_pool=None, resume=True,
+                 step_cache=None):
+        """
+        Constructor for a RunWASPAlleleSpecificExpressionBatch object.
+        :param output_dir: The output directory, each sample is saved in a subdirectory named after the sample.
+        :param sample_sheet: A tab-separated file with the columns sample, BAM and VCF.
+        :param logger: The logger to keep track of the progress of the batch.
+        :param max_samples: The number of samples that are started at once. Defaults to the number of cores in the
+        resource pool, the resource pool still limits how many steps actually run.
+        :param resource_pool: The ResourcePool shared by the steps of all of the samples.
+        :param resume: Whether to skip the steps that completed in a previous run of the batch.
+        :param step_cache: The StepCache shared by all of the samples, the configured one is used if not given.
+        """
+        fixed_config = WASPAlleleSpecificExpressionBatchFixedConfig()
+
+        self.name = fixed_config.name
+        self.output_dir = output_dir
+        self.summary_name = fixed_config.summary_name
+
+        self.samples = read_sample_sheet(sample_sheet)
+
+        self.logger = logger
+
+        if resource_pool:
+            self.resource_pool = resource_pool
+        else:
+            self.resource_pool = ResourcePool(cores=PIPELINE_MAX_CORES, memory=PIPELINE_MAX_MEMORY,
+                                              scratch=PIPELINE_MAX_SCRATCH or free_disk_space(output_dir),
+                                              **{JVM: MAX_CONCURRENT_JVMS})
+
+        self.max_samples = max_samples if max_samples else self.resource_pool.capacities[CORES]
+
+        self.resume = resume
+
+        if step_cache:
+            self.step_cache = step_cache
+        elif STEP_CACHE_DIR:
+            self.step_cache = StepCache(STEP_CACHE_DIR, max_size=STEP_CACHE_MAX_SIZE, logger=logger)
+        else:
+            self.step_cache = None
+
+        self.results = []
+
+        self.ran = False
+
+    def run(self):
+        """
+        Runs the pipeline for every sample. A sample that fails does not stop the other samples. Once every sample has
+        finished, the summary is saved and a BatchFailedError is raised if any of the samples failed.
+        :return: A list of SampleResult records in the order of the sample sheet.
+        """
+        Log.info_chk(self.logger, msg_starting_run.format(NAME=self.name))
+        os.makedirs(self.output_dir, exist_ok=True)
+
+        # The STAR genome is held for the whole batch, so that it is not removed from shared memory between samples.
+        genome = shared_star_genome(logger=self.logger) if STAR_SHARED_GENOME else None
+        if genome:
+            genome.acquire(self.resource_pool)
+        try:
+            with ThreadPoolExecutor(max_workers=min(self.max_samples, len(self.samples))) as executor:
+                self.results = list(executor.map(self.run_sample, self.samples))
+        finally:
+            if genome:
+                genome.release()
+
+        self.save_summary()
+        self.ran = True
+
+        failed = [result.name for result in self.results if result.status == FAILED_STR]
+        if failed:
+            raise BatchFailedError(self.name, failed)
+
+        return self.results
+
+    def run_sample(self, sample):
+        """
+        Runs the pipeline for a single sample.
+        :param sample: A Sample record.
+        :return: A SampleResult record.
+        """
+        sample_dir = os.path.join(self.output_dir, sample.name)
+        Log.info_chk(self.logger, msg_starting_sample.format(NAME=sample.name, PATH=sample_dir))
+
+        start = time.time()
+        status, error = COMPLETED_STR, None
+        try:
+            pipeline = RunWASPAlleleSpecificExpressionPipeline(output_dir=sample_dir,
+                                                               input_vcf=sample.vcf,
+                                                               input_bam=sample.bam,
+                                                               logger=self.logger,
+                                                               resource_pool=self.resource_pool,
+                                                               resume=self.resume,
+                                                               step_cache=self.step_cache)
+            pipeline.run()
+        except Exception as e:
+            status, error = FAILED_STR, repr(e)
+            Log.error_chk(self.logger, traceback.format_exc())
+
+        seconds = time.time() - start
+        Log.info_chk(self.logger, msg_finished_sample.format(NAME=sample.name, STATUS=status, SECONDS=seconds))
+
+        return SampleResult(name=sample.name, status=status, seconds=seconds, output_dir=sample_dir, error=error)
+
+    def save_summary(self):
+        """
+        Saves the status and run time of every sample as a tab-separated file in the output directory.
+        """
+        path = self.get_summary_path()
+        with open(path, w) as outfile:
+            writer = csv.writer(outfile, delimiter=TAB, lineterminator=NL)
+            writer.writerow(['sample', 'status', 'seconds', 'output_dir', 'error'])
+            for result in self.results:
+                writer.writerow([result.name, result.status, '%.1f' % result.seconds, result.output_dir,
+                                 result.error if result.error else ''])
+
+        completed = sum(1 for result in self.results if result.status == COMPLETED_STR)
+        Log.info_chk(self.logger, msg_batch_summary.format(PATH=path, COMPLETED=completed,
+                                                           FAILED=len(self.results) - completed))
+
+    def get_summary_path(self):
+        """
+        :return: The path to the batch summary.
+        """
+        return os.path.join(self.output_dir, self.summary_name)
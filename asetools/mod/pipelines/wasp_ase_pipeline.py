@@ -9,18 +9,26 @@ It follows the WASP workflow, a tool for removing reference allele mapping bias
 (Geijn et al., 2015) . Removing bias from read alignments is an important step in reliable ASE analysis.
 """
 
-from os.path import join
-
 from mod.subprocess.add_read_groups import RunPicardAddReadGroups
 from mod.subprocess.ase_read_counter import RunGATKASEReadCounter
+from mod.subprocess.ase_read_counter_scatter import RunGATKASEReadCounterScatter
 from mod.subprocess.mark_duplicates import RunPicardMarkDuplicates
 from mod.subprocess.samtools_merge import RunSamtoolsMerge
 from mod.subprocess.samtools_sort import RunSamtoolsSort
 from mod.subprocess.star_align import RunStarAlign
+from mod.subprocess.star_align_add_read_groups import RunStarAlignAddReadGroups
+from mod.subprocess.star_genome import shared_star_genome
 from mod.subprocess.wasp_filter_remapped_reads import RunWaspFilterRemappedReads
 from mod.subprocess.wasp_find_intersecting_snps import RunWaspFindIntersectingSnps
 
+from mod.config.custom import STREAM_STAR_OUTPUT, SCATTER_SHARDS, \
+    USE_PYSAM_ASE_READ_COUNTER, PYSAM_ASE_READ_COUNTER_PROCESSES, WASP_HDF5_SNPS, WASP_HDF5_HAPLOTYPES, \
+    STAR_SHARED_GENOME
 from mod.config.fixed import WASPAlleleSpecificExpressionPipelineFixedConfig
+from mod.misc.record_classes import StepPort
+from mod.misc.scheduler import StepNode
+from mod.misc.string_constants import *
+from mod.process.pysam_ase_read_counter import RunPysamASEReadCounter
 from mod.process.wasp_make_snp_dir import RunMakeWaspSnpDir
 from mod.pipeline_superclass import RunPipelineSuper
 from mod.subprocess.samtools_index import RunSamtoolsIndex
@@ -30,13 +38,16 @@ class RunWASPAlleleSpecificExpressionPipeline(RunPipelineSuper):
     """
     This class executes the full WASP mapping bias and ASE read counting pipeline.
     """
-    def __init__(self, output_dir, input_vcf, input_bam, logger=None):
+    def __init__(self, output_dir, input_vcf, input_bam, logger=None, resource_pool=None, resume=True, step_cache=None):
         """
         Constructor for a new RunWASPAlleleSpecificExpressionPipeline object.
         :param output_dir: The output directory to store all output files
         :param input_vcf: The input VCF file that contains all of the heterozygous sites for ASE read counting.
         :param input_bam: The input BAM file with added read groups, marked duplicates, and coordinate-sorted
         :param logger: The logger to keep track of the pipeline's progress.
+        :param resource_pool: The ResourcePool to run the steps in, a new one is created if not given.
+        :param resume: Whether to skip steps that completed in a previous run of the pipeline.
+        :param step_cache: The StepCache to share step outputs through, the configured one is used if not given.
         """
         fixed_config = WASPAlleleSpecificExpressionPipelineFixedConfig()
 
@@ -47,124 +58,160 @@ class RunWASPAlleleSpecificExpressionPipeline(RunPipelineSuper):
 
         logger = logger
 
-        super().__init__(name, output_dir, input_file, logger)
+        super().__init__(name, output_dir, input_file, logger, resource_pool=resource_pool, resume=resume,
+                         step_cache=step_cache)
 
         self.input_bam = input_bam
         self.input_vcf = input_vcf
 
-    def execute_steps(self):
-        step_num = 1
-
-        # MAKE WASP SNP DIR
-        snp_dir = join(self.output_dir, 'STEP%d_MAKE_SNP_DIR' % step_num)
-        make_snp_dir = RunMakeWaspSnpDir(output_dir=snp_dir,
-                                         input_sorted_vcf=self.input_vcf,
-                                         logger=self.logger)
-
-        #make_snp_dir.run()
-        step_num += 1
-
-
-        # WASP - FIND INTERSECTING SNPS
-        find_intersecting_snps_output_dir = join(self.output_dir, 'STEP%d_FIND_INTERSECTING_SNPS' % step_num)
-        find_intersecting_snps = RunWaspFindIntersectingSnps(output_dir=find_intersecting_snps_output_dir,
-                                                             input_bam=self.input_bam,
-                                                             input_snp_dir=snp_dir,
-                                                             logger=self.logger)
-
-        #find_intersecting_snps.run()
-        step_num += 1
-
-        bam_keep, bam_remap, fastq1_remap, fastq2_remap, fastq_single_remap = find_intersecting_snps.retrieve_output_path()
-
-
-        # WASP - STAR REMAP
-        star_remap_output_dir = join(self.output_dir, 'STEP%d_REMAP_OUTPUT_DIR' % step_num)
-        star_remap = RunStarAlign(output_dir=star_remap_output_dir,
-                                  fastq1=fastq1_remap,
-                                  fastq2=fastq2_remap,
-                                  logger=self.logger)
-        #star_remap.run()
-        step_num += 1
-
-        remap_sam = star_remap.retrieve_output_path()
-
-
-        # STAR REMAP ADD READ GROUPS
-        add_read_groups_output_dir = join(self.output_dir, "STEP%d_STAR_REMAP_ADD_READ_GROUPS" % step_num)
-        run_star_remap_add_read_groups = RunPicardAddReadGroups(output_dir=add_read_groups_output_dir,
-                                                                input_sam=remap_sam,
-                                                                logger=self.logger)
-        #run_star_remap_add_read_groups.run()
-        step_num += 1
-
-        arg_output_bam = run_star_remap_add_read_groups.retrieve_output_path()
-
-
-        # STAR REMAP MARK DUPLICATES
-        mark_dups_output_dir = join(self.output_dir, "STEP%d_STAR_REMAP_MARK_DUPLICATES" % step_num)
-        star_remap_mark_dups = RunPicardMarkDuplicates(output_dir=mark_dups_output_dir,
-                                                       input_bam=arg_output_bam,
-                                                       logger=self.logger)
-        #star_remap_mark_dups.run()
-        step_num += 1
-
-        self.input_bam = star_remap_mark_dups.retrieve_output_path()
-
-
-        # WASP - FILTER REMAP
-        filter_remapped_output_dir = join(self.output_dir, "STEP%d_WASP_FILTER_REMAPPED" % step_num)
-        filter_remapped = RunWaspFilterRemappedReads(output_dir=filter_remapped_output_dir,
-                                                     input_bam_to_remap=bam_remap,
-                                                     input_bam_remapped=self.input_bam,
-                                                     logger=self.logger)
-        #filter_remapped.run()
-        step_num += 1
-
-        remapped_output_bam = filter_remapped.retrieve_output_path()
-
-
-        # SAMTOOLS MERGE
-        samtools_merge_output_dir = join(self.output_dir, "STEP%d_MERGE_WASP_BAMS" % step_num)
-        samtools_merge = RunSamtoolsMerge(output_dir=samtools_merge_output_dir,
-                                          input_bam1=remapped_output_bam,
-                                          input_bam2=bam_keep,
-                                          logger=self.logger)
-        #samtools_merge.run()
-        step_num += 1
-        merged_bam = samtools_merge.retrieve_output_path()
-
-
-        # SAMTOOLS SORT
-        samtools_sort_output_dir = join(self.output_dir, "STEP%d_SORT_BAM" % step_num)
-        samtools_sort = RunSamtoolsSort(output_dir=samtools_sort_output_dir,
-                                         input_bam=merged_bam,
-                                         logger=self.logger)
-        #samtools_sort.run()
-        step_num += 1
-        sorted_bam = samtools_sort.retrieve_output_path()
-
-
-        # SAMTOOLS INDEX
-        samtools_index = RunSamtoolsIndex(input_bam=sorted_bam,
-                                          logger=self.logger)
-        #samtools_index.run()
-
-
-        # ASE READ COUNTER
-        ase_read_counter_output_dir = join(self.output_dir, "STEP%d_ASE_READ_COUNTER" % step_num)
-        ase_read_counter = RunGATKASEReadCounter(output_dir=ase_read_counter_output_dir,
-                                                 input_bam=sorted_bam,
-                                                 input_sites_vcf=self.input_vcf,
-                                                 logger=self.logger)
-        ase_read_counter.run()
-
-
-
-
-
-
-
-
+    def declare_inputs(self):
+        """
+        :return: The BAM and VCF files given to the pipeline.
+        """
+        return [(StepPort('input_bam', bam_str), self.input_bam),
+                (StepPort('input_vcf', vcf_str), self.input_vcf)]
 
+    def shared_genomes(self):
+        """
+        :return: The STAR genome, if the remapping attaches it from shared memory.
+        """
+        return [shared_star_genome(logger=self.logger)] if STAR_SHARED_GENOME else []
 
+    def declare_steps(self):
+        """
+        :return: The steps of the WASP ASE read counting pipeline as a graph of StepNodes.
+        """
+        if USE_PYSAM_ASE_READ_COUNTER:
+            # ASE READ COUNTER, counted with pysam one contig per process.
+            ase_read_counter = StepNode(name='STEP9_ASE_READ_COUNTER',
+                                        step_class=RunPysamASEReadCounter,
+                                        step_kwargs=dict(self.step_kwargs('STEP9_ASE_READ_COUNTER'),
+                                                         processes=PYSAM_ASE_READ_COUNTER_PROCESSES),
+                                        inputs={'input_bam': StepPort('indexed_bam', bam_str),
+                                                'input_sites_vcf': StepPort('input_vcf', vcf_str)},
+                                        outputs=[StepPort('read_counts', tsv_str)])
+        elif SCATTER_SHARDS > 1:
+            # ASE READ COUNTER, scattered across the genome. The shards take their own resources from the pool.
+            ase_read_counter = StepNode(name='STEP9_ASE_READ_COUNTER',
+                                        step_class=RunGATKASEReadCounterScatter,
+                                        step_kwargs=self.scatter_kwargs('STEP9_ASE_READ_COUNTER'),
+                                        inputs={'input_bam': StepPort('indexed_bam', bam_str),
+                                                'input_sites_vcf': StepPort('input_vcf', vcf_str)},
+                                        outputs=[StepPort('read_counts', tsv_str)])
+        else:
+            # ASE READ COUNTER
+            ase_read_counter = StepNode(name='STEP9_ASE_READ_COUNTER',
+                                        step_class=RunGATKASEReadCounter,
+                                        step_kwargs=self.step_kwargs('STEP9_ASE_READ_COUNTER'),
+                                        inputs={'input_bam': StepPort('indexed_bam', bam_str),
+                                                'input_sites_vcf': StepPort('input_vcf', vcf_str)},
+                                        outputs=[StepPort('read_counts', tsv_str)])
+
+        steps = [
+
+            # MAKE WASP SNP DIR
+            StepNode(name='STEP1_MAKE_SNP_DIR',
+                     step_class=RunMakeWaspSnpDir,
+                     step_kwargs=dict(self.step_kwargs('STEP1_MAKE_SNP_DIR'), hdf5=WASP_HDF5_SNPS),
+                     inputs={'input_sorted_vcf': StepPort('input_vcf', vcf_str)},
+                     outputs=[StepPort('snp_dir', dir_str)]),
+
+            # WASP - FIND INTERSECTING SNPS
+            StepNode(name='STEP2_FIND_INTERSECTING_SNPS',
+                     step_class=RunWaspFindIntersectingSnps,
+                     step_kwargs=dict(self.step_kwargs('STEP2_FIND_INTERSECTING_SNPS'), hdf5=WASP_HDF5_SNPS,
+                                      haplotypes=WASP_HDF5_HAPLOTYPES),
+                     inputs={'input_bam': StepPort('input_bam', bam_str),
+                             'input_snp_dir': StepPort('snp_dir', dir_str)},
+                     outputs=[StepPort('bam_keep', bam_str), StepPort('bam_remap', bam_str),
+                              StepPort('fastq1_remap', fastq_str), StepPort('fastq2_remap', fastq_str),
+                              StepPort('fastq_single_remap', fastq_str)])
+
+        ]
+
+        steps += self.declare_remap_steps()
+
+        steps += [
+
+            # STAR REMAP MARK DUPLICATES
+            StepNode(name='STEP5_STAR_REMAP_MARK_DUPLICATES',
+                     step_class=RunPicardMarkDuplicates,
+                     step_kwargs=self.step_kwargs('STEP5_STAR_REMAP_MARK_DUPLICATES'),
+                     inputs={'input_bam': StepPort('remap_read_groups_bam', bam_str)},
+                     outputs=[StepPort('remap_mark_dups_bam', bam_str)]),
+
+            # WASP - FILTER REMAP
+            StepNode(name='STEP6_WASP_FILTER_REMAPPED',
+                     step_class=RunWaspFilterRemappedReads,
+                     step_kwargs=self.step_kwargs('STEP6_WASP_FILTER_REMAPPED'),
+                     inputs={'input_bam_to_remap': StepPort('bam_remap', bam_str),
+                             'input_bam_remapped': StepPort('remap_mark_dups_bam', bam_str)},
+                     outputs=[StepPort('remap_keep_bam', bam_str)]),
+
+            # SAMTOOLS MERGE
+            StepNode(name='STEP7_MERGE_WASP_BAMS',
+                     step_class=RunSamtoolsMerge,
+                     step_kwargs=self.step_kwargs('STEP7_MERGE_WASP_BAMS'),
+                     inputs={'input_bam1': StepPort('remap_keep_bam', bam_str),
+                             'input_bam2': StepPort('bam_keep', bam_str)},
+                     outputs=[StepPort('merged_bam', bam_str)]),
+
+            # SAMTOOLS SORT
+            StepNode(name='STEP8_SORT_BAM',
+                     step_class=RunSamtoolsSort,
+                     step_kwargs=self.step_kwargs('STEP8_SORT_BAM'),
+                     inputs={'input_bam': StepPort('merged_bam', bam_str)},
+                     outputs=[StepPort('sorted_bam', bam_str)]),
+
+            # SAMTOOLS INDEX, the index is written next to the sorted BAM.
+            StepNode(name='STEP8_INDEX_BAM',
+                     step_class=RunSamtoolsIndex,
+                     step_kwargs={'logger': self.logger},
+                     inputs={'input_bam': StepPort('sorted_bam', bam_str)},
+                     outputs=[StepPort('indexed_bam', bam_str)]),
+
+            ase_read_counter
+
+        ]
+
+        return steps
+
+    def declare_remap_steps(self):
+        """
+        The STAR remapping of the reads that overlap SNPs, followed by read group addition. When STREAM_STAR_OUTPUT is
+        set, the SAM output of STAR is piped into AddReadGroups instead of being written to disk.
+        :return: The remapping steps as a list of StepNodes.
+        """
+        if STREAM_STAR_OUTPUT:
+            return [
+
+                # WASP - STAR REMAP, STREAMED INTO ADD READ GROUPS
+                StepNode(name='STEP3_REMAP_ADD_READ_GROUPS',
+                         step_class=RunStarAlignAddReadGroups,
+                         step_kwargs=dict(self.step_kwargs('STEP3_REMAP_ADD_READ_GROUPS'),
+                                          shared_genome=STAR_SHARED_GENOME),
+                         inputs={'fastq1': StepPort('fastq1_remap', fastq_str),
+                                 'fastq2': StepPort('fastq2_remap', fastq_str)},
+                         outputs=[StepPort('remap_read_groups_bam', bam_str)])
+
+            ]
+
+        return [
+
+            # WASP - STAR REMAP
+            StepNode(name='STEP3_REMAP_OUTPUT_DIR',
+                     step_class=RunStarAlign,
+                     step_kwargs=dict(self.step_kwargs('STEP3_REMAP_OUTPUT_DIR'),
+                                      shared_genome=STAR_SHARED_GENOME),
+                     inputs={'fastq1': StepPort('fastq1_remap', fastq_str),
+                             'fastq2': StepPort('fastq2_remap', fastq_str)},
+                     outputs=[StepPort('remap_sam', sam_str)]),
+
+            # STAR REMAP ADD READ GROUPS
+            StepNode(name='STEP4_STAR_REMAP_ADD_READ_GROUPS',
+                     step_class=RunPicardAddReadGroups,
+                     step_kwargs=self.step_kwargs('STEP4_STAR_REMAP_ADD_READ_GROUPS'),
+                     inputs={'input_sam': StepPort('remap_sam', sam_str)},
+                     outputs=[StepPort('remap_read_groups_bam', bam_str)])
+
+        ]
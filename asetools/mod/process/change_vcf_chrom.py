@@ -6,29 +6,67 @@ This module contains a RunProcessStepSuper subclass called RunChangeVcfChrom.
 I developed this script to help me correct a common problem that I often came across:
 different chromosome identifiers in different VCF files.
 
-This script uses regular expressions to parse through a VCF file and replace all chromosome IDs that are labeled
-as ‘1’ with ‘chr1’, or the opposite operation. Automating this conversion will save me a lot of time.
+This script replaces all chromosome IDs that are labeled as ‘1’ with ‘chr1’, or the opposite operation. Automating this
+conversion will save me a lot of time. Any other renaming, such as ‘MT’ to ‘chrM’, can be given as a rename map.
+
+Only the first column of each record, and the ID of each contig line of the header, are changed. The new name of each
+chromosome is looked up in a table, which is filled in the first time each chromosome is seen, and the rest of each
+line is copied unchanged. Plain and bgzipped VCF files can be read and written, and bgzipped output is indexed with
+tabix.
 """
 
 import re
 import os
 from mod.misc.string_constants import *
+from mod.misc.vcf_text import open_vcf, open_vcf_output, index_vcf, HEADER_PREFIX, TAB_BYTES, GZ_SUFFIX, \
+    TABIX_SUFFIX
 from mod.process_step_superclass import RunProcessStepSuper
 
+# The ID of a contig line of the header.
+CONTIG_ID_PATTERN = re.compile(rb'^(##contig=<(?:[^>]*?,)?ID=)([^,>]+)')
+CONTIG_HEADER_PREFIX = b'##contig=<'
+
+# The 'chr' prefix is only added to chromosomes that start with a letter, number or underscore.
+WORD_START_PATTERN = re.compile(rb'^\w')
+
+
+def read_rename_map(path):
+    """
+    Reads a rename map, which has one chromosome per line with its old and new names separated by whitespace, like the
+    files given to bcftools annotate --rename-chrs. Empty lines and lines starting with '#' are skipped.
+    :param path: The path to the rename map.
+    :return: A dictionary of old names to new names, as bytes strings.
+    """
+    rename_map = {}
+    with open(path, 'rb') as infile:
+        for line in infile:
+            fields = line.split()
+            if not fields or fields[0].startswith(HEADER_PREFIX):
+                continue
+            old_name, new_name = fields[:2]
+            rename_map[old_name] = new_name
+    return rename_map
+
 
 class RunChangeVcfChrom(RunProcessStepSuper):
     """
     This class runs the ChangeVcfChrom protocol
     """
 
-    def __init__(self, output_dir, input_vcf, add_chr=True, output_file=None, logger=None):
+    def __init__(self, output_dir, input_vcf, add_chr=True, output_file=None, logger=None, rename_map=None,
+                 bgzip=None):
         """
         The constructor for a RunChangeVcfChrom object.
         :param output_dir: The output directory.
-        :param input_vcf: The input VCF file to be altered.
+        :param input_vcf: The input VCF file to be altered, which may be bgzipped.
         :param add_chr: Whether or not to add (or remove when False) 'chr' from the VCF
         :param output_file: The name of the output file.
         :param logger: The logger to track progress.
+        :param rename_map: A dictionary of old chromosome names to new names, or the path to a file of them as read by
+        read_rename_map(). When it is given, it is used instead of add_chr and the chromosomes that are not in it are
+        left unchanged.
+        :param bgzip: Whether to compress the output with bgzip and index it with tabix. Defaults to compressing the
+        output if the input is gzipped.
         """
         name = 'ChangeVcfChrom'
         output_dir = output_dir
@@ -39,61 +77,110 @@ class RunChangeVcfChrom(RunProcessStepSuper):
         log_name = 'change_vcf_chrom.json'
         logger = logger
 
-        super().__init__(name, output_dir, input_file, output_file, log_name, logger, output_suffix='vcf')
+        bgzip = input_vcf.endswith(GZ_SUFFIX) if bgzip is None else bgzip
+
+        super().__init__(name, output_dir, input_file, output_file, log_name, logger,
+                         output_suffix=vcf_str + GZ_SUFFIX if bgzip else vcf_str)
 
         self.add_chr = add_chr
+        self.bgzip = bgzip
         self.chr_s = 'chr'
 
+        # A rename map that is given as a file is an input of the process.
+        self.rename_map_file = rename_map if isinstance(rename_map, str) else None
+        if self.rename_map_file:
+            rename_map = read_rename_map(self.rename_map_file)
+        self.rename_map = {self.to_bytes(old): self.to_bytes(new) for old, new in rename_map.items()} \
+            if rename_map is not None else None
+
+        # The table of new chromosome names, which is filled in as each chromosome is seen.
+        self.rename_table = dict(self.rename_map) if self.rename_map is not None else {}
+
     def process(self):
         """
-        Processes the input vcf, changes the chromosome identifiers using regular expressions, and then saves
-        the output.
+        Processes the input vcf, changes the chromosome identifiers, and then saves the output.
         """
-        with open(self.input_file) as vcf_in:
-
-            # Checks if it should add 'chr' from chromosomes
-            if self.add_chr:
-                self.add_chr_parse_vcf(vcf_in)
-            # Otherwise it removes 'chr' from the contigs.
-            else:
-                self.remove_chr_parse_vcf(vcf_in)
-
-    def add_chr_parse_vcf(self, vcf_stream):
+        output_path = os.path.join(self.output_dir, self.output)
+
+        with open_vcf(self.input_file) as vcf_in, open_vcf_output(output_path, self.bgzip) as outfile:
+            # VCF files are sorted, so each record usually starts with the same chromosome as the one before it.
+            old_prefix = new_prefix = None
+
+            for line in vcf_in:
+                if line.startswith(HEADER_PREFIX):
+                    # Only the IDs of the contig lines are changed in the header.
+                    if line.startswith(CONTIG_HEADER_PREFIX):
+                        line = CONTIG_ID_PATTERN.sub(self.rename_contig_id, line, count=1)
+                    outfile.write(line)
+                    continue
+
+                if old_prefix is None or not line.startswith(old_prefix):
+                    chrom, tab, rest = line.partition(TAB_BYTES)
+                    if not tab:
+                        outfile.write(line)
+                        continue
+                    old_prefix = chrom + tab
+                    new_prefix = self.rename_chrom(chrom) + tab
+
+                if new_prefix == old_prefix:
+                    outfile.write(line)
+                else:
+                    outfile.write(new_prefix + line[len(old_prefix):])
+
+        if self.bgzip:
+            index_vcf(output_path)
+
+    def rename_chrom(self, chrom):
         """
-        This function adds the 'chr' chromosome prefix to the VCF file where appropriate.
-        :param vcf_stream: A VCF file opened as a plain IO stream.
+        :param chrom: The name of a chromosome, as a bytes string.
+        :return: The new name of the chromosome.
         """
-
-        with open(os.path.join(self.output_dir, self.output), w) as outfile:
-
-            for line in vcf_stream:
-
-                # Adds 'chr' where the regular expression finds a contig match in the header lines
-                # Ignores if 'chr' is already the prefix.
-                if re.search(r'contig=<', line):
-                    line = re.sub(r'(?<=ID=)(?!{CHR_STRING})([^,>]+)'.format(CHR_STRING=self.chr_s),
-                                  r'{CHR_STRING}\1'.format(CHR_STRING=self.chr_s), line)
-
-                # Adds 'chr' to all of the non-header lines
-                # Ignores if 'chr' is already the prefix.
-                line = re.sub(r'^(?!{CHR_STRING})(\w+)'.format(CHR_STRING=self.chr_s),
-                              r'{CHR_STRING}\1'.format(CHR_STRING=self.chr_s), line)
-                outfile.write(line)
-
-    def remove_chr_parse_vcf(self, vcf_stream):
+        try:
+            return self.rename_table[chrom]
+        except KeyError:
+            pass
+
+        chr_s = self.chr_s.encode()
+        if self.rename_map is not None:
+            new_chrom = chrom
+        # Adds 'chr', ignoring chromosomes that already have the prefix.
+        elif self.add_chr:
+            new_chrom = chr_s + chrom if not chrom.startswith(chr_s) and WORD_START_PATTERN.match(chrom) else chrom
+        # Otherwise it removes 'chr' from the chromosome.
+        else:
+            new_chrom = chrom[len(chr_s):] if chrom.startswith(chr_s) else chrom
+
+        self.rename_table[chrom] = new_chrom
+        return new_chrom
+
+    def rename_contig_id(self, match):
         """
-        This function removes the 'chr' chromosome prefix from the VCF file where appropriate.
-        :param vcf_stream: A VCF file opened as a plain IO stream.
+        :param match: A match of CONTIG_ID_PATTERN.
+        :return: The start of the contig line, with the new name of the contig.
         """
+        return match.group(1) + self.rename_chrom(match.group(2))
 
-        with open(os.path.join(self.output_dir, self.output), w) as outfile:
-
-            for line in vcf_stream:
-
-                # Removes 'chr' where the regular expression finds a contig match in the header lines
-                if re.search(r'contig=<', line):
-                    line = re.sub(r'(?<=ID=){CHR_STRING}'.format(CHR_STRING=self.chr_s), '', line)
-
-                # Removes 'chr' from all of the non-header lines
-                line = re.sub(r'^{CHR_STRING}'.format(CHR_STRING=self.chr_s), '', line)
-                outfile.write(line)
+    def to_bytes(self, name):
+        """
+        :param name: A chromosome name as a string or bytes string.
+        :return: The chromosome name as a bytes string.
+        """
+        return name if isinstance(name, bytes) else str(name).encode()
+
+    def get_input_paths(self):
+        if self.rename_map_file:
+            return [self.input_file, self.rename_map_file]
+        return [self.input_file]
+
+    def get_output_paths(self):
+        output_paths = super().get_output_paths()
+        if self.bgzip:
+            output_paths.append(output_paths[0] + TABIX_SUFFIX)
+        return output_paths
+
+    def get_cache_signature(self):
+        # The rename map changes the output.
+        signature = super().get_cache_signature()
+        if self.rename_map is not None:
+            signature['rename_map'] = sorted([old.decode(), new.decode()] for old, new in self.rename_map.items())
+        return signature
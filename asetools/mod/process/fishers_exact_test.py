@@ -4,18 +4,26 @@ AUTHOR: Matt Durrant
 This module contains a RunProcessStepSuper subclass called RunFishersExactTest.
 
 It iterates through each line of the input file and performs a Fisher’s exact test on the case/control read count data.
-This test can determine if the difference in allele counts between cases and controls is significant or not.
+This test can determine if the difference in allele counts between cases and controls is significant or not. The tests
+are performed together by a vectorized implementation in mod.misc.fisher, which gives the same results as scipy.stats.
 This script also filters out any variant that variants with low coverage (< 10 reads) or that appear to be homozygous.
-P-values are corrected for multiple testing using the Bonferroni correction, and then FDR q-values are calculated using
-a downloaded package called qvalue (available at https://github.com/nfusi/qvalue).
+P-values are corrected for multiple testing using the Bonferroni correction, and optionally the Benjamini-Hochberg
+correction, and then FDR q-values are calculated using a downloaded package called qvalue (available at
+https://github.com/nfusi/qvalue).
+
+The read counts can be read from a TSV file or a columnar table written by PrepareReadCountData, and the results can
+also be written as a columnar table. The ReadCountTable kept by PrepareReadCountData can also be given directly, in
+which case the count and ratio filters are applied to all of the sites at once.
 """
 
 import os
 import numpy as np
+from mod.misc.columnar import open_table, table_suffix, is_columnar, iter_rows, DICTIONARY
+from mod.misc.read_count_table import ReadCountTable
 from mod.misc.string_constants import *
 from mod.misc.integer_constants import *
 from mod.process_step_superclass import RunProcessStepSuper
-from scipy.stats import fisher_exact
+from mod.misc.fisher import fisher_exact
 from mod.misc import qvalue
 
 
@@ -26,39 +34,49 @@ class RunFishersExactTest(RunProcessStepSuper):
     """
 
     def __init__(self, output_dir, read_count_data, filter_ratio_low=0.1, filter_ratio_high=0.9, min_count=10,
-                 output_file=None, logger=None):
+                 output_file=None, logger=None, benjamini_hochberg=False, columnar=False):
         """
         The constructor class for a RunFishersExactTest object.
         :param output_dir: The output directory.
-        :param read_count_data: A path to read count data, as formatted by the protocol PrepareReadCountData.
+        :param read_count_data: A path to read count data, as formatted by the protocol PrepareReadCountData, which
+        may be a TSV file or a columnar table, or the ReadCountTable of a PrepareReadCountData step that was run with
+        the numpy engine.
         :param filter_ratio_low: The lower bound for the allele frequency ratio filter.
         :param filter_ratio_high: The upper bound for the allele frequency ratio filter.
         :param min_count: The minimum number of reads for cases and controls.
         :param output_file: The output file.
         :param logger: The logger to track progress.
+        :param benjamini_hochberg: Whether to add Benjamini-Hochberg corrected p-values alongside the Bonferroni ones.
+        :param columnar: Writes the results as a columnar table, rather than a TSV file.
         """
 
         name = 'FishersExactTest'
         output_dir = output_dir
 
-        input_file = read_count_data
+        # A read count table is named by the file that it was written to.
+        self.read_count_table = read_count_data if isinstance(read_count_data, ReadCountTable) else None
+        input_file = self.read_count_table.path if self.read_count_table is not None else read_count_data
         output_file = output_file
 
         log_name = 'fishers_exact_test.json'
         logger = logger
 
-        super().__init__(name, output_dir, input_file, output_file, log_name, logger)
+        super().__init__(name, output_dir, input_file, output_file, log_name, logger,
+                         output_suffix=table_suffix(columnar))
 
         self.filter_ratio_low = filter_ratio_low
         self.filter_ratio_high = filter_ratio_high
         self.min_count = min_count
+        self.benjamini_hochberg = benjamini_hochberg
+        self.columnar = columnar
 
         # Keeps track of the strings to be used to specify different fields
         self.treatment_s, self.chrom_s, self.pos_s, self.ref_s, self.alt_s, self.case_alt_count_s, \
         self.case_ref_count_s, self.case_total_count_s, self.control_alt_count_s, self.control_ref_count_s, \
-        self.control_total_count_s, self.oddsratio_s, self.pval_s, self.bonf_p_s, self.qval_s = \
+        self.control_total_count_s, self.oddsratio_s, self.pval_s, self.bonf_p_s, self.bh_p_s, self.qval_s = \
             ['TREATMENT', 'CHROM', 'POS', 'REF', 'ALT', 'CASE_ALT_COUNT', 'CASE_REF_COUNT', 'CASE_TOTAL_COUNT',
-             'CONTROL_ALT_COUNT', 'CONTROL_REF_COUNT', 'CONTROL_TOTAL_COUNT', 'OR', 'PVAL', 'BONF_PVAL', 'QVAL']
+             'CONTROL_ALT_COUNT', 'CONTROL_REF_COUNT', 'CONTROL_TOTAL_COUNT', 'OR', 'PVAL', 'BONF_PVAL', 'BH_PVAL',
+             'QVAL']
 
         # Keeps track of the strings used to specify input fields
         self.input_header = [self.treatment_s, self.chrom_s, self.pos_s, self.ref_s, self.alt_s, self.case_alt_count_s,
@@ -71,41 +89,71 @@ class RunFishersExactTest(RunProcessStepSuper):
                               self.control_ref_count_s, self.control_total_count_s, self.oddsratio_s, self.pval_s,
                               self.bonf_p_s, self.qval_s]
 
+        # The Benjamini-Hochberg corrected p-values follow the Bonferroni corrected p-values, if they are requested
+        if self.benjamini_hochberg:
+            self.output_header.insert(self.output_header.index(self.bonf_p_s) + 1, self.bh_p_s)
+
+        # The types of the output fields, for a columnar table
+        self.output_types = {self.treatment_s: DICTIONARY, self.chrom_s: DICTIONARY, self.pos_s: np.int64,
+                             self.ref_s: DICTIONARY, self.alt_s: DICTIONARY, self.oddsratio_s: np.float64,
+                             self.pval_s: np.float64, self.bonf_p_s: np.float64, self.bh_p_s: np.float64,
+                             self.qval_s: np.float64}
+
     def process(self):
         """
         The primary process step for the class.
         """
 
         tested_snps = []
-        for snp in self.parse_read_counts():
+        if self.read_count_table is not None:
+            tested_snps = list(self.filter_read_count_table(self.read_count_table))
+
+        else:
+            for snp in self.parse_read_counts():
 
-            # Checks to see if the snp fails the filters, skips it if it fails.
-            if not self.passes_count_filter(snp) or not self.passes_ratio_filter(snp):
-                continue
+                # Checks to see if the snp fails the filters, skips it if it fails.
+                if not self.passes_count_filter(snp) or not self.passes_ratio_filter(snp):
+                    continue
 
-            # Creates a contingency table to be analyzed by the fishers exact test
-            contingency_table = [[snp[self.case_ref_count_s], snp[self.control_ref_count_s]],
-                                 [snp[self.case_alt_count_s], snp[self.control_alt_count_s]]]
+                tested_snps.append(snp)
 
-            # Uses the fisher exact test as implemented by scipy.stats to get odds ratio and p-value
-            oddsratio, pval = fisher_exact(contingency_table)
-            snp[self.oddsratio_s] = oddsratio
-            snp[self.pval_s] = pval
-            tested_snps.append(snp)
+        # The fishers exact test is performed on all of the snps at once
+        tested_snps = self.fishers_exact_test(tested_snps)
 
         # Bonferonni correction is added
         results = self.bonferroni_correct(tested_snps)
+        # Benjamini-Hochberg correction is added if requested.
+        if self.benjamini_hochberg:
+            results = self.benjamini_hochberg_correct(results)
         # q-value correction is added.
         results = self.qvalue_correct(results)
 
         # Writes the results for:q a file
-        with open(os.path.join(self.output_dir, self.output), w) as outfile:
-
-            outfile.write(TAB.join(self.output_header) + NL)
+        schema = [(key, self.output_types.get(key, np.int64)) for key in self.output_header]
+        with open_table(os.path.join(self.output_dir, self.output), schema, self.columnar) as outfile:
 
             for line in results:
-                outline = TAB.join([str(line[key]) for key in self.output_header])
-                outfile.write(outline + NL)
+                outfile.write([line[key] for key in self.output_header])
+
+    def fishers_exact_test(self, snps):
+        """
+        Performs a fishers exact test on the contingency table of each snp, all at once.
+        :param snps: The snps that passed the filters.
+        :return: The same snps, with additional key: value pairs for the odds ratio and p-value of each test.
+        """
+        # Creates a contingency table for each snp to be analyzed by the fishers exact test
+        contingency_tables = np.array([[[snp[self.case_ref_count_s], snp[self.control_ref_count_s]],
+                                        [snp[self.case_alt_count_s], snp[self.control_alt_count_s]]]
+                                       for snp in snps], dtype=np.int64).reshape(-1, 2, 2)
+
+        # Uses a vectorized fisher exact test that matches scipy.stats to get the odds ratios and p-values
+        oddsratios, pvals = fisher_exact(contingency_tables)
+
+        for snp, oddsratio, pval in zip(snps, oddsratios.tolist(), pvals.tolist()):
+            snp[self.oddsratio_s] = oddsratio
+            snp[self.pval_s] = pval
+
+        return snps
 
     def bonferroni_correct(self, results):
         """
@@ -129,6 +177,23 @@ class RunFishersExactTest(RunProcessStepSuper):
 
         return results
 
+    def benjamini_hochberg_correct(self, results):
+        """
+        Corrects the p-values of the results of the fisher exact test according to the Benjamini-Hochberg method.
+        :param results: The results that have yet to be corrected by the Benjamini-Hochberg method
+        :return: The same results, with an additional key: value pair for each test that includes the
+        Benjamini-Hochberg corrected p-value.
+        """
+        pvals = np.asarray([result[self.pval_s] for result in results])
+
+        # The Benjamini-Hochberg corrected p-values are the q-values when the proportion of null tests (pi0) is one.
+        bh_pvals = qvalue.estimate(pvals, pi0=1.0) if len(pvals) else pvals
+
+        for result, bh_pval in zip(results, bh_pvals.tolist()):
+            result[self.bh_p_s] = bh_pval
+
+        return results
+
     def qvalue_correct(self, results):
         """
         Calcualtes the qvalue of the results of the fisher exact test according to the FDR.
@@ -138,7 +203,7 @@ class RunFishersExactTest(RunProcessStepSuper):
         pvals = np.asarray([result[self.pval_s] for result in results])
 
         # Uses the qvalue package, which was downloaded from the internet.
-        qvals = qvalue.estimate(pvals)
+        qvals = qvalue.estimate(pvals) if len(pvals) else pvals
 
         for index in range(len(results)):
             results[index][self.qval_s] = qvals[index]
@@ -172,6 +237,31 @@ class RunFishersExactTest(RunProcessStepSuper):
         else:
             return True
 
+    def filter_read_count_table(self, table):
+        """
+        Applies the count and ratio filters to all of the snps of a read count table at once.
+        :param table: A ReadCountTable with the count columns of the input header.
+        :return: yields a snp for each row of the table that passes the filters.
+        """
+        case_alt, case_total, control_alt, control_total = [
+            table.column(key).astype(np.int64) for key in
+            (self.case_alt_count_s, self.case_total_count_s, self.control_alt_count_s, self.control_total_count_s)]
+
+        passes = (case_total >= self.min_count) & (control_total >= self.min_count)
+
+        # The ratios of the snps without reads are not a number, and fail the ratio filter.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            case_ratio = case_alt / case_total
+            control_ratio = control_alt / control_total
+        passes &= ((self.filter_ratio_low <= case_ratio) & (case_ratio <= self.filter_ratio_high)) | \
+                  ((self.filter_ratio_low <= control_ratio) & (control_ratio <= self.filter_ratio_high))
+
+        # The counts are named by the count columns of the table.
+        for row in table.rows(np.flatnonzero(passes)):
+            snp = dict(zip(self.input_header[:5], row[:5]))
+            snp.update(zip(table.count_columns, row[5:]))
+            yield snp
+
     def parse_read_counts(self, header=True):
         """
         A method to parse the read counts.
@@ -179,6 +269,12 @@ class RunFishersExactTest(RunProcessStepSuper):
         :return: yields a snp for each line in the file.
         """
 
+        # A columnar table is read directly, its counts are already integers.
+        if is_columnar(self.input_file):
+            for row in iter_rows(self.input_file):
+                yield {self.input_header[i]: row[i] for i in range(len(self.input_header))}
+            return
+
         with open(self.input_file) as infile:
             if header:
                 infile.readline()
@@ -7,18 +7,106 @@ This script takes the output of the pipeline implemented as Pipeline-ASEReadCoun
 contain allele counts for the heterozygous variant sites of interest. The data set I analyzed has ten samples in total,
 but many of them are replicates of the same time point. PrepareReadCountData merges the replicates by summing their
 read counts. Since each of the three time points (9 hours, 18 hours, 24 hours) has both cases and controls, the read
-count data from both cases and controls are organized so that they appear on the same line in the output.
+count data from both cases and controls are organized so that they appear on the same line in the output. The output
+can be written as a columnar table instead of a TSV file, which FishersExactTest reads directly.
+
+The read count files are sorted by coordinate, so they are merged as they are read, rather than loaded into memory.
+Each file is first scanned for where the read counts of each chromosome start. Then, one chromosome at a time, the
+read counts of all of the case and control replicates of a treatment are merged by position with a heap, summed, and
+written out. Only the read counts at a single position are held in memory.
+
+The numpy engine loads each read count file into a ReadCountTable in bulk instead, and sums all of the replicates and
+treatments at once with np.add.reduceat. It holds every read count in memory, in compact arrays, and keeps the table
+so that it can be given to FishersExactTest directly. Both engines write the same output.
 """
 
+import heapq
 import os
+from contextlib import ExitStack
+from itertools import groupby
+from operator import itemgetter
+import numpy as np
+from mod.misc.columnar import open_table, table_suffix, DICTIONARY
+from mod.misc.exceptions import UnsortedReadCountsError
+from mod.misc.read_count_table import ReadCountTable
 from mod.misc.string_constants import *
 from mod.process_step_superclass import RunProcessStepSuper
-from collections import defaultdict
-from operator import itemgetter
+
+# The offsets of the case and control counts in the counts of a merged site.
+CASE_OFFSET = 0
+CONTROL_OFFSET = 3
+
+# The prefixes of the case and control count columns.
+CASE_PREFIX = 'CASE_'
+CONTROL_PREFIX = 'CONTROL_'
+
+# The engines that merge the read counts.
+STREAM_ENGINE = 'stream'
+NUMPY_ENGINE = 'numpy'
+ENGINES = [STREAM_ENGINE, NUMPY_ENGINE]
+
+
+def index_contigs(path, header=True):
+    """
+    Finds where the read counts of each contig start in a read count file.
+    :param path: The path to a read count file produced by GATK ASEReadCounter.
+    :param header: Whether the file has a header line.
+    :return: A dictionary of each contig to the byte offset of its first line.
+    """
+    offsets = {}
+    with open(path, 'rb') as infile:
+        offset = len(infile.readline()) if header else 0
+        previous = None
+
+        for line in infile:
+            contig = line.split(None, 1)[0] if line.strip() else previous
+            if contig != previous:
+                contig_str = contig.decode()
+                if contig_str in offsets:
+                    raise UnsortedReadCountsError(path, 'the read counts of {CONTIG} are not together'.format(
+                        CONTIG=contig_str))
+                offsets[contig_str] = offset
+                previous = contig
+            offset += len(line)
+
+    return offsets
+
+
+def iter_contig_counts(path, infile, contig, offset, counts_offset):
+    """
+    Reads the read counts of one contig from a read count file.
+    :param path: The path to the read count file, for error messages.
+    :param infile: The read count file, opened in binary mode.
+    :param contig: The contig to read.
+    :param offset: The byte offset of the first line of the contig, as found by index_contigs().
+    :param counts_offset: CASE_OFFSET or CONTROL_OFFSET, which is passed on with the counts.
+    :return: Yields a (position, ref, alt, counts_offset, alt_count, ref_count, total_count) tuple for each line.
+    """
+    infile.seek(offset)
+    previous_position = -1
+
+    for line in infile:
+        fields = line.split()
+        if not fields:
+            continue
+
+        chrom, position, ident, ref_allele, alt_allele, ref_count, alt_count, total_count = fields[:8]
+        if chrom.decode() != contig:
+            break
+
+        position = int(position)
+        if position < previous_position:
+            raise UnsortedReadCountsError(path, 'position {POS} of {CONTIG} follows position {PREVIOUS}'.format(
+                POS=position, CONTIG=contig, PREVIOUS=previous_position))
+        previous_position = position
+
+        yield position, ref_allele.decode(), alt_allele.decode(), counts_offset, int(alt_count), int(ref_count), \
+            int(total_count)
 
 
 class RunPrepareReadCountData(RunProcessStepSuper):
-    def __init__(self, output_dir, cases_paths, controls_paths, output_file=None, logger=None):
+    def __init__(self, output_dir, cases_paths, controls_paths, output_file=None, logger=None, columnar=False,
+                 engine=STREAM_ENGINE):
         """
         The constructor class for a RunPrepareReadCountData object.
         :param output_dir: The output directory.
@@ -26,6 +114,9 @@ class RunPrepareReadCountData(RunProcessStepSuper):
         :param controls_paths: The list of paths to the read count files for the controls.
         :param output_file: The path to the output file.
         :param logger: The logger for tracking process.
+        :param columnar: Writes the read counts as a columnar table, rather than a TSV file.
+        :param engine: STREAM_ENGINE merges the read count files as they are read, NUMPY_ENGINE loads them into a
+        ReadCountTable, which is kept as self.read_count_table.
         """
         name = 'PrepareReadCountData'
         output_dir = output_dir
@@ -36,18 +127,24 @@ class RunPrepareReadCountData(RunProcessStepSuper):
         log_name = 'prepare_read_count_data.json'
         logger = logger
 
-        super().__init__(name, output_dir, input_file, output_file, log_name, logger)
+        super().__init__(name, output_dir, input_file, output_file, log_name, logger,
+                         output_suffix=table_suffix(columnar))
 
         self.cases = cases_paths
         self.controls = controls_paths
+        self.columnar = columnar
+        self.engine = engine
+        self.read_count_table = None
 
         # A list of the ordered human chromsoomes to ensure that output reads are in the correct format.
         self.ordered_chroms = [chrM, chr1, chr2, chr3, chr4, chr5, chr6, chr7, chr8, chr9, chr10, chr11, chr12, chr13,
                                chr14, chr15, chr16, chr17, chr18, chr19, chr20, chr21, chr22, chrX, chrY]
 
-        # The output header
-        self.header = TAB.join(['TREATMENT', 'CHROM', 'POS', 'REF', 'ALT', 'CASE_ALT_COUNT', 'CASE_REF_COUNT',
-                                'CASE_TOTAL_COUNT', 'CONTROL_ALT_COUNT', 'CONTROL_REF_COUNT', 'CONTROL_TOTAL_COUNT'])
+        # The output columns
+        self.schema = [('TREATMENT', DICTIONARY), ('CHROM', DICTIONARY), ('POS', np.int64), ('REF', DICTIONARY),
+                       ('ALT', DICTIONARY), ('CASE_ALT_COUNT', np.int64), ('CASE_REF_COUNT', np.int64),
+                       ('CASE_TOTAL_COUNT', np.int64), ('CONTROL_ALT_COUNT', np.int64),
+                       ('CONTROL_REF_COUNT', np.int64), ('CONTROL_TOTAL_COUNT', np.int64)]
 
         # The treatment string to label each new line by treatment.
         self.treatment_str = 'treatment{NUM}'
@@ -56,118 +153,108 @@ class RunPrepareReadCountData(RunProcessStepSuper):
         """
         The primary process step for the class.
         """
+        output_path = os.path.join(self.output_dir, self.output)
 
-        merged_cases = []
-        for treatment in self.cases:
-            # Merges the read counts data that share the same treatment
-            merged_cases.append(self.merge_read_counts(treatment))
-
-        merged_controls = []
-        for treatment in self.controls:
-            # Merges the read counts data that share the same treatment
-            merged_controls.append(self.merge_read_counts(treatment))
+        if self.engine == NUMPY_ENGINE:
+            self.read_count_table = self.merge_tables()
+            self.read_count_table.path = output_path
 
-        # Formats the results correctly.
-        final_output = self.format_final_output(merged_cases, merged_controls)
+        with open_table(output_path, self.schema, self.columnar) as outfile:
 
-        # Writes the results to the output file.
-        with open(os.path.join(self.output_dir, self.output), w) as outfile:
+            if self.read_count_table is not None:
+                for line in self.read_count_table.rows():
+                    outfile.write(line)
+                return
 
-            outfile.write(self.header + NL)
+            for index, (case_paths, control_paths) in enumerate(zip(self.cases, self.controls)):
+                # Merges the read counts of the cases and controls that share the same treatment, and writes them
+                for line in self.merge_treatment(index, case_paths, control_paths):
+                    outfile.write(line)
 
-            for line in final_output:
-                outfile.write(TAB.join(map(str, line)) + NL)
-
-    def merge_read_counts(self, read_count_paths):
+    def get_input_paths(self):
         """
-        Merges replicates of the same treatment.
-        :param read_count_paths: The paths to the read count files to merge
-        :return: A dictionary of the merged read count data.
+        :return: The paths to all of the case and control read count files.
         """
-        count_dict = defaultdict(lambda: defaultdict(list))
-
-        for path in read_count_paths:
-            reader = self.read_count_reader(path)
+        return [path for treatment in self.cases + self.controls for path in treatment]
 
-            for chrom, pos, ref, alt, refCount, altCount, totalCount in reader:
-                # Stores the reference allele count, alternate allele count, and total allele count
-                dict_key = (chrom, pos, ref, alt)
-
-                if dict_key in count_dict[chrom]:
-                    count_dict[chrom][dict_key][0] += refCount
-                    count_dict[chrom][dict_key][1] += altCount
-                    count_dict[chrom][dict_key][2] += totalCount
-
-                else:
-                    count_dict[chrom][dict_key] = [refCount, altCount, totalCount]
-
-        return dict(count_dict)
-
-    def format_final_output(self, merged_cases, merged_controls):
+    def merge_treatment(self, index, case_paths, control_paths):
         """
-        Formats the output data so that it can be properly analyzed by the FishersExactTest protocol.
-        :param merged_cases: The merged cases as produced by self.merge_read_counts()
-        :param merged_controls: The merged controls as produced by self.merge_read_counts()
-        :return:  The correctly formatted final output.
+        Merges the replicates of the cases and controls of a treatment, one chromosome at a time in the order of
+        self.ordered_chroms, so that they can be properly analyzed by the FishersExactTest protocol.
+        :param index: The index of the treatment.
+        :param case_paths: The paths to the read count files of the cases.
+        :param control_paths: The paths to the read count files of the controls.
+        :return: Yields the output line of each variant, sorted by position within each chromosome.
         """
+        replicates = [(path, CASE_OFFSET) for path in case_paths] + [(path, CONTROL_OFFSET) for path in control_paths]
+        contig_offsets = [index_contigs(path) for path, counts_offset in replicates]
 
-        final_output = []
+        with ExitStack() as stack:
+            infiles = [stack.enter_context(open(path, 'rb')) for path, counts_offset in replicates]
 
-        for index, case_counts in enumerate(merged_cases):
-
-            control_counts = merged_controls[index]
-
-            # iterates through all of the chromosomes so that the output has the correct chromosome order.
             for chrom in self.ordered_chroms:
+                in_cases = any(chrom in offsets for offsets, (path, counts_offset) in zip(contig_offsets, replicates)
+                               if counts_offset == CASE_OFFSET)
+                in_controls = any(chrom in offsets for offsets, (path, counts_offset) in
+                                  zip(contig_offsets, replicates) if counts_offset == CONTROL_OFFSET)
 
-                # Checks that the chromosome is in either the cases or the controls.
-                if chrom in case_counts.keys() and chrom in control_counts.keys():
-
-                    # Uses sets to get a list of unique variant positions
-                    all_chrom_keys = list(set(case_counts[chrom].keys()) | set(control_counts[chrom].keys()))
-                    # Converts back into a list and sorts by position.
-                    all_chrom_keys.sort(key=itemgetter(1))
-
-                    for key in all_chrom_keys:
-
-                        # If variant is missing from cases, sets all counts to 0
-                        if key not in case_counts[chrom]:
-                            case_counts[chrom][key] = [0, 0, 0]
-
-                        # If variant is missing from controls, sets all counts to 0
-                        elif key not in control_counts[chrom]:
-                            control_counts[chrom][key] = [0, 0, 0]
-
-                        # Retrieves the allele counts
-                        chrom, pos, ref, alt = key
-                        case_alt_count, case_ref_count, case_total_count = case_counts[chrom][key]
-                        control_alt_count, control_ref_count, control_total_count = control_counts[chrom][key]
-
-                        new_line = [self.treatment_str.format(NUM=index), chrom, pos, ref, alt,
-                                    case_alt_count, case_ref_count, case_total_count,
-                                    control_alt_count, control_ref_count, control_total_count]
-
-                        final_output.append(new_line)
-
-                elif chrom not in case_counts.keys() and chrom not in control_counts.keys():
+                # Checks that the chromosome is in both the cases and the controls.
+                if not in_cases and not in_controls:
                     continue
-
-                # Handles an error edge case
-                else:
+                elif not in_cases or not in_controls:
                     print("Error: not the same number of chromosomes in each read count file.")
+                    continue
+
+                streams = [iter_contig_counts(path, infile, chrom, offsets[chrom], counts_offset)
+                           for (path, counts_offset), infile, offsets in zip(replicates, infiles, contig_offsets)
+                           if chrom in offsets]
+
+                # The variants at each position are summed over all of the replicates. Variants that are missing from
+                # the cases or the controls have counts of 0.
+                for pos, position_counts in groupby(heapq.merge(*streams, key=itemgetter(0)), key=itemgetter(0)):
+                    variants = {}
+                    for pos, ref, alt, counts_offset, alt_count, ref_count, total_count in position_counts:
+                        counts = variants.setdefault((ref, alt), [0, 0, 0, 0, 0, 0])
+                        counts[counts_offset] += alt_count
+                        counts[counts_offset + 1] += ref_count
+                        counts[counts_offset + 2] += total_count
 
-        return final_output
+                    for (ref, alt), counts in sorted(variants.items()):
+                        yield [self.treatment_str.format(NUM=index), chrom, pos, ref, alt] + counts
 
-    def read_count_reader(self, path, header=True):
+    def merge_tables(self):
         """
-        Produces a generator that parses the read count files.
+        Loads the read count files of every treatment into a ReadCountTable, and sums the replicates of the cases and
+        controls of each treatment.
+        :return: A ReadCountTable with the case and control count columns of the output, sorted in the same way as
+        the output of self.merge_treatment().
         """
-        with open(path) as infile:
+        count_columns = [column for column, dtype in self.schema[5:]]
+
+        tables = []
+        for index, (case_paths, control_paths) in enumerate(zip(self.cases, self.controls)):
+            treatment = self.treatment_str.format(NUM=index)
+            cases = [ReadCountTable.read_ase_read_counter(path, treatment).with_count_columns(count_columns,
+                                                                                               CASE_PREFIX)
+                     for path in case_paths]
+            controls = [ReadCountTable.read_ase_read_counter(path, treatment).with_count_columns(count_columns,
+                                                                                                  CONTROL_PREFIX)
+                        for path in control_paths]
+
+            # Checks that each chromosome is in both the cases and the controls.
+            case_chroms = set().union(*(table.chrom_names() for table in cases))
+            control_chroms = set().union(*(table.chrom_names() for table in controls))
+            for chrom in self.ordered_chroms:
+                if (chrom in case_chroms) != (chrom in control_chroms):
+                    print("Error: not the same number of chromosomes in each read count file.")
+
+            shared_chroms = case_chroms & control_chroms
+            tables.extend(table.select_chroms(shared_chroms) for table in cases + controls)
 
-            if header:
-                infile.readline()
+        return ReadCountTable.concatenate(tables).aggregate(self.ordered_chroms)
 
-            for line in infile:
-                line = line.strip().split()
-                chrom, position, ident, refAllele, altAllele, refCount, altCount, totalCount = line[:8]
-                yield chrom, int(position), refAllele, altAllele, int(refCount), int(altCount), int(totalCount)
+    def get_cache_signature(self):
+        # Both engines write the same output.
+        signature = super().get_cache_signature()
+        signature.pop('engine')
+        return signature
@@ -0,0 +1,254 @@
+"""
+AUTHOR: Matt Durrant
+
+This module contains a RunProcessStepSuper subclass called RunPysamASEReadCounter.
+
+This script counts the reference and alternate alleles of the reads that overlap each heterozygous site in a VCF file.
+It replaces the GATK ASEReadCounter step, which starts a java virtual machine with a large heap just to count bases.
+The read filters are taken from the GATK ASEReadCounter arguments in the custom config and are applied in the same
+order as GATK 3: overlapping mates are filtered from the pileup and deletions are removed first, and only then is each
+remaining read checked for an improper pair, a low mapping quality and a low base quality. The output has the same
+columns as the output of GATK ASEReadCounter. Each contig is counted in its own process.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+import pysam
+import vcf
+from mod.config.custom import GATKASEReadCounterCustomConfig
+from mod.misc.string_constants import *
+from mod.process_step_superclass import RunProcessStepSuper
+
+# The columns of the GATK ASEReadCounter output.
+ASE_READ_COUNTER_HEADER = ['contig', 'position', 'variantID', 'refAllele', 'altAllele', 'refCount', 'altCount',
+                           'totalCount', 'lowMAPQDepth', 'lowBaseQDepth', 'rawDepth', 'otherBases', 'improperPairs']
+
+# The ways that overlapping mates are counted, as in the GATK --countOverlapReadsType argument.
+COUNT_READS = 'COUNT_READS'
+COUNT_FRAGMENTS = 'COUNT_FRAGMENTS'
+COUNT_FRAGMENTS_REQUIRE_SAME_BASE = 'COUNT_FRAGMENTS_REQUIRE_SAME_BASE'
+
+# Sites that are closer than this are counted from a single pileup.
+SITE_WINDOW_GAP = 1000
+
+# The base and quality that GATK gives to a deletion in a pileup, which matter when overlapping mates are filtered.
+DELETION_BASE = 'D'
+DELETION_QUAL = 16
+
+# The quality of the bases of reads without base qualities.
+MISSING_QUAL = 0
+
+
+def filter_pileup(pileup_column, filters):
+    """
+    Filters the overlapping mates and the deletions from a pileup column, as GATK ASEReadCounter filters its pileup
+    before it counts. When fragments are counted, the mate with the higher base quality is kept, or the first mate if
+    they are equal, and with COUNT_FRAGMENTS_REQUIRE_SAME_BASE both mates are discarded if their bases differ.
+    :param pileup_column: A pysam PileupColumn at the site.
+    :param filters: The filters, as returned by RunPysamASEReadCounter.get_filters().
+    :return: A list of (read, base, quality) tuples of the reads that remain.
+    """
+    elements = []
+    fragments = {}
+
+    for pileup_read in pileup_column.pileups:
+        read = pileup_read.alignment
+        if read.is_unmapped or read.is_secondary or read.is_qcfail:
+            continue
+        if read.is_duplicate and not filters['count_duplicates']:
+            continue
+
+        # As in GATK, reference skips are never part of a pileup.
+        if pileup_read.is_refskip:
+            continue
+        if pileup_read.is_del:
+            element = (read, DELETION_BASE, DELETION_QUAL)
+        else:
+            qualities = read.query_qualities
+            quality = qualities[pileup_read.query_position] if qualities is not None else MISSING_QUAL
+            element = (read, read.query_sequence[pileup_read.query_position], quality)
+
+        if filters['overlap_type'] == COUNT_READS:
+            elements.append(element)
+            continue
+
+        existing = fragments.get(read.query_name)
+        if existing is None:
+            fragments[read.query_name] = element
+        elif filters['overlap_type'] == COUNT_FRAGMENTS_REQUIRE_SAME_BASE and existing[1] != element[1]:
+            del fragments[read.query_name]
+        elif existing[2] < element[2]:
+            fragments[read.query_name] = element
+
+    if filters['overlap_type'] != COUNT_READS:
+        elements = list(fragments.values())
+
+    return [element for element in elements if element[1] != DELETION_BASE]
+
+
+def count_site(pileup_column, ref, alt, filters):
+    """
+    Counts the alleles of the reads in a pileup column, following GATK ASEReadCounter. The raw depth is the number of
+    reads that remain once the overlapping mates and the deletions have been filtered.
+    :param pileup_column: A pysam PileupColumn at the site.
+    :param ref: The reference allele.
+    :param alt: The alternate allele.
+    :param filters: The filters, as returned by RunPysamASEReadCounter.get_filters().
+    :return: The counts of the GATK ASEReadCounter columns from refCount to improperPairs.
+    """
+    raw_depth = low_mapq = low_baseq = improper_pairs = 0
+    ref_count = alt_count = other_bases = 0
+
+    for read, base, quality in filter_pileup(pileup_column, filters):
+        raw_depth += 1
+        if read.is_paired and (read.mate_is_unmapped or not read.is_proper_pair):
+            improper_pairs += 1
+            continue
+        if read.mapping_quality < filters['min_mapping_quality']:
+            low_mapq += 1
+            continue
+        if quality < filters['min_base_quality']:
+            low_baseq += 1
+            continue
+
+        if base == ref:
+            ref_count += 1
+        elif base == alt:
+            alt_count += 1
+        else:
+            other_bases += 1
+
+    return [ref_count, alt_count, ref_count + alt_count, low_mapq, low_baseq, raw_depth, other_bases, improper_pairs]
+
+
+def count_contig(input_bam, contig, sites, filters):
+    """
+    Counts the alleles at all of the sites on one contig. This runs in a worker process, which opens its own BAM file.
+    :param input_bam: The path to the indexed BAM file.
+    :param contig: The contig of the sites.
+    :param sites: A list of (position, variant_id, ref, alt) tuples sorted by position, with one-based positions.
+    :param filters: The filters, as returned by RunPysamASEReadCounter.get_filters().
+    :return: A list of output rows in the GATK ASEReadCounter layout.
+    """
+    rows = []
+    with pysam.AlignmentFile(input_bam, 'rb') as bamfile:
+        if contig not in bamfile.references:
+            return rows
+
+        # Groups nearby sites into windows, so that each window is read from the BAM only once.
+        windows = []
+        for site in sites:
+            if windows and site[0] - windows[-1][-1][0] <= SITE_WINDOW_GAP:
+                windows[-1].append(site)
+            else:
+                windows.append([site])
+
+        for window in windows:
+            window_sites = {site[0]: site for site in window}
+            columns = bamfile.pileup(contig, window[0][0] - 1, window[-1][0], truncate=True, stepper='nofilter',
+                                     ignore_overlaps=False, ignore_orphans=False, min_base_quality=0,
+                                     max_depth=10 ** 8)
+
+            for pileup_column in columns:
+                site = window_sites.pop(pileup_column.reference_pos + 1, None)
+                if site is None:
+                    continue
+
+                # As in GATK, sites that are not covered by any reads that pass the read filters are not reported.
+                position, variant_id, ref, alt = site
+                counts = count_site(pileup_column, ref, alt, filters)
+                if counts[5] and counts[2] >= filters['min_depth']:
+                    rows.append([contig, position, variant_id, ref, alt] + counts)
+
+    return rows
+
+
+class RunPysamASEReadCounter(RunProcessStepSuper):
+    def __init__(self, output_dir, input_bam, input_sites_vcf, output_counts=None, logger=None, processes=None):
+        """
+        The constructor for a RunPysamASEReadCounter object.
+        :param output_dir: The output directory.
+        :param input_bam: The indexed BAM file to count alleles in.
+        :param input_sites_vcf: The VCF of heterozygous sites to count.
+        :param output_counts: The name of the output read count table.
+        :param logger: The logger for tracking progress.
+        :param processes: The number of contigs that are counted at once. Defaults to the number of cores.
+        """
+        name = 'PysamASEReadCounter'
+        output_dir = output_dir
+
+        input_file = input_bam
+        # The output is named like the output of GATK ASEReadCounter, so that either step can be used.
+        output_file = output_counts if output_counts else os.path.basename(input_bam).split(DOT)[0] + DOT + tsv_str
+
+        log_name = 'pysam_ase_read_counter.json'
+        logger = logger
+
+        super().__init__(name, output_dir, input_file, output_file, log_name, logger)
+
+        self.input_sites_vcf = input_sites_vcf
+        self.processes = processes if processes else os.cpu_count()
+
+        self.filters = self.get_filters(GATKASEReadCounterCustomConfig().args)
+
+    def get_filters(self, args):
+        """
+        Translates the GATK ASEReadCounter arguments into read filters.
+        :param args: The (flag, arg) tuples of the GATK ASEReadCounter custom config.
+        :return: A dictionary of the filters.
+        """
+        filters = {'min_depth': -1, 'min_base_quality': 0, 'min_mapping_quality': 0, 'count_duplicates': False,
+                   'overlap_type': COUNT_FRAGMENTS_REQUIRE_SAME_BASE}
+
+        for flag, arg in args:
+            if flag in ('-minDepth', '--minDepthOfNonFilteredBase'):
+                filters['min_depth'] = int(arg)
+            elif flag in ('-mbq', '--minBaseQuality'):
+                filters['min_base_quality'] = int(arg)
+            elif flag in ('-mmq', '--minMappingQuality'):
+                filters['min_mapping_quality'] = int(arg)
+            elif flag in ('-overlap', '--countOverlapReadsType'):
+                filters['overlap_type'] = arg
+            # Disabling the duplicate read filter means that duplicate reads are counted.
+            elif flag in ('-drf', '--disable_read_filter') and arg == 'DuplicateRead':
+                filters['count_duplicates'] = True
+
+        return filters
+
+    def process(self):
+        """
+        Reads the sites from the VCF, counts each contig in a separate process, and writes the counts in VCF order.
+        """
+        sites = self.read_sites()
+
+        with ProcessPoolExecutor(max_workers=max(1, min(self.processes, len(sites)))) as executor:
+            results = executor.map(count_contig, [self.input_file] * len(sites), list(sites),
+                                   list(sites.values()), [self.filters] * len(sites))
+
+            with open(os.path.join(self.output_dir, self.output), w) as outfile:
+                outfile.write(TAB.join(ASE_READ_COUNTER_HEADER) + NL)
+                for rows in results:
+                    for row in rows:
+                        outfile.write(TAB.join(map(str, row)) + NL)
+
+    def read_sites(self):
+        """
+        Reads the biallelic SNPs from the sites VCF, the only sites that GATK ASEReadCounter counts.
+        :return: An ordered dictionary of contigs to lists of (position, variant_id, ref, alt) tuples.
+        """
+        sites = {}
+        for rec in vcf.Reader(filename=self.input_sites_vcf):
+            if len(rec.ALT) != 1 or len(rec.REF) != 1 or rec.ALT[0] is None or len(str(rec.ALT[0])) != 1:
+                continue
+            sites.setdefault(rec.CHROM, []).append((rec.POS, rec.ID if rec.ID else DOT, rec.REF, str(rec.ALT[0])))
+        return sites
+
+    def get_input_paths(self):
+        return [self.input_file, self.input_sites_vcf]
+
+    def get_cache_signature(self):
+        # The filters change the counts, the number of processes does not.
+        signature = super().get_cache_signature()
+        signature.pop('processes')
+        signature['filters'] = self.filters
+        return signature
@@ -8,17 +8,227 @@ second input. It then retrieves all reads from the BAM file that overlap a varia
 distance between the two paired reads. One can then compare the mapping distance distributions of the reference and the
 alternate allele visually by plotting them. If the alleles differ drastically in their read mapping distance
 distributions, it is an indication that allele-specific splicing may be confounding the analysis.
+
+The mapping distance is calculated from the mate coordinates that are stored in each read, rather than by looking up
+each mate in the BAM file. The start of the mate is in the read record, and the end of the mate is calculated from its
+CIGAR string in the MC tag. The mates of the reads without an MC tag are read from the BAM file together, once for each
+window of variants.
+
+The variants of each contig are sorted and grouped into windows of nearby variants. The reads of each window are read
+from the BAM file with a single pileup, and only the columns at the variants are kept, so that htslib filters the reads
+and lowers the base qualities of overlapping mates exactly as it did when the variants were read one at a time. The
+windows are spread over a pool of processes, which each open their own BAM file.
+
+The distances can be written as a columnar table instead of a TSV file, with the chromosome, alleles and allele type
+dictionary encoded and the positions and distances stored as integers, which is much smaller than the TSV file and can
+be loaded for plotting without parsing any text.
 """
 
+import re
 import pysam, vcf
 import os
+import numpy as np
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from mod.misc.columnar import open_table, table_suffix, DICTIONARY
 from mod.misc.string_constants import *
 
 from mod.process_step_superclass import RunProcessStepSuper
 
+# The tag that holds the CIGAR string of the mate.
+MATE_CIGAR_TAG = 'MC'
+
+# The CIGAR operations that consume the reference.
+CIGAR_PATTERN = re.compile(r'(\d+)([MIDNSHP=X])')
+REFERENCE_OPERATIONS = set('MDN=X')
+
+# Mates that start closer together than this are read from the BAM file in a single fetch.
+MATE_FETCH_GAP = 10000
+
+# Sites within this distance of the first site of a window are read from the BAM file in a single pileup. A window also
+# ends at a larger gap between sites than WINDOW_GAP, so that the reads between distant sites are not read.
+WINDOW_SIZE = 1000000
+WINDOW_GAP = 10000
+
+# The BAM file of a worker process, which is opened once by open_worker_bam().
+_worker_bamfile = None
+
+# The reference lengths of the CIGAR strings that have been seen, as there are few distinct CIGAR strings in a BAM file.
+_cigar_reference_lengths = {}
+
+
+def cigar_reference_length(cigar):
+    """
+    :param cigar: A CIGAR string.
+    :return: The number of reference bases the CIGAR string covers.
+    """
+    try:
+        return _cigar_reference_lengths[cigar]
+    except KeyError:
+        length = sum(int(count) for count, operation in CIGAR_PATTERN.findall(cigar)
+                     if operation in REFERENCE_OPERATIONS)
+        _cigar_reference_lengths[cigar] = length
+        return length
+
+
+def build_mate_index(bamfile, reads):
+    """
+    Finds the mates of many reads at once. The mate start positions are grouped into clusters, and each cluster is
+    read from the BAM file with a single fetch.
+    :param bamfile: The indexed BAM file.
+    :param reads: The reads to find the mates of.
+    :return: A dictionary of (read name, mate is read1) to the (start, end) of the mate.
+    """
+    wanted = defaultdict(dict)
+    for read in reads:
+        wanted[read.next_reference_name][(read.query_name, not read.is_read1)] = read.next_reference_start
+
+    mate_index = {}
+    for contig, mates in wanted.items():
+        starts = sorted(set(mates.values()))
+
+        clusters = [[starts[0], starts[0]]]
+        for start in starts[1:]:
+            if start - clusters[-1][1] > MATE_FETCH_GAP:
+                clusters.append([start, start])
+            else:
+                clusters[-1][1] = start
+
+        for cluster_start, cluster_end in clusters:
+            for mate in bamfile.fetch(contig, cluster_start, cluster_end + 1):
+                if mate.is_secondary or mate.is_supplementary or mate.is_unmapped:
+                    continue
+                key = (mate.query_name, mate.is_read1)
+                if mates.get(key) == mate.reference_start:
+                    mate_index[key] = (mate.reference_start, mate.reference_end)
+
+    return mate_index
+
+
+def mate_span(read, mate_index):
+    """
+    :param read: A paired read with a mapped mate.
+    :param mate_index: The mates of the reads without an MC tag, as returned by build_mate_index().
+    :return: The (start, end) of the mate of the read, or None if the mate was not found.
+    """
+    if read.has_tag(MATE_CIGAR_TAG):
+        return read.next_reference_start, read.next_reference_start + \
+            cigar_reference_length(read.get_tag(MATE_CIGAR_TAG))
+    return mate_index.get((read.query_name, not read.is_read1))
+
+
+def open_worker_bam(input_bam):
+    """
+    Opens the BAM file of a worker process, which is read by each window that the process is given.
+    :param input_bam: The path to the indexed BAM file.
+    """
+    global _worker_bamfile
+    _worker_bamfile = pysam.AlignmentFile(input_bam, 'rb')
+
+
+def group_windows(sites):
+    """
+    Groups sorted sites into windows of nearby sites.
+    :param sites: A list of sites sorted by position, with the position first.
+    :return: A list of the windows, each a list of sites.
+    """
+    windows = []
+    for site in sites:
+        if windows and site[0] - windows[-1][0][0] < WINDOW_SIZE and site[0] - windows[-1][-1][0] <= WINDOW_GAP:
+            windows[-1].append(site)
+        else:
+            windows.append([site])
+    return windows
+
+
+def read_window(bamfile, contig, positions):
+    """
+    Reads all of the reads that overlap a window of sites with a single pileup, and keeps the pileup columns at the
+    sites. The pileup filters the reads and changes the base qualities of overlapping mates in the same way as when each
+    site is read with its own pileup.
+    :param bamfile: The indexed BAM file.
+    :param contig: The contig of the sites.
+    :param positions: The sorted, distinct zero-based positions of the sites.
+    :return: A dictionary of each position to a list of the (read, base) tuples of the reads that have a base there.
+    Reads with a deletion or a skipped region at a position do not have a base there.
+    """
+    site_reads = {position: [] for position in positions}
+
+    for pileupcolumn in bamfile.pileup(contig, positions[0], positions[-1] + 1, truncate=True):
+        reads = site_reads.get(pileupcolumn.reference_pos)
+        if reads is None:
+            continue
+
+        for pileupread in pileupcolumn.pileups:
+            if not pileupread.is_del and not pileupread.is_refskip:
+                read = pileupread.alignment
+                reads.append((read, read.query_sequence[pileupread.query_position]))
+
+    return site_reads
+
+
+def calc_mapping_distance(read1, mate_start, mate_end):
+    """
+    Calculates the read distance between two paired reads
+    :param read1: The first read of the pair.
+    :param mate_start: The reference start of its mate.
+    :param mate_end: The reference end of its mate.
+    """
+    reference_positions = [read1.reference_start, read1.reference_end - 1, mate_start, mate_end - 1]
+    distance = max(reference_positions) - min(reference_positions)
+    return distance
+
+
+def window_distances(contig, sites):
+    """
+    Retrieves the reference and alternate allele read pair mapping distances of a window of sites. This runs in a
+    worker process, which reads the BAM file opened by open_worker_bam().
+    :param contig: The contig of the sites.
+    :param sites: A list of (position, ref, alt) tuples sorted by position, with one-based positions.
+    :return: A list with a (ref_distances, alt_distances) tuple of sorted distances for each site.
+    """
+    bamfile = _worker_bamfile
+    if contig not in bamfile.references:
+        return [([], []) for _ in sites]
+
+    positions = sorted({position - 1 for position, ref, alt in sites})
+    site_reads = read_window(bamfile, contig, positions)
+
+    # Only reads whose base is one of the alleles, and whose mate is mapped, have a mapping distance.
+    allele_reads = []
+    for position, ref, alt in sites:
+        allele_reads.append([(read1, allele) for read1, allele in site_reads[position - 1]
+                             if (allele == ref or allele == alt) and read1.is_paired and not read1.mate_is_unmapped])
+
+    # The mates of the reads without an MC tag are all read from the BAM file at once.
+    mate_index = build_mate_index(bamfile, [read1 for reads in allele_reads for read1, allele in reads
+                                            if not read1.has_tag(MATE_CIGAR_TAG)])
+
+    distances = []
+    for (position, ref, alt), reads in zip(sites, allele_reads):
+        ref_read_distances = []
+        alt_read_distances = []
+
+        for read1, allele in reads:
+            read2 = mate_span(read1, mate_index)
+            if read2 is None:
+                continue
+            distance = calc_mapping_distance(read1, *read2)
+
+            if distance:
+                if allele == ref:
+                    ref_read_distances.append(distance)
+                elif allele == alt:
+                    alt_read_distances.append(distance)
+
+        distances.append((sorted(ref_read_distances), sorted(alt_read_distances)))
+
+    return distances
+
 
 class RunRetrieveMappingDistances(RunProcessStepSuper):
-    def __init__(self, output_dir, input_bam, input_vcf, output_file=None, logger=None):
+    def __init__(self, output_dir, input_bam, input_vcf, output_file=None, logger=None, processes=None,
+                 columnar=False):
         """
         This is the constructor for a RunRetrieveMappingDistances object.
         :param output_dir: The output directory.
@@ -26,6 +236,8 @@ class RunRetrieveMappingDistances(RunProcessStepSuper):
         :param input_vcf: The input VCF.
         :param output_file:  The output file.
         :param logger: The logger for tracking progress.
+        :param processes: The number of windows of variants that are read at once. Defaults to the number of cores.
+        :param columnar: Writes the distances as a columnar table, rather than a TSV file.
         """
 
         name = 'RetrieveMappingDistances'
@@ -37,93 +249,68 @@ class RunRetrieveMappingDistances(RunProcessStepSuper):
         log_name = 'retrieve_mapping_distances.json'
         logger = logger
 
-        super().__init__(name, output_dir, input_file, output_file, log_name, logger)
+        super().__init__(name, output_dir, input_file, output_file, log_name, logger,
+                         output_suffix=table_suffix(columnar))
 
         self.input_vcf = input_vcf
-        self.bam_index_correction = -1
+        self.processes = processes if processes else os.cpu_count()
+        self.columnar = columnar
         self.ref_s = 'REF'
         self.alt_s = 'ALT'
 
-        self.out_header = TAB.join(['CHROM', 'POS', 'REF', 'ALT', 'ALLELE', 'MAPPING_DISTANCE'])
+        self.out_schema = [('CHROM', DICTIONARY), ('POS', np.int64), ('REF', DICTIONARY), ('ALT', DICTIONARY),
+                           ('ALLELE', DICTIONARY), ('MAPPING_DISTANCE', np.int64)]
 
     def process(self):
         """
         This runs the main process script to retrieve all of the mapping distances for ll reads that overlap with
-        variants in the VCF file
+        variants in the VCF file. The windows of variants are read in separate processes, and the distances are written
+        in the order of the sorted variants of each contig.
         """
-        bam_reader = pysam.AlignmentFile(self.input_file, "rb")
-        vcf_reader = vcf.Reader(filename=self.input_vcf)
+        windows = [(contig, window) for contig, sites in self.read_sites().items() for window in group_windows(sites)]
 
-        with open(os.path.join(self.output_dir, self.output), w) as outfile:
+        with ProcessPoolExecutor(max_workers=max(1, min(self.processes, len(windows))), initializer=open_worker_bam,
+                                 initargs=(self.input_file,)) as executor:
+            chunksize = max(1, len(windows) // (self.processes * 4))
+            results = executor.map(window_distances, [contig for contig, window in windows],
+                                   [window for contig, window in windows], chunksize=chunksize)
 
-            outfile.write(self.out_header + NL)
+            with open_table(os.path.join(self.output_dir, self.output), self.out_schema, self.columnar) as outfile:
 
-            for snp in vcf_reader:
-                chrom, pos, ref, alt = snp.CHROM, snp.POS, snp.REF, snp.ALT[0]
-                ref_distances, alt_distances = self.retrieve_mapping_distances(chrom, pos, ref, alt, bam_reader)
+                for (contig, window), distances in zip(windows, results):
+                    for (pos, ref, alt), (ref_distances, alt_distances) in zip(window, distances):
 
-                for dist in ref_distances:
-                    outline = TAB.join(map(str, [chrom, pos, ref, alt, self.ref_s, dist]))
-                    outfile.write(outline + NL)
+                        for dist in ref_distances:
+                            outfile.write((contig, pos, ref, alt, self.ref_s, dist))
 
-                for dist in alt_distances:
-                    outline = TAB.join(map(str, [chrom, pos, ref, alt, self.alt_s, dist]))
-                    outfile.write(outline + NL)
+                        for dist in alt_distances:
+                            outfile.write((contig, pos, ref, alt, self.alt_s, dist))
 
-    def retrieve_mapping_distances(self, chrom, position, ref, alt, bamfile):
+    def read_sites(self):
         """
-        Parses through the bam file to retrieve all of the referencae and alternate allele read pair mapping distances
-        that overlap the given position
-        :param chrom: The variant chromosome.
-        :param position: The variant position.
-        :param ref: The referance allele.
-        :param alt: The alternate allele.
-        :param bamfile: The indexed bam file.
-        :return:
+        Reads the variants from the VCF.
+        :return: An ordered dictionary of contigs to lists of (position, ref, alt) tuples sorted by position, with
+        one-based positions.
         """
-        position += self.bam_index_correction
-        ref_read_distances = []
-        alt_read_distances = []
-
-        # Gets the pileup columns covering the read.
-        for pileupcolumn in bamfile.pileup(chrom, position, position + 1, truncate=True):
-
-            # Gets each of the reads in each pileup column.
-            for pileupread in pileupcolumn.pileups:
-
-                # Makes sure the read meets some important filters.
-                if not pileupread.is_del and not pileupread.is_refskip:
+        sites = {}
+        for snp in vcf.Reader(filename=self.input_vcf):
+            sites.setdefault(snp.CHROM, []).append((snp.POS, snp.REF, str(snp.ALT[0])))
 
-                    read1 = pileupread.alignment
-                    allele = read1.query_sequence[pileupread.query_position]
+        for contig_sites in sites.values():
+            contig_sites.sort(key=lambda site: site[0])
+        return sites
 
-                    # Gets the raad mate pair if it exists.
-                    try:
-                        read2 = bamfile.mate(read1)
-                    except ValueError:
-                        continue
-
-                    distance = self.calc_mapping_distance(read1, read2)
-
-                    if distance:
-                        if allele == ref:
-                            ref_read_distances.append(distance)
-                        elif allele == alt:
-                            alt_read_distances.append(distance)
-
-        return sorted(ref_read_distances), sorted(alt_read_distances)
-
-    def calc_mapping_distance(self, read1, read2):
+    def get_input_paths(self):
         """
-        Calculates the read distance between two paired reads
+        :return: The input BAM and VCF paths.
         """
-        if read1.is_unmapped or read2.is_unmapped:
-            return None
-        else:
-            reference_positions = [read1.reference_start, read1.reference_end - 1,
-                                   read2.reference_start, read2.reference_end - 1]
-            distance = max(reference_positions) - min(reference_positions)
-            return distance
+        return [self.input_file, self.input_vcf]
+
+    def get_cache_signature(self):
+        # The number of processes does not change the output.
+        signature = super().get_cache_signature()
+        signature.pop('processes')
+        return signature
 
     def complementary_base(self, base):
         """
@@ -4,25 +4,93 @@ AUTHOR: Matt Durrant
 This module contains a RunProcessStepSuper subclass called RunVcfFilterASE.
 
 This script takes a VCF file as input, and it keeps only variants that are biallelic, heterozygous single nucleotide
-variants (SNVs). These scripts are used fro downstream ASE analysis. This script uses the PyVCF object-oriented module
-to parse the VCF file.
+variants (SNVs). These scripts are used fro downstream ASE analysis. This script reads the VCF file as raw text, rather
+than with PyVCF. The chromosome, allele and indel filters are decided from the text of the columns, the genotypes are
+only decoded for the records that pass those filters, and the records that are kept are written out unchanged.
+
+If the input VCF is bgzipped and indexed with tabix, each contig is filtered in its own process. The filtered contigs
+are concatenated in the order of the contigs in the header.
 """
 
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from os.path import join
-import vcf
 from mod.misc.string_constants import *
+from mod.misc.vcf_text import open_vcf, open_vcf_output, index_vcf, split_record, is_indel, iter_gt_types, \
+    is_indexed, read_header, indexed_contigs, open_tabix, fetch_records, concatenate_parts, HEADER_PREFIX, CHROM_COL, \
+    REF_COL, ALT_COL, INFO_COL, COMMA_BYTES, HOM_REF, HET, HOM_ALT, GZ_SUFFIX, TABIX_SUFFIX
 from mod.process_step_superclass import RunProcessStepSuper
 
 
+def passes_filters(line, filters):
+    """
+    Filters a single VCF record. The genotypes are only decoded if the record passes the other filters.
+    :param line: The VCF record as a bytes string.
+    :param filters: The filters, as returned by RunVcfFilterASE.get_filters().
+    :return: True if the record passes the filters.
+    """
+    columns = split_record(line)
+
+    # If the autosomal_only filter exists and it is NOT an autosomal chromosome, it skips the variant.
+    if filters['autosomal_chroms'] is not None and columns[CHROM_COL] not in filters['autosomal_chroms']:
+        return False
+
+    alts = columns[ALT_COL].split(COMMA_BYTES)
+
+    # If the biallelic_only filter is set and the record is not biallelic, it skips.
+    if filters['biallelic_only'] and len(alts) != 1:
+        return False
+
+    # Skips if no indels is on and the record is an indel
+    if filters['no_indels'] and is_indel(columns[REF_COL], alts, columns[INFO_COL]):
+        return False
+
+    # If neither genotype filter is on, the variant passes.
+    if not filters['min_one_het'] and not filters['hom_ref_hom_alt_is_het']:
+        return True
+
+    # The genotypes are read until one of the genotype filters is passed.
+    hom_ref = hom_alt = False
+    for gt_type in iter_gt_types(columns):
+        if gt_type == HET and filters['min_one_het']:
+            return True
+        elif filters['hom_ref_hom_alt_is_het']:
+            hom_ref = hom_ref or gt_type == HOM_REF
+            hom_alt = hom_alt or gt_type == HOM_ALT
+            if hom_ref and hom_alt:
+                return True
+
+    return False
+
+
+def filter_contig(input_vcf, contig, filters, part_path, bgzip):
+    """
+    Filters the records of one contig of an indexed VCF. This runs in a worker process, which opens its own VCF file.
+    :param input_vcf: The path to the bgzipped and indexed VCF file.
+    :param contig: The contig to filter.
+    :param filters: The filters, as returned by RunVcfFilterASE.get_filters().
+    :param part_path: The path to write the records that pass the filters to.
+    :param bgzip: Whether to compress the part with bgzip.
+    :return: The path to the part.
+    """
+    with open_tabix(input_vcf) as tabix_file, open_vcf_output(part_path, bgzip) as outfile:
+        for line in fetch_records(tabix_file, contig):
+            if passes_filters(line, filters):
+                outfile.write(line)
+    return part_path
+
+
 class RunVcfFilterASE(RunProcessStepSuper):
     """
     This class takes a VCF file as input, and it keeps only variants that are biallelic, heterozygous single nucleotide
-    variants (SNVs). These scripts are used fro downstream ASE analysis. This class uses the PyVCF object-oriented module
-    to parse the VCF file.
+    variants (SNVs). These scripts are used fro downstream ASE analysis. This class reads the VCF file as raw text and
+    writes the variants that are kept unchanged.
     """
 
     def __init__(self, output_dir, input_vcf, output_vcf=None, min_one_het=True, hom_ref_hom_alt_is_het=True,
-                 autosomal_only=True, biallelic_only=True, no_indels=True, logger=None):
+                 autosomal_only=True, biallelic_only=True, no_indels=True, logger=None, bgzip=False, processes=None):
         """
         This is the constructor for a RunVcfFilterASE object.
         :param output_dir: The output directory.
@@ -34,6 +102,9 @@ class RunVcfFilterASE(RunProcessStepSuper):
         :param biallelic_only: Filters to only biallelic variants
         :param no_indels: Filters out the indels.
         :param logger: Logger to track progress.
+        :param bgzip: Compresses the output VCF with bgzip and indexes it with tabix.
+        :param processes: The number of contigs of an indexed input VCF that are filtered at once. Defaults to the
+        number of cores.
         """
         name = 'VCFFilterASE'
         output_dir = output_dir
@@ -44,66 +115,94 @@ class RunVcfFilterASE(RunProcessStepSuper):
         log_name = 'filter_vcf.json'
         logger = logger
 
-        super().__init__(name, output_dir, input_file, output_file, log_name, logger, output_suffix='vcf')
+        super().__init__(name, output_dir, input_file, output_file, log_name, logger,
+                         output_suffix=vcf_str + GZ_SUFFIX if bgzip else vcf_str)
 
         self.min_one_het = min_one_het
         self.hom_ref_hom_alt_is_het = hom_ref_hom_alt_is_het
         self.autosomal_only = autosomal_only
         self.biallelic_only = biallelic_only
         self.no_indels = no_indels
+        self.bgzip = bgzip
+        self.processes = processes if processes else os.cpu_count()
 
         self.autosomal_chroms = [chr1, chr2, chr3, chr4, chr5, chr6, chr7, chr8, chr9, chr10, chr11, chr12, chr13,
                                  chr14, chr15, chr16, chr17, chr18, chr19, chr20, chr21, chr22]
 
+    def get_filters(self):
+        """
+        :return: A dictionary of the filters, as used by passes_filters().
+        """
+        # Autosomes are accepted with or without the chr prefix
+        autosomal_chroms = None
+        if self.autosomal_only:
+            autosomal_chroms = {c.encode() for c in self.autosomal_chroms} | \
+                               {c.strip('chr').encode() for c in self.autosomal_chroms}
+
+        return {'autosomal_chroms': autosomal_chroms, 'biallelic_only': self.biallelic_only,
+                'no_indels': self.no_indels, 'min_one_het': self.min_one_het,
+                'hom_ref_hom_alt_is_het': self.hom_ref_hom_alt_is_het}
+
     def process(self):
         """
         Processes and filters the VCF
         """
-        reader = vcf.Reader(filename=self.input_file)
-        writer = vcf.Writer(open(join(self.output_dir, self.output), 'w'), reader)
-
-        for rec in reader:
-            # If the autosomal_only filter exists and it is NOT an autosomal chromosome, it skips the variant.
-            if self.autosomal_only and rec.CHROM not in self.autosomal_chroms and \
-                            rec.CHROM not in [c.strip('chr') for c in self.autosomal_chroms]:
-                continue
-
-            # If the self.biallelic_only filter is set and the record is not biallelic, it skips.
-            elif self.biallelic_only and not self.is_biallelic(rec):
-                continue
-
-            # Skips if no indels is on and the record is an indel
-            elif self.no_indels and rec.is_indel:
-                continue
-
-            # Writes the variant if min_one_het is on and it contains at least one het
-            elif self.min_one_het and self.contains_min_one_het(rec):
-                writer.write_record(rec)
-                continue
-
-            # Writes the ariant if hom_ref_hom_alt_is_het is on and it passes the filter
-            elif self.hom_ref_hom_alt_is_het and self.contains_both_homs(rec):
-                writer.write_record(rec)
-                continue
-
-            # If it gets through all the filters, write the variant to a file.
-            else:
-                writer.write_record(rec)
-
-    def is_biallelic(self, record):
-        if len(record.ALT) == 1:
-            return True
+        if self.processes > 1 and is_indexed(self.input_file):
+            self.process_contigs()
         else:
-            return False
+            self.process_stream()
 
-    def contains_min_one_het(self, record):
-        if len(record.get_hets()) >= 1:
-            return True
-        else:
-            return False
+        if self.bgzip:
+            index_vcf(join(self.output_dir, self.output))
 
-    def contains_both_homs(self, record):
-        if len(record.get_hom_refs()) >= 1 and len(record.get_hom_alts()) >= 1:
-            return True
-        else:
-            return False
+    def process_stream(self):
+        """
+        Filters the VCF from start to end in a single process.
+        """
+        filters = self.get_filters()
+        output_path = join(self.output_dir, self.output)
+
+        with open_vcf(self.input_file) as infile, open_vcf_output(output_path, self.bgzip) as outfile:
+            for line in infile:
+                # The header is copied, as are the variants that pass the filters
+                if line.startswith(HEADER_PREFIX) or line.strip() and passes_filters(line, filters):
+                    outfile.write(line)
+
+    def process_contigs(self):
+        """
+        Filters each contig of an indexed VCF in a separate process, and concatenates the filtered contigs in the order
+        of the header.
+        """
+        filters = self.get_filters()
+        header = read_header(self.input_file)
+
+        # Contigs that are not autosomes do not need to be read at all.
+        contigs = [contig for contig in indexed_contigs(self.input_file, header)
+                   if filters['autosomal_chroms'] is None or contig.encode() in filters['autosomal_chroms']]
+
+        parts_dir = tempfile.mkdtemp(prefix='.filter_vcf_', dir=self.output_dir)
+        try:
+            header_path = join(parts_dir, 'header')
+            with open_vcf_output(header_path, self.bgzip) as outfile:
+                outfile.write(b''.join(header))
+
+            part_paths = [join(parts_dir, 'part_%06d' % i) for i in range(len(contigs))]
+            with ProcessPoolExecutor(max_workers=max(1, min(self.processes, len(contigs)))) as executor:
+                part_paths = list(executor.map(filter_contig, [self.input_file] * len(contigs), contigs,
+                                               [filters] * len(contigs), part_paths, [self.bgzip] * len(contigs)))
+
+            concatenate_parts([header_path] + part_paths, join(self.output_dir, self.output), self.bgzip)
+        finally:
+            shutil.rmtree(parts_dir, ignore_errors=True)
+
+    def get_output_paths(self):
+        output_paths = super().get_output_paths()
+        if self.bgzip:
+            output_paths.append(output_paths[0] + TABIX_SUFFIX)
+        return output_paths
+
+    def get_cache_signature(self):
+        # The number of processes does not change the output.
+        signature = super().get_cache_signature()
+        signature.pop('processes')
+        return signature
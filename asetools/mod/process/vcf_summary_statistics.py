@@ -6,23 +6,209 @@ This module contains a RunProcessStepSuper subclass called RunVcfSummaryStatisti
 This script produces useful VCF summary, including the total number of indels, SNVs, multiallelic sites, and biallelic
 sites. This is used at the end of the RNAseq variant calling pipeline to process the VCF files produced by calling
 system applications with the subprocess module.
+
+The VCF file is read as raw text in chunks of records. The REF and ALT columns of each chunk are loaded into NumPy
+arrays, and the records are classified and counted with vectorized operations. If the VCF file is bgzipped and indexed
+with tabix, each contig is summarized in its own process. The summary is written as a text report, and also as JSON and
+as a TSV table.
 """
 
-import vcf
+import json
 import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import numpy as np
 from mod.misc.string_constants import *
+from mod.misc.vcf_text import open_vcf, open_tabix, fetch_records, is_indexed, is_indel, split_record, \
+    HEADER_PREFIX, TAB_BYTES, COMMA_BYTES, CHROM_COL, REF_COL, ALT_COL, INFO_COL
 from mod.process_step_superclass import RunProcessStepSuper
-from collections import defaultdict
+
+# The number of records that are loaded into NumPy arrays at once.
+CHUNK_RECORDS = 100000
+
+# The counts of each chromosome, in the order they are reported.
+TOTAL, SNP, INDEL, BIALLELIC, MULTIALLELIC = range(5)
+STATISTICS = ['total', 'snp', 'indel', 'biallelic', 'multiallelic']
+
+# The alternate alleles of SNPs, as in PyVCF.
+SNP_BASES = np.zeros(256, dtype=bool)
+SNP_BASES[np.frombuffer(b'ACGTN*', dtype=np.uint8)] = True
+
+COMMA = ord(COMMA_BYTES)
+MISSING = ord(DOT)
+
+
+class VcfSummary:
+    """
+    The counts of the records, and of the nucleotide changes of the SNVs, of each chromosome in a VCF file.
+    """
+    def __init__(self):
+        # The index of each chromosome, in the order they were first seen.
+        self.chroms = {}
+        self.stats = np.zeros((0, len(STATISTICS)), dtype=np.int64)
+
+        # Nucleotide changes are encoded as REF byte * 256 + ALT byte, and kept in the order they were first seen.
+        self.change_order = {}
+        self.changes = {}
+
+    def add_chroms(self, chroms):
+        """
+        :param chroms: The CHROM column of a chunk of records.
+        :return: An array of the index of the chromosome of each record.
+        """
+        unique_chroms, first, inverse = np.unique(np.array(chroms), return_index=True, return_inverse=True)
+        for i in np.argsort(first):
+            self.chroms.setdefault(bytes(unique_chroms[i]), len(self.chroms))
+
+        if len(self.chroms) > len(self.stats):
+            self.stats = np.vstack([self.stats, np.zeros((len(self.chroms) - len(self.stats), len(STATISTICS)),
+                                                         dtype=np.int64)])
+
+        chrom_index = np.array([self.chroms[bytes(chrom)] for chrom in unique_chroms], dtype=np.int64)
+        return chrom_index[inverse.reshape(-1)]
+
+    def add_records(self, lines):
+        """
+        Counts a chunk of records.
+        :param lines: The records as bytes strings.
+        """
+        if not lines:
+            return
+
+        columns = [line.split(TAB_BYTES, ALT_COL + 1) for line in lines]
+        chrom_index = self.add_chroms([record[CHROM_COL] for record in columns])
+        refs = np.array([record[REF_COL] for record in columns])
+        alts = np.array([record[ALT_COL].rstrip() for record in columns])
+
+        ref_lengths = np.char.str_len(refs)
+        ref_bases = refs.view(np.uint8).reshape(len(refs), -1)[:, 0]
+
+        # Each ALT column is a row of bytes, padded with zeros. Each allele is separated by a comma.
+        alt_bytes = alts.view(np.uint8).reshape(len(alts), -1)
+        separators = (alt_bytes == COMMA) | (alt_bytes == 0)
+        alt_counts = (alt_bytes == COMMA).sum(axis=1) + 1
+
+        # An allele is a single character if it is surrounded by separators.
+        after_separator = np.ones_like(separators)
+        after_separator[:, 1:] = separators[:, :-1]
+        before_separator = np.ones_like(separators)
+        before_separator[:, :-1] = separators[:, 1:]
+        single = ~separators & after_separator & before_separator
+        all_single = single.sum(axis=1) == alt_counts
+
+        counts = np.zeros((len(lines), len(STATISTICS)), dtype=np.int64)
+        counts[:, TOTAL] = 1
+        counts[:, SNP] = (ref_lengths <= 1) & all_single & ~(single & ~SNP_BASES[alt_bytes]).any(axis=1)
+        counts[:, BIALLELIC] = alt_counts == 1
+        counts[:, MULTIALLELIC] = alt_counts > 1
+
+        # A record with a single base REF and single character alleles is never an indel. The INFO column of the rest of
+        # the records is checked for structural variants.
+        for i in np.flatnonzero((ref_lengths != 1) | ~all_single):
+            info = split_record(lines[i], INFO_COL + 1)[INFO_COL]
+            counts[i, INDEL] = is_indel(bytes(refs[i]), bytes(alts[i]).split(COMMA_BYTES), info)
+
+        np.add.at(self.stats, chrom_index, counts)
+
+        # The nucleotide changes are the single character alleles of the records with a single base REF.
+        rows, cols = np.nonzero(single & (ref_lengths == 1)[:, None] & (alt_bytes != MISSING))
+        self.add_changes(chrom_index[rows], ref_bases[rows].astype(np.int64) * 256 + alt_bytes[rows, cols])
+
+    def add_changes(self, chrom_index, changes):
+        """
+        :param chrom_index: The index of the chromosome of each nucleotide change.
+        :param changes: The encoded nucleotide changes, in the order they appear in the VCF file.
+        """
+        unique_changes, first = np.unique(changes, return_index=True)
+        for change in unique_changes[np.argsort(first)].tolist():
+            self.change_order.setdefault(change, len(self.change_order))
+
+        keys, key_counts = np.unique(chrom_index * 65536 + changes, return_counts=True)
+        for key, count in zip(keys.tolist(), key_counts.tolist()):
+            self.changes[key] = self.changes.get(key, 0) + count
+
+    def merge(self, other):
+        """
+        Adds the counts of a summary of later records in the VCF file, such as the summary of another contig.
+        :param other: The other VcfSummary.
+        """
+        chrom_index = np.array([self.chroms.setdefault(chrom, len(self.chroms)) for chrom in other.chroms],
+                               dtype=np.int64)
+        stats = np.zeros((len(self.chroms), len(STATISTICS)), dtype=np.int64)
+        stats[:len(self.stats)] = self.stats
+        np.add.at(stats, chrom_index, other.stats)
+        self.stats = stats
+
+        for change in other.change_order:
+            self.change_order.setdefault(change, len(self.change_order))
+        for key, count in other.changes.items():
+            key = int(chrom_index[key // 65536]) * 65536 + key % 65536
+            self.changes[key] = self.changes.get(key, 0) + count
+
+    def ordered_changes(self):
+        """
+        :return: The names of the nucleotide changes, such as 'A to G', and their codes, in the order first seen.
+        """
+        return [('{REF} to {ALT}'.format(REF=chr(change // 256), ALT=chr(change % 256)), change)
+                for change in sorted(self.change_order, key=self.change_order.get)]
+
+    def to_dict(self):
+        """
+        :return: The summary as a dictionary that can be written as JSON, with the totals and each chromosome.
+        """
+        changes = self.ordered_changes()
+
+        def counts(stats, chrom_index=None):
+            result = dict(zip(STATISTICS, (int(count) for count in stats)))
+            if chrom_index is None:
+                totals = {}
+                for key, count in self.changes.items():
+                    totals[key % 65536] = totals.get(key % 65536, 0) + count
+                result['nucleotide_changes'] = {name: totals.get(change, 0) for name, change in changes}
+            else:
+                result['nucleotide_changes'] = {name: self.changes.get(chrom_index * 65536 + change, 0)
+                                                for name, change in changes}
+            return result
+
+        return {'total': counts(self.stats.sum(axis=0)),
+                'chromosomes': {chrom.decode(): counts(self.stats[i], i) for chrom, i in self.chroms.items()}}
+
+
+def summarize_lines(lines):
+    """
+    :param lines: An iterable of the lines of a VCF file, or of records.
+    :return: A VcfSummary of the records.
+    """
+    summary = VcfSummary()
+    records = (line for line in lines if not line.startswith(HEADER_PREFIX) and line.strip())
+    while True:
+        chunk = list(islice(records, CHUNK_RECORDS))
+        if not chunk:
+            return summary
+        summary.add_records(chunk)
+
+
+def summarize_contig(input_vcf, contig):
+    """
+    Summarizes one contig of an indexed VCF. This runs in a worker process, which opens its own VCF file.
+    :param input_vcf: The path to the bgzipped and indexed VCF file.
+    :param contig: The contig to summarize.
+    :return: A VcfSummary of the contig.
+    """
+    with open_tabix(input_vcf) as tabix_file:
+        return summarize_lines(fetch_records(tabix_file, contig))
 
 
 class RunVcfSummaryStatistics(RunProcessStepSuper):
-    def __init__(self, output_dir, input_vcf, output_file=None, logger=None):
+    def __init__(self, output_dir, input_vcf, output_file=None, logger=None, processes=None):
         """
         This is the constructor for a RunVcfSummaryStatistics object.
         :param output_dir: The output directory.
         :param input_vcf: The input VCF path.
         :param output_file: The output path.
         :param logger: The logger for tracking progress.
+        :param processes: The number of contigs of an indexed input VCF that are summarized at once. Defaults to the
+        number of cores.
         """
         name = 'VcfSummaryStatistics'
         output_dir = output_dir
@@ -35,6 +221,12 @@ class RunVcfSummaryStatistics(RunProcessStepSuper):
 
         super().__init__(name, output_dir, input_file, output_file, log_name, logger)
 
+        self.processes = processes if processes else os.cpu_count()
+
+        # The machine readable versions of the summary are saved next to the text report.
+        self.json_output = os.path.splitext(self.output)[0] + DOT + 'json'
+        self.table_output = os.path.splitext(self.output)[0] + DOT + table_str + DOT + tsv_str
+
         self.RECORDS = 'record(s)'
         self.TOTAL = 'total'
         self.SNP = 'snp'
@@ -45,48 +237,43 @@ class RunVcfSummaryStatistics(RunProcessStepSuper):
 
     def process(self):
         """
-        Iterates through VCF file, keeps track of several useful summary statstics and writes them to file.
+        Summarizes the VCF file, and writes the summary statistics to file.
         """
+        if self.processes > 1 and is_indexed(self.input_file):
+            summary = self.summarize_contigs()
+        else:
+            with open_vcf(self.input_file) as infile:
+                summary = summarize_lines(infile)
 
-        reader = vcf.Reader(filename=self.input_file)
+        summary = summary.to_dict()
+        self.write_report(summary)
+        self.write_table(summary)
 
-        full_stats = defaultdict(int)
-        full_stats_nuc_changes = defaultdict(int)
+        with open(os.path.join(self.output_dir, self.json_output), w) as outfile:
+            json.dump(summary, outfile, indent=4)
 
-        per_chrom_stats = defaultdict(lambda: defaultdict(int))
-        per_chrom_nuc_changes = defaultdict(lambda: defaultdict(int))
-
-        ordered_chroms = []
-
-        for rec in reader:
-            if rec.CHROM not in ordered_chroms:
-                ordered_chroms.append(rec.CHROM)
-
-            full_stats[self.TOTAL] += 1
-            per_chrom_stats[rec.CHROM][self.TOTAL] += 1
-
-            if rec.is_indel:
-                full_stats[self.INDEL] += 1
-                per_chrom_stats[rec.CHROM][self.INDEL] += 1
-
-            if rec.is_snp:
-                full_stats[self.SNP] += 1
-                per_chrom_stats[rec.CHROM][self.SNP] += 1
+    def summarize_contigs(self):
+        """
+        Summarizes each contig of an indexed VCF file in a separate process.
+        :return: A VcfSummary of the VCF file, with the contigs in the order of the file.
+        """
+        with open_tabix(self.input_file) as tabix_file:
+            contigs = list(tabix_file.contigs)
 
-            if len(rec.ALT) > 1:
-                full_stats[self.MULTIALLELIC] += 1
-                per_chrom_stats[rec.CHROM][self.MULTIALLELIC] += 1
+        summary = VcfSummary()
+        with ProcessPoolExecutor(max_workers=max(1, min(self.processes, len(contigs)))) as executor:
+            for contig_summary in executor.map(summarize_contig, [self.input_file] * len(contigs), contigs):
+                summary.merge(contig_summary)
 
-            if len(rec.ALT) == 1:
-                full_stats[self.BIALLELIC] += 1
-                per_chrom_stats[rec.CHROM][self.BIALLELIC] += 1
+        return summary
 
-            ref = rec.REF
-            for alt in rec.ALT:
-                if len(ref) == 1 and len(alt) == 1:
-                    nucleotide_change = '{REF} to {ALT}'.format(REF=ref, ALT=alt)
-                    full_stats_nuc_changes[nucleotide_change] += 1
-                    per_chrom_nuc_changes[rec.CHROM][nucleotide_change] += 1
+    def write_report(self, summary):
+        """
+        Writes the summary statistics as a text report.
+        :param summary: The summary, as returned by VcfSummary.to_dict().
+        """
+        full_stats = summary[self.TOTAL]
+        full_stats_nuc_changes = full_stats[self.NUCLEOTIDE_CHANGES]
 
         # Begin writing results to file.
         with open(os.path.join(self.output_dir, self.output), w) as outfile:
@@ -105,19 +292,44 @@ class RunVcfSummaryStatistics(RunProcessStepSuper):
 
             outfile.write(NL + "PER CHROMOSOME SUMMARY STATISTICS" + NL)
 
-            for chrom in ordered_chroms:
+            for chrom, per_chrom_stats in summary['chromosomes'].items():
                 outfile.write(NL + TAB + chrom + SEMI + NL)
                 outfile.write(TAB + TAB + self.TOTAL + SPACE + self.RECORDS + SEMI + SPACE +
-                              str(per_chrom_stats[chrom][self.TOTAL]) + NL)
+                              str(per_chrom_stats[self.TOTAL]) + NL)
                 outfile.write(TAB + TAB + self.SNP + SPACE + self.RECORDS + SEMI + SPACE +
-                              str(per_chrom_stats[chrom][self.SNP]) + NL)
+                              str(per_chrom_stats[self.SNP]) + NL)
                 outfile.write(TAB + TAB + self.INDEL + SPACE + self.RECORDS + SEMI + SPACE +
-                              str(per_chrom_stats[chrom][self.INDEL]) + NL)
+                              str(per_chrom_stats[self.INDEL]) + NL)
                 outfile.write(TAB + TAB + self.BIALLELIC + SPACE + self.RECORDS + SEMI + SPACE +
-                              str(per_chrom_stats[chrom][self.BIALLELIC]) + NL)
+                              str(per_chrom_stats[self.BIALLELIC]) + NL)
                 outfile.write(TAB + TAB + self.MULTIALLELIC + SPACE + self.RECORDS + SEMI + SPACE +
-                              str(per_chrom_stats[chrom][self.MULTIALLELIC]) + NL)
+                              str(per_chrom_stats[self.MULTIALLELIC]) + NL)
 
                 outfile.write(NL + TAB + "{CHROM} SNV NUCLEOTIDE CHANGES".format(CHROM=chrom) + NL)
                 for change in full_stats_nuc_changes.keys():
-                    outfile.write(TAB + TAB + change + SEMI + SPACE + str(per_chrom_nuc_changes[chrom][change]) + NL)
+                    outfile.write(TAB + TAB + change + SEMI + SPACE +
+                                  str(per_chrom_stats[self.NUCLEOTIDE_CHANGES][change]) + NL)
+
+    def write_table(self, summary):
+        """
+        Writes the summary statistics as a table, with one row for the totals and one row for each chromosome.
+        :param summary: The summary, as returned by VcfSummary.to_dict().
+        """
+        changes = list(summary[self.TOTAL][self.NUCLEOTIDE_CHANGES])
+        rows = [(self.TOTAL, summary[self.TOTAL])] + list(summary['chromosomes'].items())
+
+        with open(os.path.join(self.output_dir, self.table_output), w) as outfile:
+            outfile.write(TAB.join(['CHROM'] + STATISTICS + changes) + NL)
+            for chrom, stats in rows:
+                outfile.write(TAB.join([chrom] + [str(stats[statistic]) for statistic in STATISTICS] +
+                                       [str(stats[self.NUCLEOTIDE_CHANGES][change]) for change in changes]) + NL)
+
+    def get_output_paths(self):
+        return super().get_output_paths() + [os.path.join(self.output_dir, self.json_output),
+                                             os.path.join(self.output_dir, self.table_output)]
+
+    def get_cache_signature(self):
+        # The number of processes does not change the output.
+        signature = super().get_cache_signature()
+        signature.pop('processes')
+        return signature
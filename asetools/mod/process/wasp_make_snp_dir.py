@@ -5,23 +5,87 @@ This module contains a RunProcessStepSuper subclass called RunMakeWaspSnpDir.
 
 This class converts a VCF file into a WASP SNP directory. This is a directory of files for each of the chromosomes
 independently.
+
+The VCF file is read as raw text, and the SNP lines of each chromosome are buffered and compressed in blocks. Each
+block is compressed as its own gzip member, and gzip readers read the members of a file one after the other as a
+single stream. The blocks are compressed by a pool of threads, as zlib does not hold the GIL while it compresses, and
+written in order. If the VCF is bgzipped and indexed with tabix, each chromosome is read and written by its own
+process instead.
+
+The SNPs can also be written to the HDF5 files that newer versions of WASP read, in the same pass over the VCF file.
 """
 
 import gzip
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from os.path import join
-import vcf
+from mod.misc.exceptions import ExecutionNotRanNoOutput
 from mod.misc.string_constants import *
+from mod.misc.vcf_text import open_vcf, split_record, is_indexed, read_header, indexed_contigs, open_tabix, \
+    fetch_records, HEADER_PREFIX, CHROM_COL, POS_COL, REF_COL, ALT_COL, SAMPLES_COL, COMMA_BYTES, MISSING_BYTES
+from mod.misc.wasp_snp_tables import WaspSnpTableWriter
 from mod.process_step_superclass import RunProcessStepSuper
 
+# The number of SNP lines that are compressed together as one gzip member.
+BLOCK_LINES = 100000
+
+# The compression level of the SNP files.
+COMPRESS_LEVEL = 6
+
+# PyVCF reads a missing alternate allele as None, which was written out as it is.
+MISSING_ALT = b'None'
+
+
+def snp_line(columns):
+    """
+    :param columns: The columns of a VCF record, split out at least as far as the ALT column.
+    :return: The line of the record in a WASP SNP file, with the position, reference allele and first alternate allele.
+    """
+    alt = columns[ALT_COL].split(COMMA_BYTES, 1)[0]
+    return b' '.join((columns[POS_COL], columns[REF_COL], alt if alt != MISSING_BYTES else MISSING_ALT)) + b'\n'
+
+
+def compress_block(lines):
+    """
+    :param lines: The SNP lines of a block.
+    :return: The block compressed as a gzip member.
+    """
+    return gzip.compress(b''.join(lines), compresslevel=COMPRESS_LEVEL, mtime=0)
+
+
+def write_contig(input_vcf, contig, output_path):
+    """
+    Writes the SNP file of one contig of an indexed VCF. This runs in a worker process, which opens its own VCF file.
+    :param input_vcf: The path to the bgzipped and indexed VCF file.
+    :param contig: The contig to write the SNPs of.
+    :param output_path: The path to the SNP file.
+    :return: The path to the SNP file.
+    """
+    with open_tabix(input_vcf) as tabix_file, open(output_path, 'wb') as outfile:
+        lines = []
+        for line in fetch_records(tabix_file, contig):
+            lines.append(snp_line(split_record(line, ALT_COL + 1)))
+            if len(lines) >= BLOCK_LINES:
+                outfile.write(compress_block(lines))
+                lines = []
+        if lines:
+            outfile.write(compress_block(lines))
+    return output_path
+
 
 class RunMakeWaspSnpDir(RunProcessStepSuper):
 
-    def __init__(self, output_dir, input_sorted_vcf, logger=None):
+    def __init__(self, output_dir, input_sorted_vcf, logger=None, processes=None, hdf5=False):
         """
         The constructor for a RunMakeWaspSnpDir object.
         :param output_dir: The output directory
         :param input_sorted_vcf:  The sorted input vcf
         :param logger: The logger for tracking progress.
+        :param processes: The number of blocks or chromosomes that are compressed at once. Defaults to the number of
+        cores.
+        :param hdf5: Whether to also write the snp_tab.h5, snp_index.h5 and haplotype.h5 files that WASP can read
+        instead of the text files. This requires PyTables.
         """
 
         name = 'MakeWaspSnpDir'
@@ -36,35 +100,98 @@ class RunMakeWaspSnpDir(RunProcessStepSuper):
         super().__init__(name, output_dir, input_file, output_file, log_name, logger)
 
         self.file_suffix = '.snps.txt.gz'
+        self.processes = processes if processes else os.cpu_count()
+        self.hdf5 = hdf5
 
     def process(self):
         """
         Converts the vcf file into a WASP snp directory.
         """
+        # The HDF5 files are written by a single writer, so they are built while the VCF file is streamed.
+        if self.processes > 1 and not self.hdf5 and is_indexed(self.input_file):
+            self.process_contigs()
+        else:
+            self.process_stream()
 
-        reader = vcf.Reader(filename=self.input_file)
-
+    def process_stream(self):
+        """
+        Reads the VCF from start to end, and compresses the blocks of SNP lines of each chromosome in a pool of threads.
+        The SNPs are also written to the HDF5 files as they are read.
+        """
+        snp_tables = WaspSnpTableWriter(self.output_dir, read_header(self.input_file)) if self.hdf5 else None
         snp_files = {}
-        for rec in reader:
-            if rec.CHROM not in snp_files.keys():
-                snp_files[rec.CHROM] = gzip.open(join(self.output_dir, rec.CHROM+self.file_suffix), 'wt')
-
-            snp_files[rec.CHROM].write(SPACE.join(map(str, [rec.POS, rec.REF, rec.ALT[0]]))+NL)
+        snp_lines = {}
+        # The compressed blocks are written in the order they were submitted, which keeps the blocks of each
+        # chromosome in order. Only a few blocks per thread are held in memory at once.
+        pending = deque()
+
+        with open_vcf(self.input_file) as reader, ThreadPoolExecutor(max_workers=self.processes) as executor:
+            for line in reader:
+                if line.startswith(HEADER_PREFIX) or not line.strip():
+                    continue
+
+                columns = split_record(line, SAMPLES_COL if snp_tables else ALT_COL + 1)
+                if snp_tables:
+                    snp_tables.write(columns)
+
+                chrom = columns[CHROM_COL]
+                if chrom not in snp_files:
+                    snp_files[chrom] = open(join(self.output_dir, chrom.decode() + self.file_suffix), 'wb')
+                    snp_lines[chrom] = []
+
+                lines = snp_lines[chrom]
+                lines.append(snp_line(columns))
+                if len(lines) >= BLOCK_LINES:
+                    pending.append((snp_files[chrom], executor.submit(compress_block, lines)))
+                    snp_lines[chrom] = []
+
+                    while len(pending) > 2 * self.processes:
+                        out, block = pending.popleft()
+                        out.write(block.result())
+
+            for chrom, lines in snp_lines.items():
+                if lines:
+                    pending.append((snp_files[chrom], executor.submit(compress_block, lines)))
+
+            while pending:
+                out, block = pending.popleft()
+                out.write(block.result())
 
         for chrom, out in snp_files.items():
             out.close()
 
+        if snp_tables:
+            snp_tables.close()
+
+    def process_contigs(self):
+        """
+        Writes the SNP file of each chromosome of an indexed VCF in a separate process.
+        """
+        contigs = indexed_contigs(self.input_file, read_header(self.input_file))
+        output_paths = [join(self.output_dir, contig + self.file_suffix) for contig in contigs]
+
+        with ProcessPoolExecutor(max_workers=max(1, min(self.processes, len(contigs)))) as executor:
+            list(executor.map(write_contig, [self.input_file] * len(contigs), contigs, output_paths))
+
+    def retrieve_output_path(self, default_output=True):
+        """
+        :return: The WASP SNP directory, which is the output directory itself.
+        """
+        if self.ran:
+            return self.output_dir
+        else:
+            raise ExecutionNotRanNoOutput(self.name)
+
     def save_log(self):
         """Skips log saving by overriding the parent class."""
         pass
 
+    def get_cache_signature(self):
+        # The number of processes does not change the output.
+        signature = super().get_cache_signature()
+        signature.pop('processes')
+        return signature
+
     def prep_chrom_snps(self, snps):
         """Formats the snps"""
         return NL.join(map(lambda x: SPACE.join(map(str, x)), snps))
-
-
-
-
-
-
-
@@ -11,6 +11,8 @@ This superclass makes much of the analyses object-oriented, which greatly eases
 from mod.misc.exceptions import ExecutionNotRanNoOutput
 import json
 from mod.misc.log import *
+from mod.misc.manifest import StepManifest
+from mod.misc.resources import CORES
 from mod.misc.string_constants import *
 
 
@@ -58,6 +60,8 @@ class RunProcessStepSuper:
         self.save_log()
         # Changes the ran status to ran = True
         self.ran = True
+        # Saves a manifest so that a rerun of the pipeline can skip this step
+        self.save_manifest()
         # Returns the path to the output file.
         return self.retrieve_output_path()
 
@@ -99,6 +103,101 @@ class RunProcessStepSuper:
         """
         return os.path.join(self.output_dir, self.log_name)
 
+    def completed_previously(self):
+        """
+        Checks the completion manifest of a previous run. If the process already ran with the same inputs and
+        parameters, and its outputs are unchanged, it is marked as ran so that it does not need to run again.
+        :return: True if the process already completed.
+        """
+        manifest = StepManifest(self.get_manifest_path())
+        if manifest.matches(self.get_input_paths(), self.get_manifest_command(), None):
+            Log.info_chk(self.logger, msg_skipping_completed_step.format(NAME=self.name, PATH=manifest.path))
+            self.ran = True
+            return True
+        return False
+
+    def run_cached(self, step_cache):
+        """
+        Runs the process unless its outputs are already in the step cache, in which case they are linked into the
+        output directory instead. The outputs of a process that is run are added to the cache.
+        :param step_cache: The StepCache to look up and store the outputs in.
+        :return: Path to the output file.
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+
+        if step_cache.fetch(self):
+            Log.info_chk(self.logger, msg_step_cache_hit.format(NAME=self.name, PATH=step_cache.cache_dir))
+            self.save_log()
+            self.ran = True
+            self.save_manifest()
+            return self.retrieve_output_path()
+
+        output = self.run()
+        if step_cache.store(self):
+            Log.info_chk(self.logger, msg_step_cache_store.format(NAME=self.name, PATH=step_cache.cache_dir))
+        return output
+
+    def get_resources(self):
+        """
+        :return: A dictionary of the resources that the process needs while it runs, for the ResourcePool. A process
+        that runs a pool of workers needs a core for each of them.
+        """
+        return {CORES: getattr(self, 'processes', None) or 1}
+
+    def get_cache_signature(self):
+        """
+        Everything other than the input files that determines the output of the process. These are the simple
+        parameters that were given to the constructor, leaving out the paths that depend on where the pipeline is run.
+        This can be overridden to return None for a process that should never be cached.
+        :return: An object that can be formatted as a json object.
+        """
+        skip = {'output_dir', 'input_file', 'output', 'log_name', 'ran'}
+        input_paths = set(self.get_input_paths())
+
+        parameters = {key: value for key, value in vars(self).items()
+                      if key not in skip and isinstance(value, (bool, int, float, str)) and value not in input_paths}
+        parameters['output'] = os.path.basename(self.output)
+
+        return parameters
+
+    def get_manifest_command(self):
+        """
+        :return: What takes the place of the command of a subprocess step in the completion manifest. This is the cache
+        signature, so that a process that is run again with different parameters is not skipped, or the json log for
+        a process that is never cached.
+        """
+        signature = self.get_cache_signature()
+        return signature if signature is not None else self.get_log_json()
+
+    def save_manifest(self):
+        """
+        Saves the completion manifest of the process next to its json log. The cache signature takes the place of the
+        command of a subprocess step.
+        """
+        Log.info_chk(self.logger, msg_saving_run_info.format(PATH=self.get_manifest_path()))
+        StepManifest(self.get_manifest_path()).save(self.get_input_paths(), self.get_manifest_command(), None,
+                                                    self.get_output_paths())
+
+    def get_manifest_path(self):
+        """
+        :return: The path to the completion manifest, which is saved next to the json log.
+        """
+        return os.path.splitext(self.get_log_path())[0] + '.manifest.json'
+
+    def get_input_paths(self):
+        """
+        This can be overridden by subclasses that take more than one input file.
+        :return: The paths to the input files of the process.
+        """
+        return [self.input_file]
+
+    def get_output_paths(self):
+        """
+        This can be overridden by subclasses that produce more than one output file.
+        :return: The paths to the output files of the process.
+        """
+        return [self.retrieve_output_path()]
+
     def retrieve_output_path(self, default_output=True):
         """
         This function retrieves the output path.
@@ -0,0 +1,157 @@
+"""
+AUTHOR: Matt Durrant
+
+This module contains the RunScatterGatherSuper superclass.
+
+This superclass splits a subprocess step that runs over the whole genome, such as GATK ASEReadCounter, into shards that
+each cover part of the genome. The shards are run at the same time, each in its own subprocess, and their outputs are
+merged into a single output in genome order. The shards take their memory and java virtual machines from the pipeline's
+ResourcePool, so that a scattered step never oversubscribes the machine.
+"""
+
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from mod.config.custom import MAX_CONCURRENT_JVMS, SCATTER_JAVA_MEMORY
+from mod.misc.intervals import read_contigs, scatter_intervals, write_intervals, INTERVALS_SUFFIX
+from mod.misc.log import *
+from mod.misc.resources import ResourcePool, MEMORY, JVM
+from mod.misc.string_constants import *
+from mod.subprocess_step_superclass import RunSubprocessStepSuper
+from mod.subprocess.java import set_java_memory
+
+# The subdirectory of the output directory that holds the shards.
+SHARDS_DIR = 'shards'
+
+
+class RunScatterGatherSuper(RunSubprocessStepSuper):
+    """
+    This is a super class that runs a java subprocess step on shards of the genome and gathers the outputs.
+    Subclasses must implement build_shard() and gather().
+    """
+
+    # Whether the shards may cut a contig in two. Subclasses whose calls depend on the reads around a site set it to
+    # False, so that the shards are only split between contigs.
+    split_contigs = True
+
+    def __init__(self, name, output_dir, input_bam, shard_count, log_name, logger=None, resource_pool=None):
+        """
+        Constructor for the superclass.
+        :param name: The name of the scattered step.
+        :param output_dir: The output directory to save the gathered output in.
+        :param input_bam: The input BAM, whose header defines the contigs that are split into shards.
+        :param shard_count: The number of shards to split the genome into.
+        :param log_name: The name of the json log of the scattered step.
+        :param logger: The logger object for outputting all of the relevant log information.
+        :param resource_pool: The ResourcePool that the shards take their resources from. When it is not given, only
+        the number of java virtual machines is limited.
+        """
+        self.intervals = scatter_intervals(read_contigs(input_bam), shard_count, split_contigs=self.split_contigs)
+
+        self.shards = []
+        for i in range(len(self.intervals)):
+            shard_dir = os.path.join(output_dir, SHARDS_DIR, 'shard_%04d' % i)
+            shard = self.build_shard(shard_dir, os.path.join(shard_dir, 'shard_%04d' % i + INTERVALS_SUFFIX))
+            shard.execution_path = set_java_memory(shard.execution_path, SCATTER_JAVA_MEMORY)
+            self.shards.append(shard)
+
+        self.resource_pool = resource_pool if resource_pool else ResourcePool(**{JVM: MAX_CONCURRENT_JVMS})
+        self.shard_resources = dict(self.shards[0].get_resources(), **{MEMORY: SCATTER_JAVA_MEMORY, JVM: 1})
+
+        first_shard = self.shards[0]
+        super().__init__(name=name, output_dir=output_dir, execution_path=first_shard.execution_path,
+                         version=first_shard.version, version_flag=first_shard.version_flag,
+                         version_parser=first_shard.version_parser, input_file=first_shard.input_file,
+                         output_file=first_shard.output_file, args=first_shard.args, log_name=log_name, logger=logger)
+
+
+    def build_shard(self, shard_dir, intervals_path):
+        """
+        This needs to be implemented by the subclasses.
+        :param shard_dir: The output directory of the shard.
+        :param intervals_path: The GATK interval list that the shard is restricted to.
+        :return: A RunSubprocessStepSuper object that processes the intervals.
+        """
+        raise NotImplementedError
+
+
+    def gather(self, shard_outputs, output):
+        """
+        This needs to be implemented by the subclasses.
+        :param shard_outputs: The output paths of the shards, in genome order.
+        :param output: The path to write the merged output to.
+        """
+        raise NotImplementedError
+
+
+    def check_version(self, stderr=subprocess.PIPE, ignore_error=False, pass_version_to_parser=False):
+        # All of the shards run the same application, so it is only checked once.
+        self.shards[0].check_version()
+
+
+    def get_resources(self):
+        """
+        :return: No resources, as each shard takes its own resources from the pool while it runs.
+        """
+        return {}
+
+
+    def format_command(self):
+        """
+        :return: The commands of all of the shards, one per line.
+        """
+        return NL.join(shard.format_command() for shard in self.shards)
+
+
+    def execute_command(self, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=False):
+        """
+        Runs every shard as soon as its resources are available, then gathers their outputs.
+        """
+        for shard, intervals in zip(self.shards, self.intervals):
+            os.makedirs(shard.output_dir, exist_ok=True)
+            write_intervals(intervals, shard.intervals)
+
+        with ThreadPoolExecutor(max_workers=len(self.shards)) as executor:
+            list(executor.map(self.run_shard, self.shards))
+
+        self.gather([shard.retrieve_output_path() for shard in self.shards], self.retrieve_output_path())
+
+
+    def run_shard(self, shard):
+        """
+        Runs a single shard, holding its memory and java virtual machine while it runs.
+        :param shard: The shard to run.
+        """
+        request = self.resource_pool.acquire(self.shard_resources)
+        try:
+            shard.execute_command()
+            shard.save_log()
+            shard.ran = True
+        finally:
+            self.resource_pool.release(request)
+
+
+    def get_log_json(self, input_class_parse=None, output_class_parse=None):
+        """
+        :return: The intervals and json log of every shard.
+        """
+        log_json = {
+
+            'name': self.name,
+            'output_dir': self.output_dir,
+            'version': self.version,
+            'shards': [dict(shard.get_log_json(), intervals=intervals)
+                       for shard, intervals in zip(self.shards, self.intervals)]
+
+        }
+
+        return log_json
+
+
+    def get_input_paths(self):
+        return self.shards[0].get_input_paths()
+
+
+    def get_cache_signature(self):
+        signature = self.shards[0].get_cache_signature()
+        signature['intervals'] = self.intervals
+        return signature
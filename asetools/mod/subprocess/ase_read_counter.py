@@ -16,7 +16,7 @@ from mod.subprocess.java import RunJava
 
 
 class RunGATKASEReadCounter(RunSubprocessStepSuper):
-    def __init__(self, output_dir, input_bam, input_sites_vcf, output_counts=None, logger=None):
+    def __init__(self, output_dir, input_bam, input_sites_vcf, output_counts=None, logger=None, intervals=None):
 
         custom_config = GATKASEReadCounterCustomConfig()
         fixed_config = GATKASEReadCounterFixedConfig()
@@ -49,7 +49,11 @@ class RunGATKASEReadCounter(RunSubprocessStepSuper):
 
         super().__init__(name=name, output_dir=output_dir, execution_path=execution_path, version=version,
                          version_flag=version_flag, version_parser=version_parser, input_file=input_file,
-                         output_file=output_file, args=args, log_name=log_name, logger=logger)
+                         output_file=output_file, args=args, log_name=log_name, logger=logger,
+                         resources=custom_config.resources)
+
+        # An optional GATK interval list, so that only part of the genome is processed.
+        self.intervals = intervals
 
     def handle_output_counts(self, output_counts, input_bam):
         if output_counts:
@@ -64,9 +68,14 @@ class RunGATKASEReadCounter(RunSubprocessStepSuper):
                    SPACE.join([self.input_sites.flag, self.input_sites.arg]),
                    SPACE.join([self.output_file.flag, join(self.output_dir, self.output_file.arg)])]
         command.extend([SPACE.join(map(str, [flag, arg])) for flag, arg in self.args])
+        if self.intervals:
+            command.append(SPACE.join(['-L', self.intervals]))
 
         return SPACE.join(command)
 
+    def get_input_paths(self):
+        return super().get_input_paths() + [self.input_sites.arg]
+
     def check_version(self, stderr=subprocess.PIPE, ignore_error=False, pass_version_to_parse=False):
         self.java.check_version()
         super().check_version()
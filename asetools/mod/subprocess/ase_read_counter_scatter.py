@@ -0,0 +1,48 @@
+"""
+AUTHOR: Matt Durrant
+
+This module contains a RunScatterGatherSuper subclass called RunGATKASEReadCounterScatter.
+
+It executes GATK ASEReadCounter on shards of the genome at the same time, and concatenates the read count tables of the
+shards in genome order.
+"""
+
+from mod.config.custom import SCATTER_SHARDS
+from mod.config.fixed import GATKASEReadCounterFixedConfig
+from mod.misc.string_constants import *
+from mod.scatter_gather_superclass import RunScatterGatherSuper
+from mod.subprocess.ase_read_counter import RunGATKASEReadCounter
+
+
+class RunGATKASEReadCounterScatter(RunScatterGatherSuper):
+    def __init__(self, output_dir, input_bam, input_sites_vcf, output_counts=None, logger=None, resource_pool=None,
+                 shard_count=SCATTER_SHARDS):
+
+        fixed_config = GATKASEReadCounterFixedConfig()
+
+        self.input_bam = input_bam
+        self.input_sites_vcf = input_sites_vcf
+        self.output_counts = output_counts
+        self.shard_logger = logger
+
+        super().__init__(name=fixed_config.name, output_dir=output_dir, input_bam=input_bam, shard_count=shard_count,
+                         log_name=fixed_config.log_name, logger=logger, resource_pool=resource_pool)
+
+    def build_shard(self, shard_dir, intervals_path):
+        return RunGATKASEReadCounter(shard_dir, self.input_bam, self.input_sites_vcf, output_counts=self.output_counts,
+                                     logger=self.shard_logger, intervals=intervals_path)
+
+    def gather(self, shard_outputs, output):
+        """
+        Concatenates the read count tables of the shards, keeping only the header of the first.
+        :param shard_outputs: The read count tables of the shards, in genome order.
+        :param output: The path to the merged read count table.
+        """
+        with open(output, w) as outfile:
+            for i, shard_output in enumerate(shard_outputs):
+                with open(shard_output) as infile:
+                    header = infile.readline()
+                    if i == 0:
+                        outfile.write(header)
+                    for line in infile:
+                        outfile.write(line)
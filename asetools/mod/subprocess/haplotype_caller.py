@@ -16,7 +16,7 @@ from mod.subprocess.java import RunJava
 
 
 class RunGATKHaplotypeCaller(RunSubprocessStepSuper):
-    def __init__(self, output_dir, input_bam, output_vcf=None, logger=None):
+    def __init__(self, output_dir, input_bam, output_vcf=None, logger=None, intervals=None):
 
         custom_config = GATKHaplotypeCallerCustomConfig()
         fixed_config = GATKHaplotypeCallerFixedConfig()
@@ -46,7 +46,11 @@ class RunGATKHaplotypeCaller(RunSubprocessStepSuper):
 
         super().__init__(name=name, output_dir=output_dir, execution_path=execution_path, version=version,
                          version_flag=version_flag, version_parser=version_parser, input_file=input_file,
-                         output_file=output_file, args=args, log_name=log_name, logger=logger)
+                         output_file=output_file, args=args, log_name=log_name, logger=logger,
+                         resources=custom_config.resources)
+
+        # An optional GATK interval list, so that only part of the genome is processed.
+        self.intervals = intervals
 
     def handle_output_vcf(self, output_vcf, input_bam):
         if output_vcf:
@@ -60,6 +64,8 @@ class RunGATKHaplotypeCaller(RunSubprocessStepSuper):
         command = [self.execution_path, SPACE.join([self.input_file.flag, self.input_file.arg]),
                    SPACE.join([self.output_file.flag, join(self.output_dir, self.output_file.arg)])]
         command.extend([SPACE.join(map(str, [flag, arg])) for flag, arg in self.args])
+        if self.intervals:
+            command.append(SPACE.join(['-L', self.intervals]))
 
         return SPACE.join(command)
 
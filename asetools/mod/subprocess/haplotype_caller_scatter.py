@@ -0,0 +1,53 @@
+"""
+AUTHOR: Matt Durrant
+
+This module contains a RunScatterGatherSuper subclass called RunGATKHaplotypeCallerScatter.
+
+It executes GATK HaplotypeCaller on shards of the genome at the same time, and merges the VCFs of the shards in genome
+order under the header of the first shard. The shards are only split between contigs, as HaplotypeCaller assembles
+active regions around each site, and a shard boundary inside a contig would change the calls near it.
+"""
+
+from mod.config.custom import SCATTER_SHARDS
+from mod.config.fixed import GATKHaplotypeCallerFixedConfig
+from mod.misc.string_constants import *
+from mod.scatter_gather_superclass import RunScatterGatherSuper
+from mod.subprocess.haplotype_caller import RunGATKHaplotypeCaller
+
+
+class RunGATKHaplotypeCallerScatter(RunScatterGatherSuper):
+
+    split_contigs = False
+
+    def __init__(self, output_dir, input_bam, output_vcf=None, logger=None, resource_pool=None,
+                 shard_count=SCATTER_SHARDS):
+
+        fixed_config = GATKHaplotypeCallerFixedConfig()
+
+        self.input_bam = input_bam
+        self.output_vcf = output_vcf
+        self.shard_logger = logger
+
+        super().__init__(name=fixed_config.name, output_dir=output_dir, input_bam=input_bam, shard_count=shard_count,
+                         log_name=fixed_config.log_name, logger=logger, resource_pool=resource_pool)
+
+    def build_shard(self, shard_dir, intervals_path):
+        return RunGATKHaplotypeCaller(shard_dir, self.input_bam, output_vcf=self.output_vcf, logger=self.shard_logger,
+                                      intervals=intervals_path)
+
+    def gather(self, shard_outputs, output):
+        """
+        Merges the VCFs of the shards. The shards share the same header, as they were called from the same BAM with the
+        same arguments, so the header of the first shard is kept and the records of every shard follow it in order.
+        :param shard_outputs: The VCFs of the shards, in genome order.
+        :param output: The path to the merged VCF.
+        """
+        with open(output, w) as outfile:
+            for i, shard_output in enumerate(shard_outputs):
+                with open(shard_output) as infile:
+                    for line in infile:
+                        if line.startswith('#'):
+                            if i == 0:
+                                outfile.write(line)
+                        else:
+                            outfile.write(line)
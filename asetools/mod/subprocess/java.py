@@ -6,6 +6,7 @@ This module contains a RunSubprocessStepSuper subclass called RunJava.
 It simply verifies that Java is the right version.
 """
 
+import re
 import subprocess
 from mod.config.custom import JavaCustomConfig
 from mod.config.fixed import JavaFixedConfig
@@ -13,6 +14,16 @@ from mod.misc.record_classes import *
 from mod.subprocess_step_superclass import RunSubprocessStepSuper
 
 
+def set_java_memory(execution_path, memory):
+    """
+    Changes the maximum memory of a java execution path, as built by the custom config.
+    :param execution_path: A java execution path containing an -Xmx argument.
+    :param memory: The new maximum memory, such as '8g'.
+    :return: The execution path with the new -Xmx argument.
+    """
+    return re.sub(r'-Xmx\S+', '-Xmx%s' % memory, execution_path)
+
+
 class RunJava(RunSubprocessStepSuper):
     def __init__(self, logger=None):
         custom_config = JavaCustomConfig()
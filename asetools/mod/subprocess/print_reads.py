@@ -48,7 +48,8 @@ class RunGATKPrintReads(RunSubprocessStepSuper):
 
         super().__init__(name=name, output_dir=output_dir, execution_path=execution_path, version=version,
                          version_flag=version_flag, version_parser=version_parser, input_file=input_file,
-                         output_file=output_file, args=args, log_name=log_name, logger=logger)
+                         output_file=output_file, args=args, log_name=log_name, logger=logger,
+                         resources=custom_config.resources)
 
     def handle_output_bam(self, output_bam, input_bam):
         if output_bam:
@@ -66,6 +67,9 @@ class RunGATKPrintReads(RunSubprocessStepSuper):
 
         return SPACE.join(command)
 
+    def get_input_paths(self):
+        return super().get_input_paths() + [self.input_recal_table.arg]
+
     def check_version(self, stderr=subprocess.PIPE, ignore_error=False, pass_version_to_parse=False):
         self.java.check_version()
         super().check_version()
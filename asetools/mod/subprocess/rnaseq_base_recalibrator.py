@@ -45,7 +45,8 @@ class RunGATKRNAseqBaseRecalibrator(RunSubprocessStepSuper):
 
         super().__init__(name=name, output_dir=output_dir, execution_path=execution_path, version=version,
                          version_flag=version_flag, version_parser=version_parser, input_file=input_file,
-                         output_file=output_file, args=args, log_name=log_name, logger=logger)
+                         output_file=output_file, args=args, log_name=log_name, logger=logger,
+                         resources=custom_config.resources)
 
     def handle_output_bam(self, output_bam, input_sam):
         if output_bam:
@@ -43,7 +43,8 @@ class RunSamtoolsIndex(RunSubprocessStepSuper):
 
         super().__init__(name=name, output_dir=output_dir, execution_path=execution_path, version=version,
                          version_flag=version_flag, version_parser=version_parser, input_file=input_file,
-                         output_file=output_file, args=args, log_name=log_name, logger=logger)
+                         output_file=output_file, args=args, log_name=log_name, logger=logger,
+                         resources=custom_config.resources)
 
         self.samtools = RunSamtools(logger=self.logger)
 
@@ -53,6 +54,9 @@ class RunSamtoolsIndex(RunSubprocessStepSuper):
     def save_log(self):
         pass
 
+    def get_output_paths(self):
+        return [self.input_file.arg + '.bai']
+
     def run(self, make_output_dir=True):
         super().run(make_output_dir=False)
 
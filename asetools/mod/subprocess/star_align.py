@@ -10,14 +10,36 @@ from glob import glob
 from os.path import basename, join
 from mod.config.custom import StarAlignCustomConfig
 from mod.config.fixed import StarAlignFixedConfig
+from mod.misc.exceptions import StarSharedGenomeError
 from mod.misc.path_methods import get_shared_prefix
 from mod.misc.record_classes import flagtwoargs_to_tuple
+from mod.misc.resources import MEMORY
 from mod.misc.string_constants import *
 from mod.subprocess_step_superclass import RunSubprocessStepSuper
 
+# The arguments that insert splice junctions on the fly, which STAR cannot do with a genome in shared memory.
+SJDB_INSERT_ARGS = ['--sjdbGTFfile', '--sjdbFileChrStartEnd']
+
+
+def shared_genome_args(args):
+    """
+    :param args: The STAR arguments of the custom config.
+    :return: The arguments with --genomeLoad LoadAndKeep, so that the genome is attached from shared memory.
+    """
+    arg_dict = dict(args)
+    if str(arg_dict.get('--twopassMode', 'None')) != 'None':
+        raise StarSharedGenomeError(arg_dict.get('--genomeDir'), "--twopassMode must be None")
+    for arg in SJDB_INSERT_ARGS:
+        if arg in arg_dict:
+            raise StarSharedGenomeError(arg_dict.get('--genomeDir'),
+                                        "{ARG} inserts splice junctions on the fly".format(ARG=arg))
+
+    return [(flag, arg) for flag, arg in args if flag != '--genomeLoad'] + [('--genomeLoad', 'LoadAndKeep')]
+
 
 class RunStarAlign(RunSubprocessStepSuper):
-    def __init__(self, output_dir, fastq1, fastq2, logger=None, out_prefix=None):
+    def __init__(self, output_dir, fastq1, fastq2, logger=None, out_prefix=None, stream_sam=False,
+                 shared_genome=False):
 
         custom_config = StarAlignCustomConfig()
         fixed_config = StarAlignFixedConfig()
@@ -34,6 +56,7 @@ class RunStarAlign(RunSubprocessStepSuper):
         output_file = fixed_config.output_file
 
         args = custom_config.args
+        resources = custom_config.resources
 
         log_name = fixed_config.log_name
         logger = logger
@@ -41,10 +64,20 @@ class RunStarAlign(RunSubprocessStepSuper):
         # Adjusting attributes based on relevant input variables
         input_file.arg1, input_file.arg2 = fastq1, fastq2
         output_file.arg = self.handle_out_prefix(out_prefix, fastq1, fastq2)
+        if shared_genome:
+            args = shared_genome_args(args)
+            resources = dict(resources, **{MEMORY: custom_config.shared_genome_memory})
 
         super().__init__(name=name, output_dir=output_dir, execution_path=execution_path, version=version,
                          version_flag=version_flag, version_parser=version_parser, input_file=input_file,
-                         output_file=output_file, args=args, log_name=log_name, logger=logger)
+                         output_file=output_file, args=args, log_name=log_name, logger=logger,
+                         resources=resources)
+
+        # Whether the alignments are written to stdout instead of a SAM file, to be streamed into the next step.
+        self.stream_sam = stream_sam
+
+        # Whether the genome is attached from shared memory, where it is loaded by a StarSharedGenome.
+        self.shared_genome = shared_genome
 
     def handle_out_prefix(self, out_prefix, fastq1, fastq2):
         if out_prefix:
@@ -59,12 +92,21 @@ class RunStarAlign(RunSubprocessStepSuper):
         command.extend([self.input_file.flag, self.input_file.arg1, self.input_file.arg2])
         command.extend([SPACE.join(map(str, [flag, arg])) for flag, arg in self.args])
         command.extend([self.output_file.flag, join(self.output_dir, self.output_file.arg)])
+        if self.stream_sam:
+            command.extend(['--outStd', 'SAM'])
 
         return SPACE.join(command)
 
     def get_log_json(self):
         return super().get_log_json(input_class_parse=flagtwoargs_to_tuple)
 
+    def get_cache_signature(self):
+        signature = super().get_cache_signature()
+        signature['stream_sam'] = self.stream_sam
+        # The alignments do not depend on where the genome is loaded from.
+        signature['args'] = [(flag, arg) for flag, arg in self.args if flag != '--genomeLoad']
+        return signature
+
     def retrieve_output_path(self):
         output = glob(join(self.output_dir, self.output_file.arg) + '*.sam')[0]
         return super().retrieve_output_path(default_output=output)
@@ -0,0 +1,41 @@
+"""
+AUTHOR: Matt Durrant
+
+This module contains a RunSubprocessStreamSuper subclass called RunStarAlignAddReadGroups.
+
+It executes STAR mapping with its SAM output piped directly into the picard.jar AddReadGroups command, so that the
+uncompressed SAM file is never written to disk.
+"""
+
+from mod.config.fixed import StarAlignAddReadGroupsFixedConfig
+from mod.subprocess_stream_superclass import RunSubprocessStreamSuper, STDIN_PATH
+from mod.subprocess.add_read_groups import RunPicardAddReadGroups
+from mod.subprocess.star_align import RunStarAlign
+
+
+class RunStarAlignAddReadGroups(RunSubprocessStreamSuper):
+    def __init__(self, output_dir, fastq1, fastq2, output_bam=None, logger=None, out_prefix=None, shared_genome=False):
+        """
+        Constructor for a RunStarAlignAddReadGroups object.
+        :param output_dir: The output directory of both STAR and AddReadGroups.
+        :param fastq1: The first FASTQ file for the paired-end reads.
+        :param fastq2: The second FASTQ file for the paired-end reads.
+        :param output_bam: The name of the output BAM, by default it is named after the STAR output prefix.
+        :param logger: The logger object for outputting all of the relevant log information.
+        :param out_prefix: The STAR output prefix.
+        :param shared_genome: Whether STAR attaches the genome from shared memory, see RunStarAlign.
+        """
+        fixed_config = StarAlignAddReadGroupsFixedConfig()
+
+        name = fixed_config.name
+        log_name = fixed_config.log_name
+
+        star_align = RunStarAlign(output_dir, fastq1, fastq2, logger=logger, out_prefix=out_prefix, stream_sam=True,
+                                  shared_genome=shared_genome)
+
+        if not output_bam:
+            output_bam = star_align.output_file.arg + '.bam'
+        add_read_groups = RunPicardAddReadGroups(output_dir, STDIN_PATH, output_bam=output_bam, logger=logger)
+
+        super().__init__(name=name, output_dir=output_dir, steps=[star_align, add_read_groups], log_name=log_name,
+                         logger=logger)
@@ -0,0 +1,153 @@
+"""
+AUTHOR: Matt Durrant
+
+This module contains the StarSharedGenome class, which loads a STAR genome into shared memory for the alignments of a
+pipeline or batch.
+
+Each STAR alignment that runs with --genomeLoad NoSharedMemory reads the whole genome from disk, which takes minutes for
+a human genome. A StarSharedGenome loads the genome once with --genomeLoad LoadAndExit, the alignments attach to it with
+--genomeLoad LoadAndKeep, and it is removed with --genomeLoad Remove once the last pipeline that uses it has finished.
+The pipelines and batches hold a reference to the genome while they run, so that it stays loaded between samples.
+"""
+
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from mod.config.custom import StarAlignCustomConfig
+from mod.misc.exceptions import StarSharedGenomeError
+from mod.misc.log import *
+from mod.misc.resources import MEMORY
+from mod.misc.string_constants import *
+from mod.subprocess.star_align import shared_genome_args
+
+# The files of a STAR genome that are loaded into shared memory.
+GENOME_FILES = ['Genome', 'SA', 'SAindex']
+
+LOAD_AND_EXIT = 'LoadAndExit'
+REMOVE = 'Remove'
+
+# The shared genomes of this process by genome directory.
+_shared_genomes = {}
+_shared_genomes_lock = threading.Lock()
+
+
+def genome_size(genome_dir):
+    """
+    :param genome_dir: A STAR genome directory.
+    :return: The size in bytes of the files of the genome that are loaded into shared memory.
+    """
+    return sum(os.path.getsize(os.path.join(genome_dir, genome_file)) for genome_file in GENOME_FILES
+               if os.path.isfile(os.path.join(genome_dir, genome_file)))
+
+
+def shared_star_genome(genome_dir=None, logger=None):
+    """
+    :param genome_dir: A STAR genome directory. Defaults to the --genomeDir of the STAR custom config.
+    :param logger: The logger object for outputting all of the relevant log information.
+    :return: The StarSharedGenome of the genome directory, which is shared by every pipeline of this process.
+    """
+    custom_config = StarAlignCustomConfig()
+
+    # The arguments are checked before the genome is loaded, rather than when the first alignment starts.
+    shared_genome_args(custom_config.args)
+    if genome_dir is None:
+        genome_dir = dict(custom_config.args)['--genomeDir']
+
+    with _shared_genomes_lock:
+        genome_dir = os.path.abspath(genome_dir)
+        if genome_dir not in _shared_genomes:
+            _shared_genomes[genome_dir] = StarSharedGenome(genome_dir, custom_config.execution_path, logger=logger)
+        return _shared_genomes[genome_dir]
+
+
+class StarSharedGenome:
+    """
+    A STAR genome in shared memory, which is loaded by the first acquire() and removed by the last release().
+    """
+
+    def __init__(self, genome_dir, execution_path, logger=None):
+        """
+        The constructor for a StarSharedGenome object.
+        :param genome_dir: The STAR genome directory.
+        :param execution_path: The execution path of STAR.
+        :param logger: The logger object for outputting all of the relevant log information.
+        """
+        self.genome_dir = genome_dir
+        self.execution_path = execution_path
+        self.logger = logger
+
+        self.references = 0
+        self.lock = threading.Lock()
+
+        # The pool that the memory of the genome was taken from, and the memory that was taken.
+        self.resource_pool = None
+        self.memory = None
+
+    def acquire(self, resource_pool=None):
+        """
+        Takes a reference to the genome, and loads it if it is not loaded yet. The memory of the genome is taken from
+        the resource pool while it is loaded.
+        :param resource_pool: The ResourcePool of the pipeline or batch, if any.
+        """
+        with self.lock:
+            if not self.references:
+                if resource_pool:
+                    self.memory = resource_pool.acquire({MEMORY: genome_size(self.genome_dir)})
+                    self.resource_pool = resource_pool
+                try:
+                    self.execute_genome_load(LOAD_AND_EXIT)
+                except Exception:
+                    self.release_memory()
+                    raise
+            self.references += 1
+
+    def release(self):
+        """
+        Drops a reference to the genome, and removes it from shared memory if it was the last one.
+        """
+        with self.lock:
+            self.references -= 1
+            if not self.references:
+                try:
+                    self.execute_genome_load(REMOVE)
+                finally:
+                    self.release_memory()
+
+    def release_memory(self):
+        """
+        Returns the memory of the genome to the resource pool it was taken from.
+        """
+        if self.resource_pool:
+            self.resource_pool.release(self.memory)
+        self.resource_pool, self.memory = None, None
+
+    def execute_genome_load(self, genome_load):
+        """
+        Runs STAR to load the genome into, or remove it from, shared memory. The logs of STAR are written to a
+        temporary directory.
+        :param genome_load: The --genomeLoad option, LOAD_AND_EXIT or REMOVE.
+        """
+        temp_dir = tempfile.mkdtemp(prefix='star_genome_')
+        command = self.execution_path.split() + ['--genomeDir', self.genome_dir, '--genomeLoad', genome_load,
+                                                 '--outFileNamePrefix', temp_dir + os.sep]
+
+        Log.info_chk(self.logger, msg_executing_command.format(DELIM=NL, COMMAND=SPACE.join(command)))
+        try:
+            output = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            for line in output.stdout.decode(UTF8, errors='replace').splitlines():
+                Log.info_chk(self.logger, line)
+            if output.returncode:
+                problem = "STAR --genomeLoad {LOAD} exited with status {CODE}".format(LOAD=genome_load,
+                                                                                     CODE=output.returncode)
+                raise StarSharedGenomeError(self.genome_dir, problem)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
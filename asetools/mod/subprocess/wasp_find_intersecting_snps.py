@@ -4,6 +4,9 @@ AUTHOR: Matt Durrant
 This module contains a RunSubprocessStepSuper subclass called RunWaspFindIntersectingSnps.
 
 It executes the WASP find_intersecting_snps.py script using the subprocess standard library module.
+
+The SNPs are read from the text files of the WASP SNP directory, or from the HDF5 files that RunMakeWaspSnpDir writes
+into the same directory, which WASP loads much faster.
 """
 
 import subprocess
@@ -13,11 +16,24 @@ from mod.config.fixed import WASPFindIntersectingSnpsFixedConfig
 from mod.misc.log import *
 from mod.misc.record_classes import FlagArg
 from mod.misc.string_constants import *
+from mod.misc.wasp_snp_tables import SNP_TAB_FILE, SNP_INDEX_FILE, HAPLOTYPE_FILE
 from mod.subprocess_step_superclass import RunSubprocessStepSuper
 
 
 class RunWaspFindIntersectingSnps(RunSubprocessStepSuper):
-    def __init__(self, output_dir, input_bam, input_snp_dir, output_bam=None, logger=None):
+    def __init__(self, output_dir, input_bam, input_snp_dir, output_bam=None, logger=None, hdf5=False,
+                 haplotypes=False):
+        """
+        The constructor for a RunWaspFindIntersectingSnps object.
+        :param output_dir: The output directory.
+        :param input_bam: The input BAM file.
+        :param input_snp_dir: The WASP SNP directory written by RunMakeWaspSnpDir.
+        :param output_bam: Unused, the output files are named by WASP.
+        :param logger: The logger for tracking progress.
+        :param hdf5: Whether to read the SNPs from the HDF5 files of the SNP directory, rather than its text files.
+        :param haplotypes: Whether WASP remaps only the haplotypes of the samples of the HDF5 haplotype file, rather than
+        every combination of the alleles of the SNPs in a read.
+        """
         custom_config = WASPFindIntersectingSnpsCustomConfig()
         fixed_config = WASPFindIntersectingSnpsFixedConfig()
 
@@ -43,19 +59,40 @@ class RunWaspFindIntersectingSnps(RunSubprocessStepSuper):
 
         super().__init__(name=name, output_dir=output_dir, execution_path=execution_path, version=version,
                          version_flag=version_flag, version_parser=version_parser, input_file=input_file,
-                         output_file=output_file, args=args, log_name=log_name, logger=logger)
+                         output_file=output_file, args=args, log_name=log_name, logger=logger,
+                         resources=custom_config.resources)
 
         self.input_snp_dir = FlagArg(flag='--snp_dir', arg=input_snp_dir)
+        self.input_snp_tab = FlagArg(flag='--snp_tab', arg=os.path.join(input_snp_dir, SNP_TAB_FILE))
+        self.input_snp_index = FlagArg(flag='--snp_index', arg=os.path.join(input_snp_dir, SNP_INDEX_FILE))
+        self.input_haplotype = FlagArg(flag='--haplotype', arg=os.path.join(input_snp_dir, HAPLOTYPE_FILE))
+        self.hdf5 = hdf5
+        self.haplotypes = haplotypes
 
     def format_command(self):
         command = [self.execution_path]
         command.extend([SPACE.join(map(str, [flag, arg])) for flag, arg in self.args])
         command.extend([self.output_file.flag, self.output_file.arg])
-        command.extend([self.input_snp_dir.flag, self.input_snp_dir.arg])
+        if self.hdf5:
+            command.extend([self.input_snp_tab.flag, self.input_snp_tab.arg])
+            command.extend([self.input_snp_index.flag, self.input_snp_index.arg])
+            if self.haplotypes:
+                command.extend([self.input_haplotype.flag, self.input_haplotype.arg])
+        else:
+            command.extend([self.input_snp_dir.flag, self.input_snp_dir.arg])
         command.append(self.input_file.arg)
 
         return SPACE.join(command)
 
+    def get_input_paths(self):
+        return super().get_input_paths() + [self.input_snp_dir.arg]
+
+    def get_cache_signature(self):
+        signature = super().get_cache_signature()
+        signature['hdf5'] = self.hdf5
+        signature['haplotypes'] = self.haplotypes
+        return signature
+
     def retrieve_output_path(self, default_output=True):
         bam_keep = glob(self.output_dir + os.sep + AST + 'keep.bam').pop()
         bam_remap = glob(self.output_dir + os.sep + AST + 'to.remap.bam').pop()
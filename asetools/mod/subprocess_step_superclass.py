@@ -6,14 +6,69 @@ This module contains the RunSubprocessStepSuper supeclass.
 This functions acts as the superclass for all of the subclasses that are found in the mod.subprocess directory.
 
 This superclass makes much of the analyses object-oriented, which greatly eases the creation of new subclasses.
+
+A step can also be run within an asyncio event loop with run_async(), which drains the output of the command without
+blocking, so that one process can run many steps at once.
 """
 
+import asyncio
 import subprocess
+from contextlib import contextmanager
+from mod.config.custom import VERSION_CACHE_FILE, USE_JVM_WORKERS, NAILGUN_SERVER_JAR, NAILGUN_SERVER_CLASS, \
+    NAILGUN_CLIENT_PATH, MAX_CONCURRENT_JVMS, JVM_WORKER_MAX_RUNS
 from mod.misc.exceptions import VersionError
 import json
+from mod.misc.jvm_workers import JvmWorkerPool
+from mod.misc.manifest import StepManifest
 from mod.misc.record_classes import flagarg_to_tuple
 from mod.misc.log import *
 from mod.misc.string_constants import *
+from mod.misc.version_cache import VersionCache
+
+# The versions of the tools, shared by all of the steps that run in this process.
+version_cache = VersionCache(VERSION_CACHE_FILE)
+
+# The java virtual machines that the picard and GATK steps run their tools in, shared by all of the steps that run in this
+# process, if they are enabled.
+jvm_workers = JvmWorkerPool(NAILGUN_SERVER_JAR, NAILGUN_SERVER_CLASS, NAILGUN_CLIENT_PATH, MAX_CONCURRENT_JVMS,
+                            max_runs=JVM_WORKER_MAX_RUNS) if USE_JVM_WORKERS else None
+
+# The output lines of a command that is run with run_async() are logged together, once there are this many of them or
+# the oldest of them has waited this many seconds.
+LOG_BATCH_LINES = 100
+LOG_BATCH_SECONDS = 1.0
+
+# The longest line that is read from the output of a command that is run with run_async().
+STREAM_LIMIT = 2 ** 24
+
+# The number of seconds a command that timed out or was cancelled has to exit after SIGTERM, before it is killed.
+TERMINATE_SECONDS = 10
+
+
+async def run_steps_async(steps, max_concurrent=None, timeout=None):
+    """
+    Runs many steps at once within an asyncio event loop. If a step fails, the others are cancelled.
+    :param steps: The RunSubprocessStepSuper objects to run.
+    :param max_concurrent: The maximum number of steps that run at once. All of them are run at once if it is None.
+    :param timeout: The number of seconds each command may run for, or None.
+    :return: The output paths of the steps, in order.
+    """
+    semaphore = asyncio.Semaphore(max_concurrent) if max_concurrent else None
+
+    async def run_step(step):
+        if semaphore is None:
+            return await step.run_async(timeout=timeout)
+        async with semaphore:
+            return await step.run_async(timeout=timeout)
+
+    tasks = [asyncio.ensure_future(run_step(step)) for step in steps]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
 
 
 class RunSubprocessStepSuper:
@@ -22,7 +77,7 @@ class RunSubprocessStepSuper:
     generates the appropriate command, executes that command with subprocess, and then retrieves the output files.
     """
     def __init__(self, name, output_dir, execution_path, version, version_flag, version_parser, input_file, output_file,
-                 args, log_name, logger=None):
+                 args, log_name, logger=None, resources=None):
 
         self.name = name
         self.output_dir = output_dir
@@ -41,6 +96,9 @@ class RunSubprocessStepSuper:
         self.log_name = log_name
         self.logger = logger
 
+        # The cores, memory and scratch disk that the step needs while it runs, as declared by its custom config.
+        self.resources = resources if resources else {}
+
         self.ran = False
 
 
@@ -59,12 +117,105 @@ class RunSubprocessStepSuper:
         self.execute_command()
         self.save_log()
         self.ran = True
+        self.save_manifest()
+        return self.retrieve_output_path()
+
+
+    async def run_async(self, make_output_dir=True, timeout=None):
+        """
+        Runs the step in the same way as run(), within an asyncio event loop. If the task is cancelled, or the command
+        runs for longer than the timeout, the command is stopped.
+        :param make_output_dir: Whether or not to make the output directory.
+        :param timeout: The number of seconds the command may run for, after which subprocess.TimeoutExpired is raised.
+        :return: The path to the output file.
+        """
+        Log.info_chk(self.logger, msg_starting_run.format(NAME=self.name))
+
+        if make_output_dir:
+            os.makedirs(self.output_dir, exist_ok=True)
+
+        # The version check is usually answered by the version cache, and otherwise runs in a thread.
+        await asyncio.get_running_loop().run_in_executor(None, self.check_version)
+        await self.execute_command_async(timeout=timeout)
+        self.save_log()
+        self.ran = True
+        self.save_manifest()
         return self.retrieve_output_path()
 
 
+    def completed_previously(self):
+        """
+        Checks the completion manifest of a previous run. If the step already ran with the same inputs, command and
+        tool version, and its outputs are unchanged, the step is marked as ran so that it does not need to run again.
+        :return: True if the step already completed.
+        """
+        manifest = StepManifest(self.get_manifest_path())
+        if manifest.matches(self.get_input_paths(), self.format_command(), self.version):
+            Log.info_chk(self.logger, msg_skipping_completed_step.format(NAME=self.name, PATH=manifest.path))
+            self.ran = True
+            return True
+        return False
+
+
+    def run_cached(self, step_cache, make_output_dir=True):
+        """
+        Runs the step unless its outputs are already in the step cache, in which case they are linked into the output
+        directory instead. The outputs of a step that is run are added to the cache.
+        :param step_cache: The StepCache to look up and store the outputs in.
+        :param make_output_dir: Whether or not to make the output directory.
+        :return: The path to the output file.
+        """
+        if make_output_dir:
+            os.makedirs(self.output_dir, exist_ok=True)
+
+        if step_cache.fetch(self):
+            Log.info_chk(self.logger, msg_step_cache_hit.format(NAME=self.name, PATH=step_cache.cache_dir))
+            self.save_log()
+            self.ran = True
+            self.save_manifest()
+            return self.retrieve_output_path()
+
+        output = self.run(make_output_dir=make_output_dir)
+        if step_cache.store(self):
+            Log.info_chk(self.logger, msg_step_cache_store.format(NAME=self.name, PATH=step_cache.cache_dir))
+        return output
+
+
+    def get_resources(self):
+        """
+        This can be overridden in a subclass that runs several commands at once.
+        :return: A dictionary of the resources that the step needs while it runs, for the ResourcePool.
+        """
+        return dict(self.resources)
+
+
+    def get_cache_signature(self):
+        """
+        Everything other than the input files that determines the outputs of the step. Paths that depend on where the
+        pipeline is run are left out, so that the cache can be shared between pipelines.
+        This can be overridden to return None for a step that should never be cached.
+        :return: An object that can be formatted as a json object.
+        """
+        output_names = []
+        if self.output_file is not None:
+            output_names = [os.path.basename(str(arg)) for arg in list(self.output_file)[1:] if arg]
+
+        return {'name': self.name, 'version': self.version, 'args': self.args, 'output': output_names}
+
+
+    def save_manifest(self):
+        """
+        Saves the completion manifest of the step next to its json log.
+        """
+        Log.info_chk(self.logger, msg_saving_run_info.format(PATH=self.get_manifest_path()))
+        StepManifest(self.get_manifest_path()).save(self.get_input_paths(), self.format_command(), self.version,
+                                                    self.get_output_paths())
+
+
     def check_version(self, stderr=subprocess.PIPE, ignore_error=False, pass_version_to_parser=False):
         """
-        Checks that the version of the application being run matches the expected version.
+        Checks that the version of the application being run matches the expected version. The output of the version
+        command is cached, so it is only run again when the files of the execution path change.
         :param stderr: passes the stderr to the subprocess.check_output() method.
         :param ignore_error: Determines whether subprocess.check_output() are ignored or not.
         :param pass_version_to_parser: Determines whether or not the version is passed to the version_parser.
@@ -76,7 +227,8 @@ class RunSubprocessStepSuper:
                                                                       PVTP=pass_version_to_parser))
         try:
             Log.debug_chk(self.logger, SPACE.join(self.execution_path.split() + self.version_flag.split()))
-            output = subprocess.check_output(self.execution_path.split() + self.version_flag.split(), stderr=stderr)
+            output = version_cache.check_output(self.execution_path, self.version_flag, stderr=stderr,
+                                                save_errors=ignore_error)
 
         except subprocess.CalledProcessError as e:
             if ignore_error:
@@ -103,22 +255,145 @@ class RunSubprocessStepSuper:
             if not shell:
                 command = command.split()
 
-            popen = subprocess.Popen(command, stdout=stdout, stderr=stderr, shell=shell, universal_newlines=True)
+            with self.dispatch_command(command) as command:
+                popen = subprocess.Popen(command, stdout=stdout, stderr=stderr, shell=shell, universal_newlines=True)
 
-            for stdout_line in iter(popen.stdout.readline, ""):
-                Log.info_chk(self.logger, stdout_line.strip())
-            popen.stdout.close()
+                for stdout_line in iter(popen.stdout.readline, ""):
+                    Log.info_chk(self.logger, stdout_line.strip())
+                popen.stdout.close()
 
-            return_code = popen.wait()
+                return_code = popen.wait()
 
-            if return_code:
-                raise subprocess.CalledProcessError(return_code, command)
+                if return_code:
+                    raise subprocess.CalledProcessError(return_code, command)
 
         except subprocess.CalledProcessError as e:
             print(e.output)
             raise e
 
 
+    async def execute_command_async(self, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=False, timeout=None):
+        """
+        Executes the command in the same way as execute_command(), but drains the stdout and stderr of the command
+        with asyncio and logs their lines in batches. Subclasses that override execute_command() have it run in a
+        thread instead, where a timeout or cancellation stops the wait, but not their command.
+        :param stdout: The stdout of the command, which is drained and logged if it is subprocess.PIPE.
+        :param stderr: The stderr of the command, which is drained and logged if it is subprocess.PIPE.
+        :param shell: Whether the command is run by the shell.
+        :param timeout: The number of seconds the command may run for, after which subprocess.TimeoutExpired is raised.
+        """
+        if type(self).execute_command is not RunSubprocessStepSuper.execute_command:
+            loop = asyncio.get_running_loop()
+            await asyncio.wait_for(loop.run_in_executor(None, self.execute_command), timeout)
+            return
+
+        command = self.format_command()
+        Log.info_chk(self.logger, msg_executing_command.format(DELIM=NL, COMMAND=command))
+        Log.debug_chk(self.logger, msg_execute_command_signature.format(STDERR=stderr, SHELL=shell))
+
+        if not shell:
+            command = command.split()
+
+        # Taking a JVM worker may start it, and returning one may stop it, so both are done in a thread.
+        loop = asyncio.get_running_loop()
+        dispatch = self.dispatch_command(command)
+        command = await loop.run_in_executor(None, dispatch.__enter__)
+        try:
+            if shell:
+                process = await asyncio.create_subprocess_shell(command, stdout=stdout, stderr=stderr,
+                                                                limit=STREAM_LIMIT)
+            else:
+                process = await asyncio.create_subprocess_exec(*command, stdout=stdout, stderr=stderr,
+                                                               limit=STREAM_LIMIT)
+
+            streams = [stream for stream in (process.stdout, process.stderr) if stream is not None]
+            try:
+                await asyncio.wait_for(asyncio.gather(*map(self.drain_async, streams), process.wait()), timeout)
+            except asyncio.TimeoutError:
+                await self.stop_process(process, 'timed out')
+                raise subprocess.TimeoutExpired(command, timeout)
+            except asyncio.CancelledError:
+                await self.stop_process(process, 'was cancelled')
+                raise
+
+            if process.returncode:
+                raise subprocess.CalledProcessError(process.returncode, command)
+
+        except BaseException as e:
+            await loop.run_in_executor(None, dispatch.__exit__, type(e), e, e.__traceback__)
+            raise
+        await loop.run_in_executor(None, dispatch.__exit__, None, None, None)
+
+
+    @contextmanager
+    def dispatch_command(self, command):
+        """
+        Runs a java command in a JVM worker, if they are enabled, instead of in a new java virtual machine. The worker
+        is stopped if the command fails.
+        :param command: The command, as a string to be run by the shell or as a list of words.
+        :return: A context manager that yields the command to run, in the same form.
+        """
+        if jvm_workers is None:
+            yield command
+            return
+
+        with jvm_workers.dispatch(self.execution_path, command, logger=self.logger) as command:
+            yield command
+
+
+    async def drain_async(self, stream):
+        """
+        Logs the lines of a stream of a command in batches, until the stream is closed.
+        :param stream: An asyncio.StreamReader of the stdout or stderr of the command.
+        """
+        loop = asyncio.get_running_loop()
+        lines = []
+        first_line_time = None
+
+        while True:
+            wait = max(first_line_time + LOG_BATCH_SECONDS - loop.time(), 0) if lines else None
+            try:
+                line = await asyncio.wait_for(stream.readline(), wait)
+            except asyncio.TimeoutError:
+                line = None
+
+            if line:
+                if not lines:
+                    first_line_time = loop.time()
+                lines.append(line.decode(UTF8, errors='replace').strip())
+                if len(lines) < LOG_BATCH_LINES and loop.time() - first_line_time < LOG_BATCH_SECONDS:
+                    continue
+
+            if lines:
+                Log.info_chk(self.logger, NL.join(lines))
+                lines = []
+
+            # An empty line is the end of the stream.
+            if line == b'':
+                break
+
+
+    async def stop_process(self, process, reason):
+        """
+        Terminates a command, and kills it if it does not exit in time.
+        :param process: The asyncio.subprocess.Process of the command.
+        :param reason: Why the command is stopped, for the log.
+        """
+        if process.returncode is not None:
+            return
+
+        Log.info_chk(self.logger, msg_stopping_command.format(NAME=self.name, REASON=reason))
+        try:
+            process.terminate()
+            try:
+                await asyncio.wait_for(process.wait(), TERMINATE_SECONDS)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+        except ProcessLookupError:
+            pass
+
+
     def save_log(self):
         """
         Saves a log file keeping track of the arguments used to run the command.
@@ -160,6 +435,34 @@ class RunSubprocessStepSuper:
         return os.path.join(self.output_dir, self.log_name)
 
 
+    def get_manifest_path(self):
+        """
+        :return: The path to the completion manifest, which is saved next to the json log.
+        """
+        return os.path.splitext(self.get_log_path())[0] + '.manifest.json'
+
+
+    def get_input_paths(self):
+        """
+        This can be overridden in a subclass that takes more input files than those in self.input_file.
+        :return: The paths to the input files of the step.
+        """
+        if self.input_file is None:
+            return []
+        return [arg for arg in list(self.input_file)[1:] if arg]
+
+
+    def get_output_paths(self):
+        """
+        This can be overridden in a subclass that produces output files other than those it returns.
+        :return: The paths to the output files of the step.
+        """
+        output = self.retrieve_output_path()
+        if isinstance(output, (list, tuple)):
+            return list(output)
+        return [output]
+
+
     def format_command(self):
         """
         This formats the command to be executed by the subprocess module. This is the only function that must
@@ -0,0 +1,176 @@
+"""
+AUTHOR: Matt Durrant
+
+This module contains the RunSubprocessStreamSuper superclass.
+
+This superclass chains several RunSubprocessStepSuper objects together with OS pipes, so that the stdout of each step
+is read directly from the stdin of the next. Intermediate files, such as the uncompressed SAM written by STAR, then
+never touch the disk. The chain behaves like a single step, with one json log and one completion manifest.
+"""
+
+import subprocess
+import threading
+from mod.misc.log import *
+from mod.misc.resources import combine_requests
+from mod.misc.string_constants import *
+from mod.subprocess_step_superclass import RunSubprocessStepSuper
+
+# The path a step reads from when its input is streamed from the previous step.
+STDIN_PATH = '/dev/stdin'
+
+
+class RunSubprocessStreamSuper(RunSubprocessStepSuper):
+    """
+    This is a super class that executes a chain of subprocess steps, piping the output of each step into the next.
+    The first step must write its output to stdout and every later step must read its input from STDIN_PATH.
+    """
+    def __init__(self, name, output_dir, steps, log_name, logger=None):
+        """
+        Constructor for the superclass.
+        :param name: The name of the chain of steps.
+        :param output_dir: The output directory to save the json log and manifest of the chain.
+        :param steps: A list of RunSubprocessStepSuper objects in the order that the data flows through them.
+        :param log_name: The name of the json log of the chain.
+        :param logger: The logger object for outputting all of the relevant log information.
+        """
+        self.steps = steps
+
+        super().__init__(name=name, output_dir=output_dir, execution_path=None,
+                         version=[step.version for step in steps], version_flag=None, version_parser=None,
+                         input_file=steps[0].input_file, output_file=steps[-1].output_file, args=None,
+                         log_name=log_name, logger=logger)
+
+
+    def run(self, make_output_dir=True):
+        """
+        Runs the chain of steps.
+        :param make_output_dir: Whether or not to make the output directories.
+        :return: The path to the output file of the last step.
+        """
+        if make_output_dir:
+            for step in self.steps:
+                os.makedirs(step.output_dir, exist_ok=True)
+
+        return super().run(make_output_dir=make_output_dir)
+
+
+    async def run_async(self, make_output_dir=True, timeout=None):
+        """
+        Runs the chain of steps within an asyncio event loop. The chain itself is run in a thread.
+        :param make_output_dir: Whether or not to make the output directories.
+        :param timeout: The number of seconds the chain may run for.
+        :return: The path to the output file of the last step.
+        """
+        if make_output_dir:
+            for step in self.steps:
+                os.makedirs(step.output_dir, exist_ok=True)
+
+        return await super().run_async(make_output_dir=make_output_dir, timeout=timeout)
+
+
+    def check_version(self, stderr=subprocess.PIPE, ignore_error=False, pass_version_to_parser=False):
+        for step in self.steps:
+            step.check_version()
+
+
+    def get_resources(self):
+        """
+        :return: The resources of all of the steps together, as they all run at once.
+        """
+        return combine_requests(step.get_resources() for step in self.steps)
+
+
+    def format_command(self):
+        """
+        :return: The commands of all of the steps, joined as a shell pipeline.
+        """
+        return ' | '.join(step.format_command() for step in self.steps)
+
+
+    def execute_command(self, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=False):
+        """
+        Starts every step at once, with the stdout of each connected to the stdin of the next. The stderr of every
+        step is logged as it is produced.
+        """
+        Log.info_chk(self.logger, msg_executing_command.format(DELIM=NL, COMMAND=self.format_command()))
+
+        processes = []
+        drains = []
+        stdin = None
+
+        try:
+            for step in self.steps:
+                command = step.format_command().split()
+                popen = subprocess.Popen(command, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+                # The parent's copy of the pipe is closed, so that a step receives SIGPIPE if the next step exits.
+                if stdin is not None:
+                    stdin.close()
+
+                processes.append((command, popen))
+                drains.append(self.drain(popen.stderr))
+                stdin = popen.stdout
+
+            # The stdout of the last step is not streamed anywhere, so it is logged as well.
+            drains.append(self.drain(stdin))
+
+        except OSError:
+            for command, popen in processes:
+                popen.kill()
+            raise
+
+        for drain in drains:
+            drain.join()
+
+        return_codes = [(command, popen.wait()) for command, popen in processes]
+        for command, return_code in return_codes:
+            if return_code:
+                raise subprocess.CalledProcessError(return_code, command)
+
+
+    def drain(self, stream):
+        """
+        Logs each line of a stream in a background thread.
+        :param stream: A binary stream from a subprocess.
+        :return: The thread, which finishes when the stream is closed.
+        """
+        def log_lines():
+            for line in iter(stream.readline, b''):
+                Log.info_chk(self.logger, line.decode(UTF8, errors='replace').strip())
+            stream.close()
+
+        thread = threading.Thread(target=log_lines, daemon=True)
+        thread.start()
+        return thread
+
+
+    def get_log_json(self, input_class_parse=None, output_class_parse=None):
+        """
+        :return: The json logs of all of the steps in the chain.
+        """
+        log_json = {
+
+            'name': self.name,
+            'output_dir': self.output_dir,
+            'command': self.format_command(),
+            'steps': [step.get_log_json() for step in self.steps]
+
+        }
+
+        return log_json
+
+
+    def get_input_paths(self):
+        return self.steps[0].get_input_paths()
+
+
+    def get_output_paths(self):
+        return self.steps[-1].get_output_paths()
+
+
+    def get_cache_signature(self):
+        return [step.get_cache_signature() for step in self.steps]
+
+
+    def retrieve_output_path(self, default_output=True):
+        return self.steps[-1].retrieve_output_path()
@@ -0,0 +1,50 @@
+"""
+AUTHOR: Matt Durrant
+
+Tests that a process step that completed in a previous run is only skipped when it is run again with the same parameters.
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mod.process.wasp_make_snp_dir import RunMakeWaspSnpDir
+
+VCF_LINES = [
+    '##fileformat=VCFv4.1\n',
+    '##contig=<ID=chr1,length=1000>\n',
+    '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n',
+    'chr1\t100\trs1\tA\tG\t.\tPASS\t.\n',
+    'chr1\t200\trs2\tC\tT\t.\tPASS\t.\n',
+]
+
+
+class CompletedPreviouslyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.vcf = os.path.join(self.temp_dir.name, 'sites.vcf')
+        with open(self.vcf, 'w') as outfile:
+            outfile.writelines(VCF_LINES)
+        self.output_dir = os.path.join(self.temp_dir.name, 'snp_dir')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_same_parameters_are_skipped(self):
+        RunMakeWaspSnpDir(self.output_dir, self.vcf, processes=1).run()
+        self.assertTrue(RunMakeWaspSnpDir(self.output_dir, self.vcf, processes=1).completed_previously())
+
+    def test_processes_do_not_rerun(self):
+        RunMakeWaspSnpDir(self.output_dir, self.vcf, processes=1).run()
+        self.assertTrue(RunMakeWaspSnpDir(self.output_dir, self.vcf, processes=2).completed_previously())
+
+    def test_changed_parameter_reruns(self):
+        RunMakeWaspSnpDir(self.output_dir, self.vcf, processes=1, hdf5=False).run()
+        self.assertFalse(RunMakeWaspSnpDir(self.output_dir, self.vcf, processes=1, hdf5=True).completed_previously())
+
+
+if __name__ == '__main__':
+    unittest.main()
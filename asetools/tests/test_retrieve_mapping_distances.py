@@ -0,0 +1,96 @@
+"""
+AUTHOR: Matt Durrant
+
+Tests that reading a window of sites with a single pileup finds the same reads and bases as reading each site with its
+own pileup, including for overlapping mates where one of the mates has a deletion or a skipped region in the overlap.
+"""
+
+import os
+import random
+import sys
+import tempfile
+import unittest
+
+import pysam
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mod.process.retrieve_mapping_distances import read_window
+
+CONTIG_LENGTH = 2000
+READ_LENGTH = 50
+MATE_CIGARS = ['50M', '20M5D30M', '20M100N30M']
+
+
+def write_bam(path, seed=1):
+    """
+    Writes a sorted and indexed BAM file of overlapping read pairs, with random bases and base qualities.
+    :param path: The path to the BAM file.
+    :param seed: The seed of the random bases and base qualities.
+    """
+    rng = random.Random(seed)
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'}, 'SQ': [{'SN': 'chr1', 'LN': CONTIG_LENGTH}]}
+    reads = []
+
+    for pair in range(300):
+        start = rng.randrange(100, 1500)
+        mate_start = start + rng.randrange(0, 40)
+        for is_read1, read_start, mate_read_start in [(True, start, mate_start), (False, mate_start, start)]:
+            read = pysam.AlignedSegment()
+            read.query_name = 'r{PAIR}'.format(PAIR=pair)
+            read.flag = 0x1 | 0x2 | (0x40 | 0x20 if is_read1 else 0x80 | 0x10)
+            read.reference_id, read.reference_start = 0, read_start
+            read.next_reference_id, read.next_reference_start = 0, mate_read_start
+            read.cigarstring = '50M' if is_read1 else rng.choice(MATE_CIGARS)
+            read.mapping_quality = 60
+            read.query_sequence = ''.join(rng.choice('AC') for _ in range(READ_LENGTH))
+            read.query_qualities = pysam.qualitystring_to_array(''.join(chr(33 + rng.randrange(5, 40))
+                                                                        for _ in range(READ_LENGTH)))
+            reads.append(read)
+
+    unsorted_path = path + '.unsorted.bam'
+    with pysam.AlignmentFile(unsorted_path, 'wb', header=header) as outfile:
+        for read in sorted(reads, key=lambda read: read.reference_start):
+            outfile.write(read)
+    pysam.sort('-o', path, unsorted_path)
+    pysam.index(path)
+
+
+def site_bases(bamfile, position):
+    """
+    :param bamfile: The indexed BAM file.
+    :param position: A zero-based position.
+    :return: The (read name, is read1, base) tuples of the reads with a base at the position, from a pileup of the
+    position alone.
+    """
+    bases = []
+    for pileupcolumn in bamfile.pileup('chr1', position, position + 1, truncate=True):
+        for pileupread in pileupcolumn.pileups:
+            if not pileupread.is_del and not pileupread.is_refskip:
+                read = pileupread.alignment
+                bases.append((read.query_name, read.is_read1, read.query_sequence[pileupread.query_position]))
+    return bases
+
+
+class ReadWindowTestCase(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.bam = os.path.join(self.temp_dir.name, 'pairs.bam')
+        write_bam(self.bam)
+        self.bamfile = pysam.AlignmentFile(self.bam, 'rb')
+
+    def tearDown(self):
+        self.bamfile.close()
+        self.temp_dir.cleanup()
+
+    def test_window_matches_each_site(self):
+        positions = list(range(90, 1700, 3))
+        site_reads = read_window(self.bamfile, 'chr1', positions)
+
+        for position in positions:
+            window_bases = [(read.query_name, read.is_read1, base) for read, base in site_reads[position]]
+            self.assertEqual(window_bases, site_bases(self.bamfile, position), position)
+
+
+if __name__ == '__main__':
+    unittest.main()